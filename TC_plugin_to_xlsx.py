@@ -1,7 +1,16 @@
+import argparse
+import functools
+import hashlib
 import json
-import pandas as pd
-import pandasql as pdsql
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import NamedTuple
 import xlsxwritertools
+from plugin_cache import file_sha256
+from plugin_config import load_plugin_model
+from plugin_linter import lint_plugin_config, write_findings_sheet
+from api_budget import estimate_api_calls, write_budget_sheet
 from openpyxl import workbook
 from decimal import Decimal
 from autofit_spreadsheet_columns import autofit_spreadsheet_columns
@@ -22,26 +31,48 @@ unicode_symbols = {
     "tick": "\N{White Heavy Check Mark}",
 }
 
-crmrequirements = [
-    "Salesforce Requirements to Connect the Plugin",
-    "Salesforce must authorize Outreach through a Salesforce system user and meet the following requirements:",
-    "The Salesforce system user must be able to modify data (create, edit, delete) on required objects that need to be shown in Outreach (i.e. Accounts, Contacts, Leads, Opportunities, User, User Role, Task/Event).",
-    "The Salesforce system user must have Field Level Security settings that allow it to view and modify any mapped fields",
-    "The profile the connecting Salesforce to Outreach has \"API Enabled\" under System Permissions in the Profile of the User",
-    "Before configuring the bi-directional sync with Outreach, there are a few minimum requirements needed to leverage the Salesforce connection.",
-    "The profile connecting Salesforce to Outreach can create or edit all objects (like Accounts, Contacts, Leads, Users, etc.)",
-    "",
-    "Outreach Requirements",
-    "Outreach is compatible with Salesforce Lightning, Aloha (\"Classic\"), Console, and the SKUID overlay",
-    "The Outreach user must be listed as an Admin within Outreach to have access to the plugin settings for connection.",
-    "Outreach uses Rest API calls to communicate and sync with Salesforce. Enterprise & Unlimited editions of Salesforce are bundled with Rest API calls, but the Professional Edition is not.: https://developer.salesforce.com/docs/atlas.en-us.api_rest.meta/api_rest/",
-    "If you are using Salesforce Professional Edition, you need to have the Web API Package and purchase API call bundles.",
-    "To determine if your organization has purchased the API package, click on: Setup > Monitor > System Overview > API usage.",
-    "To verify which version of Salesforce your company is using, follow these steps.",
-    "If you are an existing Salesforce customer who is not on one of the above supported version and want to upgrade, contact your Salesforce Account Executive.",
-    "",
-    "SFDC Requirements: https://support.outreach.io/hc/en-us/articles/218582707"
-]
+# Logical operators of condition blocks, which label_mapping can relabel
+logical_operators = ("AND", "OR")
+
+# The CRM Requirements sheet, as blocks of a heading and its lines with a blank
+# row between blocks. A provider without blocks of its own gets the generic
+# ones with {provider} filled in; crm_requirement_providers points providers
+# at the blocks of another one.
+crm_requirement_blocks = {
+    "salesforce": (
+        ("Salesforce Requirements to Connect the Plugin", (
+            "Salesforce must authorize Outreach through a Salesforce system user and meet the following requirements:",
+            "The Salesforce system user must be able to modify data (create, edit, delete) on required objects that need to be shown in Outreach (i.e. Accounts, Contacts, Leads, Opportunities, User, User Role, Task/Event).",
+            "The Salesforce system user must have Field Level Security settings that allow it to view and modify any mapped fields",
+            "The profile the connecting Salesforce to Outreach has \"API Enabled\" under System Permissions in the Profile of the User",
+            "Before configuring the bi-directional sync with Outreach, there are a few minimum requirements needed to leverage the Salesforce connection.",
+            "The profile connecting Salesforce to Outreach can create or edit all objects (like Accounts, Contacts, Leads, Users, etc.)",
+        )),
+        ("Outreach Requirements", (
+            "Outreach is compatible with Salesforce Lightning, Aloha (\"Classic\"), Console, and the SKUID overlay",
+            "The Outreach user must be listed as an Admin within Outreach to have access to the plugin settings for connection.",
+            "Outreach uses Rest API calls to communicate and sync with Salesforce. Enterprise & Unlimited editions of Salesforce are bundled with Rest API calls, but the Professional Edition is not.: https://developer.salesforce.com/docs/atlas.en-us.api_rest.meta/api_rest/",
+            "If you are using Salesforce Professional Edition, you need to have the Web API Package and purchase API call bundles.",
+            "To determine if your organization has purchased the API package, click on: Setup > Monitor > System Overview > API usage.",
+            "To verify which version of Salesforce your company is using, follow these steps.",
+            "If you are an existing Salesforce customer who is not on one of the above supported version and want to upgrade, contact your Salesforce Account Executive.",
+        )),
+        ("SFDC Requirements: https://support.outreach.io/hc/en-us/articles/218582707", ()),
+    ),
+    "generic": (
+        ("{provider} Requirements to Connect the Plugin", (
+            "{provider} must authorize Outreach through a {provider} system user and meet the following requirements:",
+            "The {provider} system user must be able to modify data (create, edit, delete) on the objects that are synced with Outreach.",
+            "The {provider} system user must be able to view and modify any mapped fields.",
+            "The {provider} system user must have API access.",
+        )),
+        ("Outreach Requirements", (
+            "The Outreach user must be listed as an Admin within Outreach to have access to the plugin settings for connection.",
+        )),
+    ),
+}
+crm_requirement_providers = {"salesforcesandbox": "salesforce"}
+crm_requirements_sheet_name = "CRM Requirements"
 
 # label_mapping includes all columns in the excel document
 label_mapping = {
@@ -130,7 +161,7 @@ preset_data_lead = {
     },
     "actively being sequenced": {
         "FieldType": "Checkbox",
-        "Outreach Engagement": "Record Data",
+        "RecordType": "Outreach Engagement",
         "Note": "This field identifies if a Prospect is Active in a sequence."
     },
     "add date": {
@@ -235,44 +266,18 @@ types_mapping_to_preset_data = {
     "Contact": dict(preset_data_contact, **preset_data_engagement_panel_fields),
 }
 
-# helper function to load plugin config json file
-
-
-def read_plugin_json(fname="sage_plugin_configuration.json"):
-    with open(fname, 'r') as f:
-        plugin_data = json.load(f)
-    return plugin_data
-
-# To identify the plugin types and fields associated w/ the types
-
-
-def get_mappings_dict(plugin_data):
-    ptype_mappings = plugin_data['Legacy'].get('PluginTypeMappings', [])
-    types = {}
-    type_names = []
-    for ptype in ptype_mappings:
-        for temp in ptype['FieldMappings']:
-            for key in temp:
-                if key == 'Template':
-                    temp['InternalField'] = temp[key]
+# To replace the provider with Provider
 
-        if ptype['InternalType'] == 'MessengerGroup':  # Ignore MessengerGroup object
-            continue
-        # name = str(ptype['ExternalType'])+'-'+str(ptype['InternalType'])
-        name = (ptype['ExternalType'], ptype['InternalType'])
-        type_names.append(name)
-        types[name] = {"output": {}, "input": ptype}
-    limits = plugin_data['Legacy']
-    del limits['PluginTypeMappings']
-    return limits, type_names, types
 
-# To replace the provider with Provider
+# The labels as written, with the {provider} placeholders still in them, so
+# converting another export in the same process gets its own provider
+label_mapping_template = dict(label_mapping)
 
 
 def update_provider_in_label_mapping(datadict):
     provider = datadict['Provider'].capitalize()
-    for i in label_mapping:
-        label_mapping[i] = label_mapping[i].replace(
+    for i in label_mapping_template:
+        label_mapping[i] = label_mapping_template[i].replace(
             "{provider}", provider)
 
 # To add types to label mappings
@@ -286,14 +291,14 @@ def update_external_internal_in_label_mapping(datalist, lm):
         lm[index] = lm[index].replace("{internal_type}", internal_type)
     return (lm)
 
-# To remove the label mappings and keep the mapping data
+# To list the items of a dict with the label mappings in place of the keys.
+# The relabelled keys come last, in label mapping order; the dict isn't changed
 
 
-def update_labels_in_dictdata(data, lm):
-    for label in lm:
-        if label in data:
-            data[lm[label]] = data.pop(label)
-    return (data)
+def relabelled_items(data, lm):
+    items = [(key, value) for key, value in data.items() if key not in lm]
+    items.extend((lm[label], data[label]) for label in lm if label in data)
+    return items
 
 # To return the label mapping with its value
 
@@ -325,424 +330,877 @@ def intersperse(lst, item):
 def surround_with_quotation_marks(value):
     return f"{unicode_symbols['opening quotation']}{value}{unicode_symbols['closing quotation']}"
 
-# To create condition columns and add the mapping values to the columns
-
-
-def write_conditions(value, label_mapping, row):
-    logical_operator = (update_label(
-        value['LogicalOperator'].upper(), label_mapping), '', '')
-    if 'Conditions' in value.keys():
-        conditions = value['Conditions']
-    elif 'ConditionGroups' in value.keys():
-        # Combined components of conditions into a single cell, replaced operator labels with symbols, added quotation marks to comparison values, and tidied up.
-        # print(value["ConditionGroups"][0])
-        row = write_conditions(value["ConditionGroups"][0], label_mapping, row)
-        return row
-    column_names = list(conditions[0].keys())
-    order = [1, 0, 2]
-    column_names = [column_names[i] for i in order]
-    column_names[1] = update_label(column_names[1], unicode_symbols)
-
-    df = pd.DataFrame(columns=column_names)
-    df = df.append(conditions, ignore_index=True)
-    df.fillna('null', inplace=True)
-    list_of_conditions = df.values.tolist()
-    # print(list_of_conditions)
-    list_of_conditions = intersperse(list_of_conditions, logical_operator)
-    # print(list_of_conditions)
-
-    # rewrite the below - no for loop
-    for i in list_of_conditions:
-        if i[1] == '':
-            # row = wb.add_single_row_shift(
-            #     sheet, row, col_dict_conditions_operator, 1, update_labels_in_list(i, label_mapping))
-            row = wb.add_single_row(
-                sheet, row, col_dict_conditions, ("", f"{i[0]}"))
-        else:
-            i = [x if x != '' else 'null' for x in i]  # replace - with null
-            # row = wb.add_single_row_shift(
-            #     sheet, row, col_dict_conditions, 1, update_labels_in_list(i, label_mapping))
-            field_name = i[0]
-            field_name_with_quotes = surround_with_quotation_marks(field_name)
-            operator_label = i[1]
-            operator_symbol = update_label(operator_label, unicode_symbols)
-            comparison_value = i[2]
-            comparison_value_with_quotes = surround_with_quotation_marks(
-                comparison_value)
-            row = wb.add_single_row(
-                sheet, row, col_dict_conditions, ("", f"{field_name_with_quotes} {operator_symbol} {comparison_value_with_quotes}"))
-    if 'ConditionGroups' in value:
-        # row = wb.add_single_row_shift(
-        #     sheet, row, col_dict_conditions_operator, 1, logical_operator)
-        row = wb.add_single_row(
-            sheet, row, col_dict_conditions, ("", logical_operator[0]))
-        row = write_conditions(value["ConditionGroups"][0], label_mapping, row)
-    row = row + 1  # add a row after the condition)
-    return row
+# To render the values of a condition
+
+
+def render_condition_value(value):
+    # Missing and empty fields and values are shown as null
+    if value is None or value == '':
+        return 'null'
+    return value
+
+
+def _render_condition_block(block, operator_labels, offset, rendered):
+    """
+    Renders a Conditions/ConditionGroups block into rendered, as
+    (row offset, cell data) tuples.
+    Returns the offset of the row after the block.
+    """
+    logical_operator = block['LogicalOperator'].upper()
+    logical_operator = dict(operator_labels).get(logical_operator, logical_operator)
+    if 'Conditions' not in block and 'ConditionGroups' in block:
+        return _render_condition_block(
+            block['ConditionGroups'][0], operator_labels, offset, rendered)
+    for i, condition in enumerate(block['Conditions']):
+        if i > 0:
+            rendered.append((offset, ("", logical_operator)))
+            offset += 1
+        field_name_with_quotes = surround_with_quotation_marks(
+            render_condition_value(condition.get('Field')))
+        operator_label = render_condition_value(condition.get('ComparisonOperator'))
+        operator_symbol = update_label(operator_label, unicode_symbols)
+        comparison_value_with_quotes = surround_with_quotation_marks(
+            render_condition_value(condition.get('Value')))
+        # A long value list can be more than a cell holds; it carries on in
+        # the rows below.
+        for piece in xlsxwritertools.split_cell_text(
+                f"{field_name_with_quotes} {operator_symbol} {comparison_value_with_quotes}"):
+            rendered.append((offset, ("", piece)))
+            offset += 1
+    if 'ConditionGroups' in block:
+        rendered.append((offset, ("", logical_operator)))
+        offset += 1
+        offset = _render_condition_block(
+            block['ConditionGroups'][0], operator_labels, offset, rendered)
+    return offset + 1  # add a row after the condition
+
+
+# The same condition blocks repeat across plugin types and tenants, so the
+# rendered rows are cached by the canonical JSON of the block. The cache lives
+# as long as the process, which lets a batch run over many exports share it.
+condition_cache_size = 1024
+
+
+@functools.lru_cache(maxsize=condition_cache_size)
+def render_condition_block(canonical_block, operator_labels):
+    """
+    Renders a condition block given as canonical JSON (see write_conditions).
+    operator_labels: ((logical operator, label), ...) pairs
+    Returns a tuple of (row offset, cell data) tuples and the number of rows
+    the block takes up, blank row after it included.
+    """
+    rendered = []
+    height = _render_condition_block(
+        json.loads(canonical_block), operator_labels, 0, rendered)
+    return tuple(rendered), height
+
+
+class ConditionCacheStats(NamedTuple):
+    hits: int
+    misses: int
+    entries: int
+
+
+# Condition cache lookups made for this process by process pool workers (see
+# build_type_batches), whose caches go away with them
+_pool_condition_cache_stats = ConditionCacheStats(0, 0, 0)
+
+
+def condition_cache_info():
+    """
+    Returns the ConditionCacheStats of the condition cache in this process,
+    with the lookups of the process pool workers it ran added in.
+    """
+    cache_info = render_condition_block.cache_info()
+    own = ConditionCacheStats(cache_info.hits, cache_info.misses, cache_info.currsize)
+    return total_condition_cache_stats([own, _pool_condition_cache_stats])
+
+
+def condition_cache_stats_since(before):
+    """
+    Returns the ConditionCacheStats of the lookups made in this process since
+    before, an earlier condition_cache_info().
+    """
+    return ConditionCacheStats(*(now - then for now, then in zip(condition_cache_info(), before)))
+
+
+def total_condition_cache_stats(stats):
+    """
+    Adds up ConditionCacheStats, such as the ones returned by several workers.
+    """
+    return ConditionCacheStats(*(sum(column) for column in zip((0, 0, 0), *stats)))
+
+
+def format_condition_cache_stats(stats):
+    lookups = stats.hits + stats.misses
+    return 'condition cache: {} hits, {} misses ({:.0%} hit rate), {} entries'.format(
+        stats.hits, stats.misses, stats.hits / lookups if lookups else 0, stats.entries)
+
+
+# To create condition rows and add the mapping values to the rows list
+
+
+def write_conditions(value, label_mapping, row, rows):
+    # Combined components of conditions into a single cell, replaced operator labels with symbols, added quotation marks to comparison values, and tidied up.
+    canonical_block = json.dumps(value, sort_keys=True, separators=(',', ':'))
+    operator_labels = tuple((operator, update_label(operator, label_mapping))
+                            for operator in logical_operators)
+    rendered, height = render_condition_block(canonical_block, operator_labels)
+    for offset, data in rendered:
+        rows.append((row + offset, col_dict_conditions, data))
+    return row + height
 
 
 # Below are all styling the sheet
-if __name__ == "__main__":
-    plain_text = {
-        'width': 200,
+plain_text = {
+    'width': 200,
+    'style': 'text_style'
+}
+header_text = {
+    'width': 200,
+    'style': 'hdr_style',
+    'text_wrap': True
+}
+url_text = {
+    'width': 200,
+    'style': 'url_style'
+}
+
+col_dict_level_0 = {
+    # Field column style
+    0: {
+        'label': 'Field',
+        'width': 50,
+        'style': 'bold_style'
+    },
+    1: {
+        'label': 'Value',
+        'width': 50,
         'style': 'text_style'
-    }
-    header_text = {
-        'width': 200,
-        'style': 'hdr_style',
-        'text_wrap': True
-    }
-    url_text = {
+    },
+
+}
+
+col_condition = {
+
+    0: {
         'width': 200,
-        'style': 'url_style'
+        'height': 100,
+        'y_offset': 10,
+        'x_offset': 10,
+        'border': 1
     }
+}
 
-    col_dict_level_0 = {
-        # Field column style
-        0: {
-            'label': 'Field',
-            'width': 50,
-            'style': 'bold_style'
-        },
-        1: {
-            'label': 'Value',
-            'width': 50,
-            'style': 'text_style'
+# Style for Messages & Events settings
+col_dict_task_mapping = {
+    0: {
+        'label': 'Field',
+        'width': 100,
+        'style': 'bold_text_style'
+    },
+    1: {
+        'label': 'Value',
+        'width': 100,
+        'style': 'text_style'
+    },
+
+}
+# Style for conditional operators
+col_dict_conditions_operator = {
+    0: {
+        'width': 50,
+        'style': 'color_bold_text_style'
+    },
+    1: {'width': 50,
+        'style': 'color_bold_text_style'
         },
+    2: {'width': 50,
+        'style': 'color_bold_text_style'
+        }
 
+}
+# Style for conditions settings
+col_dict_conditions = {
+    0: {
+        'label': 'Field',
+        'width': 30,
+        'style': 'text_style'
+    },
+    1: {
+        'label': 'Comparison Operator',
+        'width': 30,
+        'style': 'color_bold_text_style',
+        'note': 'closing quotation:\N{Right Double Quotation Mark},contain:\N{Superset of or Equal To},cross:\N{Cross Mark},does not contain:\N{Not a Superset of},Equal:\N{Equals Sign},greater than or equal:\N{Greater-Than or Slanted Equal To},less than or equal:\N{Less-Than or Slanted Equal To},not equal:\N{Not Equal To},opening quotation:\N{Left Double Quotation Mark},tick:\N{White Heavy Check Mark}'
     }
+}
+col_field_mapping = {
+    0: {
+        'label': 'Internal Field',
+        'width': 30,
+        'style': 'text_style'
+    },
+    1: {
+        'label': 'Internal Empty Placeholder',
+        'width': 30,
+        'style': 'text_style'
+    },
+    2: {
+        'label': 'External Field',
+        'width': 30,
+        'style': 'text_style'
+    },
+    3: {
+        'label': 'External Mapped Type',
+        'width': 30,
+        'style': 'text_style'
+    },
+    4: {
+        'label': 'External Empty Placeholder',
+        'width': 30,
+        'style': 'text_style'
+    },
+    5: {
+        'label': 'Mapped Field',
+        'width': 30,
+        'style': 'text_style'
+    },
+    6: {
+        'label': 'Look For Name Instead Of record ID',
+        'width': 30,
+        'style': 'text_style'
+    },
+    7: {
+        'label': 'Display Name Instead Of record ID',
+        'width': 30,
+        'style': 'text_style'
+    },
+    8: {
+        'label': 'Updates In',
+        'width': 30,
+        'style': 'text_style'
+    },
+    9: {
+        'label': 'Outbound Omit If Empty',
+        'width': 30,
+        'style': 'text_style'
+    },
+    10: {
+        'label': 'Inbound Omit If Empty',
+        'width': 30,
+        'style': 'text_style'
+    },
+    11: {
+        'label': 'Updates Out',
+        'width': 30,
+        'style': 'text_style'
+    },
+}
+col_field_mapping1 = {
+    0: {
+        'label': 'Outreach Field Name',
+        'width': 30,
+        'style': 'text_style'
+    },
+    1: {
+        'label': 'SF Field Name',
+        'width': 30,
+        'style': 'text_style'
+    },
+    2: {
+        'label': 'Outreach Field Type',
+        'width': 30,
+        'style': 'text_style',
+        'dropdown': [
+            'Text',
+            'Number',
+            'Checkbox',
+            'Date/Time',
+            'Text (/Picklist)',
+            'Lookup'
+        ]
+    },
+    3: {
+        'label': 'Outreach Record Type',
+        'width': 30,
+        'style': 'text_style',
+        'dropdown': [
+            'Record Data',
+            'Opt-Out',
+            'Outreach Engagement',
+            'Custom Fields'
+        ]
+    },
 
-    col_condition = {
+    4: {
+        'label': 'Internal Empty Placeholder',
+        'width': 30,
+        'style': 'text_style'
+    },
 
-        0: {
-            'width': 200,
-            'height': 100,
-            'y_offset': 10,
-            'x_offset': 10,
-            'border': 1
-        }
-    }
+    5: {
+        'label': 'External Mapped Type',
+        'width': 30,
+        'style': 'text_style'
+    },
 
-    # Style for Messages & Events settings
-    col_dict_task_mapping = {
-        0: {
-            'label': 'Field',
-            'width': 100,
-            'style': 'bold_text_style'
-        },
-        1: {
-            'label': 'Value',
-            'width': 100,
-            'style': 'text_style'
-        },
+    6: {
+        'label': 'External Empty Placeholder',
+        'width': 30,
+        'style': 'text_style'
+    },
 
-    }
-    # Style for conditional operators
-    col_dict_conditions_operator = {
-        0: {
-            'width': 50,
-            'style': 'color_bold_text_style'
-        },
-        1: {'width': 50,
-            'style': 'color_bold_text_style'
-            },
-        2: {'width': 50,
-            'style': 'color_bold_text_style'
-            }
+    7: {
+        'label': 'Mapped Field',
+        'width': 30,
+        'style': 'text_style'
+    },
 
-    }
-    # Style for conditions settings
-    col_dict_conditions = {
-        0: {
-            'label': 'Field',
-            'width': 30,
-            'style': 'text_style'
-        },
-        1: {
-            'label': 'Comparison Operator',
-            'width': 30,
-            'style': 'color_bold_text_style',
-            'note': 'closing quotation:\N{Right Double Quotation Mark},contain:\N{Superset of or Equal To},cross:\N{Cross Mark},does not contain:\N{Not a Superset of},Equal:\N{Equals Sign},greater than or equal:\N{Greater-Than or Slanted Equal To},less than or equal:\N{Less-Than or Slanted Equal To},not equal:\N{Not Equal To},opening quotation:\N{Left Double Quotation Mark},tick:\N{White Heavy Check Mark}'
-        }
-    }
-    col_field_mapping = {
-        0: {
-            'label': 'Internal Field',
-            'width': 30,
-            'style': 'text_style'
-        },
-        1: {
-            'label': 'Internal Empty Placeholder',
-            'width': 30,
-            'style': 'text_style'
-        },
-        2: {
-            'label': 'External Field',
-            'width': 30,
-            'style': 'text_style'
-        },
-        3: {
-            'label': 'External Mapped Type',
-            'width': 30,
-            'style': 'text_style'
-        },
-        4: {
-            'label': 'External Empty Placeholder',
-            'width': 30,
-            'style': 'text_style'
-        },
-        5: {
-            'label': 'Mapped Field',
-            'width': 30,
-            'style': 'text_style'
-        },
-        6: {
-            'label': 'Look For Name Instead Of record ID',
-            'width': 30,
-            'style': 'text_style'
-        },
-        7: {
-            'label': 'Display Name Instead Of record ID',
-            'width': 30,
-            'style': 'text_style'
-        },
-        8: {
-            'label': 'Updates In',
-            'width': 30,
-            'style': 'text_style'
-        },
-        9: {
-            'label': 'Outbound Omit If Empty',
-            'width': 30,
-            'style': 'text_style'
-        },
-        10: {
-            'label': 'Inbound Omit If Empty',
-            'width': 30,
-            'style': 'text_style'
-        },
-        11: {
-            'label': 'Updates Out',
-            'width': 30,
-            'style': 'text_style'
-        },
-    }
-    col_field_mapping1 = {
-        0: {
-            'label': 'Outreach Field Name',
-            'width': 30,
-            'style': 'text_style'
-        },
-        1: {
-            'label': 'SF Field Name',
-            'width': 30,
-            'style': 'text_style'
-        },
-        2: {
-            'label': 'Outreach Field Type',
-            'width': 30,
-            'style': 'text_style',
-            'dropdown': [
-                'Text',
-                'Number',
-                'Checkbox',
-                'Date/Time',
-                'Text (/Picklist)',
-                'Lookup'
-            ]
-        },
-        3: {
-            'label': 'Outreach Record Type',
-            'width': 30,
-            'style': 'text_style',
-            'dropdown': [
-                'Record Data',
-                'Opt-Out',
-                'Outreach Engagement',
-                'Custom Fields'
-            ]
-        },
+    8: {
+        'label': 'Look For Name Instead Of record ID',
+        'width': 30,
+        'style': 'text_style'
+    },
 
-        4: {
-            'label': 'Internal Empty Placeholder',
-            'width': 30,
-            'style': 'text_style'
-        },
+    9: {
+        'label': 'Display Name Instead Of record ID',
+        'width': 30,
+        'style': 'text_style'
+    },
 
-        5: {
-            'label': 'External Mapped Type',
-            'width': 30,
-            'style': 'text_style'
-        },
+    10: {
+        'label': 'Updates In (SFDC > OR)',
+        'width': 35,
+        'style': 'color_checkboxes',
+        'note': 'Updates In = Sync data from Salesforce to Outreach. When the box is unchecked, the field can be synced from Salesforce. When the box is checked, the field is selected to be synced from Salesforce. When there is no checkbox, the field only syncs to Salesforce.'
+    },
 
-        6: {
-            'label': 'External Empty Placeholder',
-            'width': 30,
-            'style': 'text_style'
-        },
+    11: {
+        'label': 'Updates Out (OR > SFDC)',
+        'width': 35,
+        'style': 'color_checkboxes',
+        'note': 'Updates Out = Push data from Outreach to Salesforce. When the box is unchecked, the field can be synced to Salesforce. When the box is checked, the field is selected to be synced to Salesforce. When there is no checkbox, the field only syncs from Salesforce.'
+    },
 
-        7: {
-            'label': 'Mapped Field',
-            'width': 30,
-            'style': 'text_style'
-        },
+    12: {
+        'label': 'Notes',
+        'width': 30,
+        'style': 'text_style'
+    }
+}
+# Style for the Index sheet
+col_dict_index = {
+    0: {
+        'label': 'External Type',
+        'width': 30,
+        'style': 'text_style'
+    },
+    1: {
+        'label': 'Internal Type',
+        'width': 30,
+        'style': 'text_style'
+    },
+    2: {
+        'label': 'Sheet',
+        'width': 35,
+        'style': 'url_style'
+    },
+    3: {
+        'label': 'Field Mappings Sheet',
+        'width': 35,
+        'style': 'url_style'
+    },
+    4: {
+        'label': 'Field Mappings',
+        'width': 15,
+        'style': 'int_style'
+    },
+    5: {
+        'label': 'Inbound Enabled Fields',
+        'width': 15,
+        'style': 'int_style'
+    },
+    6: {
+        'label': 'Outbound Enabled Fields',
+        'width': 15,
+        'style': 'int_style'
+    },
+    7: {
+        'label': 'Condition Blocks',
+        'width': 15,
+        'style': 'int_style'
+    },
+    8: {
+        'label': 'Polling Frequency (min)',
+        'width': 15,
+        'style': 'int_style'
+    },
+}
 
-        8: {
-            'label': 'Look For Name Instead Of record ID',
-            'width': 30,
-            'style': 'text_style'
-        },
+# Sheets written ahead of the plugin type sheets, in workbook order
+index_sheet_name = "Index"
+budget_sheet_name = "API Budget"
+findings_sheet_name = "Findings"
+static_sheet_names = (index_sheet_name, crm_requirements_sheet_name, "Limits", budget_sheet_name,
+                      findings_sheet_name)
+
+# To describe the CRM Requirements sheet of a provider, for
+# XLSXWorkbook.add_static_sheet
+
+
+def crm_requirements_sheet(provider):
+    provider = crm_requirement_providers.get(provider, provider)
+    blocks = crm_requirement_blocks.get(provider)
+    if blocks is None:
+        name = provider.capitalize()
+        blocks = [(heading.format(provider=name), [line.format(provider=name) for line in lines])
+                  for heading, lines in crm_requirement_blocks["generic"]]
+    rows = []
+    for i, (heading, lines) in enumerate(blocks):
+        if i > 0:
+            rows.append(((plain_text['style'], ''),))
+        rows.append(((header_text['style'], heading),))
+        rows.extend(((plain_text['style'], line),) for line in lines)
+    return xlsxwritertools.StaticSheet(crm_requirements_sheet_name, (plain_text['width'],), tuple(rows))
+
+# To record a row for a sheet instead of writing it straight into the workbook.
+# Mirrors wb.add_single_row so row building reads the same as row writing.
+
+
+def add_row(rows, row, col_dict, data):
+    rows.append((row, col_dict, tuple(data)))
+    row += 1
+    return row
 
-        9: {
-            'label': 'Display Name Instead Of record ID',
-            'width': 30,
-            'style': 'text_style'
-        },
+# A TypeSheetBatch holds everything needed to render one plugin type: the rows
+# of the (ExternalType, InternalType) sheet and the rows of its Field Mappings
+# companion. Batches are built independently of each other and of the
+# workbook, so they can be produced in a thread/process pool and handed to a
+# single writer.
 
-        10: {
-            'label': 'Updates In (SFDC > OR)',
-            'width': 35,
-            'style': 'color_checkboxes',
-            'note': 'Updates In = Sync data from Salesforce to Outreach. When the box is unchecked, the field can be synced from Salesforce. When the box is checked, the field is selected to be synced from Salesforce. When there is no checkbox, the field only syncs to Salesforce.'
-        },
 
-        11: {
-            'label': 'Updates Out (OR > SFDC)',
-            'width': 35,
-            'style': 'color_checkboxes',
-            'note': 'Updates Out = Push data from Outreach to Salesforce. When the box is unchecked, the field can be synced to Salesforce. When the box is checked, the field is selected to be synced to Salesforce. When there is no checkbox, the field only syncs from Salesforce.'
-        },
+class TypeSheetBatch(NamedTuple):
+    typename: tuple
+    type_rows: tuple
+    field_mapping_rows: tuple
+
+
+# To build the rows of a plugin type sheet (labels, conditions and task mappings)
 
-        12: {
-            'label': 'Notes',
-            'width': 30,
-            'style': 'text_style'
-        }
-    }
 
-    plugin_data = read_plugin_json()
-    limits, type_names, types = get_mappings_dict(plugin_data)
-    update_provider_in_label_mapping(limits)
+def build_type_sheet_rows(attrdict, lm):
+    rows = []
+    row = 1
+    taskmappings = {}
+    for key, value in attrdict.items():
+        if key == 'FieldMappings':
+            continue
+        if 'Conditions' in key and len(value) != 0:
+            row = add_row(
+                rows, row, col_dict_level_0, (update_label(key, lm), ':'))
+            row = write_conditions(value, lm, row, rows)
+        elif isinstance(value, dict) and len(value) == 0:
+            row = add_row(
+                rows, row, col_dict_level_0, (update_label(key, lm), '-'))
+        elif isinstance(value, dict) and len(value) > 0:
+            taskmappings = {key: value}
+        elif type(value) is bool and value is True:
+            row = add_row(
+                rows, row, col_dict_level_0, (update_label(key, lm), unicode_symbols["tick"]))
+        elif type(value) is bool and value is False:
+            row = add_row(
+                rows, row, col_dict_level_0, (update_label(key, lm), unicode_symbols["cross"]))
+        else:
+            row = add_row(
+                rows, row, col_dict_level_0, (update_label(key, lm), value))
+
+    if len(taskmappings) > 0:
+        res = list(taskmappings.keys())[0]
+        row = add_row(
+            rows, row, col_dict_level_0, (update_label(res, lm), ':'))
+        for item in taskmappings[res]:
+            value = taskmappings[res][item]
+            if type(value) is bool and value is True:
+                row = add_row(
+                    rows, row, col_dict_task_mapping, (update_label(item, lm),  unicode_symbols["tick"]))
+            elif type(value) is bool and value is False:
+                row = add_row(
+                    rows, row, col_dict_task_mapping, (update_label(item, lm),  unicode_symbols["cross"]))
+            else:
+                row = add_row(
+                    rows, row, col_dict_task_mapping, (update_label(item, lm), value))
+    return tuple(rows)
+
+# One row of a Field Mappings sheet, in col_field_mapping1 column order
+
+
+class FieldMappingSheetRow(NamedTuple):
+    outreach_field_name: str
+    sf_field_name: str
+    field_type: str
+    record_type: str
+    internal_default: str
+    external_mapped_type: str
+    external_default: str
+    mapped_field: str
+    look_for_name: str
+    display_name: str
+    updates_in: str
+    updates_out: str
+    notes: str
+
+
+def tick_if(value):
+    return unicode_symbols["tick"] if value else ''
+
+# To build the rows of a Field Mappings sheet, enriched with the preset data
+
+
+def build_field_mapping_rows(typename, field_mappings):
+    temp_preset = types_mapping_to_preset_data.get(typename[0], {})
+    rows = []
+    for fm in field_mappings:
+        name = fm.display_internal_field
+        preset = temp_preset.get(name, {})
+        rows.append(FieldMappingSheetRow(
+            outreach_field_name=name,
+            sf_field_name=fm.external_field,
+            field_type=preset.get("FieldType", ''),
+            record_type=preset.get("RecordType", ''),
+            internal_default=fm.internal_default,
+            external_mapped_type=fm.external_mapped_type,
+            external_default=fm.external_default,
+            mapped_field=tick_if(fm.mapped_field),
+            look_for_name=tick_if(fm.look_for_name_instead_of_id),
+            display_name=tick_if(fm.display_name_instead_of_id),
+            updates_in=tick_if(fm.inbound_enabled),
+            updates_out=tick_if(fm.outbound_enabled),
+            notes=preset.get("Note", ''),
+        ))
+    return tuple(rows)
+
+# To build the rows of both sheets of a plugin type. The label mapping is passed
+# in (rather than read from the module global) so that process pool workers get
+# the provider-specific labels too.
+
+
+def build_type_batch(typename, attrdict, field_mappings, label_mapping):
+    lm = label_mapping.copy()
+    lm = update_external_internal_in_label_mapping(typename, lm)
+    type_rows = build_type_sheet_rows(attrdict, lm)
+    field_mapping_rows = build_field_mapping_rows(typename, field_mappings)
+    return TypeSheetBatch(typename, type_rows, field_mapping_rows)
+
+
+def build_type_batch_in_pool(typename, attrdict, field_mappings, label_mapping):
+    """
+    build_type_batch for a process pool worker, which also returns the
+    ConditionCacheStats of the lookups it made.
+    """
+    before = condition_cache_info()
+    batch = build_type_batch(typename, attrdict, field_mappings, label_mapping)
+    return batch, condition_cache_stats_since(before)
+
+# To build the batches of every plugin type in a pool. Yields the batches in
+# type_names order, as soon as each one (and all the ones before it) is ready,
+# so the writer can start on the first sheets while the rest are being built.
+
+
+def build_type_batches(type_names, config, label_mapping, workers=None, use_processes=False):
+    global _pool_condition_cache_stats
+    if workers == 1:
+        for typename in type_names:
+            plugin_type = config.types[typename]
+            yield build_type_batch(typename, plugin_type.settings,
+                                   plugin_type.field_mappings, label_mapping)
+        return
+    if use_processes:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(build_type_batch_in_pool, typename,
+                                       config.types[typename].settings,
+                                       config.types[typename].field_mappings, label_mapping)
+                       for typename in type_names]
+            for future in futures:
+                batch, cache_stats = future.result()
+                _pool_condition_cache_stats = total_condition_cache_stats(
+                    [_pool_condition_cache_stats, cache_stats])
+                yield batch
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(build_type_batch, typename, config.types[typename].settings,
+                                   config.types[typename].field_mappings, label_mapping)
+                   for typename in type_names]
+        for future in futures:
+            yield future.result()
+
+# To fingerprint the settings of a plugin type, so a type that didn't change
+# can reuse its batch
+
+
+def type_fingerprint(ptype):
+    canonical = json.dumps(ptype, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+class BatchCache():
+    def __init__(self):
+        """
+        Keeps the batch of every plugin type between conversions of the same
+        export (see --watch), so only the types whose settings changed have
+        their rows built again.
+        """
+        self.batches = {}
+        self.rebuilt = []
+
+    def get_batches(self, type_names, config, label_mapping, workers=None, use_processes=False):
+        """
+        Returns the batches of every type, in type_names order, building the
+        ones that are new or changed. The names of those are left in rebuilt.
+        config: the PluginConfig of the export
+        """
+        provider_labels = type_fingerprint(label_mapping)
+        fingerprints = {typename: (type_fingerprint((config.types[typename].settings,
+                                                     config.types[typename].field_mappings)),
+                                   provider_labels)
+                        for typename in type_names}
+        stale = [typename for typename in type_names
+                 if self.batches.get(typename, (None,))[0] != fingerprints[typename]]
+        for batch in build_type_batches(stale, config, label_mapping, workers, use_processes):
+            self.batches[batch.typename] = (fingerprints[batch.typename], batch)
+        self.batches = {typename: self.batches[typename] for typename in type_names}
+        self.rebuilt = stale
+        return [self.batches[typename][1] for typename in type_names]
+
+# To work out the names of every sheet of a config in one go, before any
+# rendering work is done. Returns {typename: (sheet name, field mappings sheet name)}
+
+
+def plan_type_sheet_names(type_names):
+    wanted = []
+    for typename in type_names:
+        wanted.append(typename[0]+'-'+typename[1])
+        # external_name = (typename[1])[:31]
+        wanted.append(typename[0][0] + "-" +
+                      typename[1][0:13] + " Field Mappings")
+    planned = xlsxwritertools.plan_sheet_names(
+        wanted, reserved=static_sheet_names)
+    return {typename: (planned[2 * i], planned[2 * i + 1])
+            for i, typename in enumerate(type_names)}
+
+# To list every plugin type with links to its sheets and its summary stats
+
+
+def build_index_rows(config, sheet_names):
+    rows = []
+    for typename in config.type_names:
+        sheet_name, fm_sheet_name = sheet_names[typename]
+        stats = config.types[typename].stats
+        if stats.polling_enabled:
+            polling_interval = stats.polling_interval
+        else:
+            polling_interval = unicode_symbols["cross"]
+        rows.append((typename[0], typename[1],
+                     xlsxwritertools.internal_link(sheet_name),
+                     xlsxwritertools.internal_link(fm_sheet_name),
+                     stats.field_mappings,
+                     stats.inbound_fields,
+                     stats.outbound_fields,
+                     stats.condition_blocks,
+                     polling_interval))
+    return rows
+
+# To write a batch into the workbook. Only ever called from one thread.
+
+
+def render_type_batch(wb, batch, sheet_names):
+    sheet_name, fm_sheet_name = sheet_names
+    sheet = wb.get_new_worksheet(sheet_name)
+    wb.add_headers(sheet, col_dict_level_0, 2)
+    for row, col_dict, data in batch.type_rows:
+        target, target_row = wb.sheet_for_row(sheet, row, col_dict_level_0, 2)
+        wb.add_single_row(target, target_row, col_dict, data)
+
+    sheet = wb.get_new_worksheet(fm_sheet_name)
+    wb.fill_sheet(sheet, col_field_mapping1, batch.field_mapping_rows)
+
+
+def convert_plugin_config(input_fname, spreadsheet_filename, workers=None, use_processes=False, cache_dir=None,
+                          deterministic=False, lint=False, batch_cache=None, profile='default'):
+    """
+    Converts a plugin configuration JSON export into a spreadsheet.
+    deterministic: write a byte-identical file for identical input. The
+        columns are then autofit before the workbook is saved rather than by
+        loading and saving it again with openpyxl.
+    profile: the output profile, 'default', 'fast' or 'compact' (see
+        xlsxwritertools.OUTPUT_PROFILES). The fast and compact profiles also
+        autofit before saving, since saving again with openpyxl would undo
+        their compression setting.
+    lint: add a Findings sheet with the results of plugin_linter
+    batch_cache: a BatchCache to take the batches of unchanged types from
+    Returns the hex sha256 of the spreadsheet.
+    """
+    config = load_plugin_model(input_fname, cache_dir)
+    if lint:
+        findings = lint_plugin_config(*config.as_mappings())
+    budget = estimate_api_calls({input_fname: config.as_mappings()})
+    update_provider_in_label_mapping(config.limits)
+    sheet_names = plan_type_sheet_names(config.type_names)
     # Create the workbook
+    wb = xlsxwritertools.XLSXWorkbook(spreadsheet_filename, deterministic, profile)
+    wb.reserve_sheet_names(static_sheet_names)
+    wb.reserve_sheet_names(name for names in sheet_names.values() for name in names)
 
-    spreadsheet_filename = 'sage_plugin_configuration.xlsx'
-    wb = xlsxwritertools.XLSXWorkbook(spreadsheet_filename)
+    # Index sheet
+    sheet = wb.get_new_worksheet(index_sheet_name)
+    wb.fill_sheet(sheet, col_dict_index, build_index_rows(config, sheet_names))
 
     # Create CRM Requirements Sheet
-    sheet = wb.get_new_worksheet("CRM Requirements")
-    i = 0
-    for line in crmrequirements:
-        if i in (0, 8, 17):
-            wb.add_single_row_new_way(sheet, i, 0, header_text, line)
-        else:
-            wb.add_single_row_new_way(sheet, i, 0, plain_text, line)
-        i += 1
+    wb.add_static_sheet(crm_requirements_sheet(config.provider.lower()))
 
     # Limit sheet
     sheet = wb.get_new_worksheet("Limits")
-    update_labels_in_dictdata(limits, label_mapping)
-    list1 = list(limits.items())
-    wb.fill_sheet(sheet, col_dict_level_0, list1)
+    wb.fill_sheet(sheet, col_dict_level_0, relabelled_items(config.limits, label_mapping))
+
+    # API call budget sheet
+    write_budget_sheet(wb, budget, budget_sheet_name)
+
+    # Findings sheet
+    if lint:
+        sheet_links = {'-'.join(typename): names[0]
+                       for typename, names in sheet_names.items()}
+        write_findings_sheet(wb, findings, findings_sheet_name, sheet_links)
 
     # Create Parsed Sheets from Plugin Info
-    for typename in type_names:
-        row = 0
-        lm = label_mapping.copy()
-        lm = update_external_internal_in_label_mapping(typename, lm)
-        sheet_name = (typename[0]+'-'+typename[1])[:31]
-        sheet = wb.get_new_worksheet(sheet_name)
-        attrdict = types[typename]['input']
-        fieldmappingslist = attrdict['FieldMappings']
-        attrdict.pop('FieldMappings')
-        wb.add_headers(sheet, col_dict_level_0, 2)
-        row = row + 1
-        taskmappings = {}
-        for key, value in attrdict.items():
-            if 'Conditions' in key and len(value) != 0:
-                row = wb.add_single_row(
-                    sheet, row, col_dict_level_0, (update_label(key, lm), ':'))
-                row = write_conditions(value, lm, row)
-            elif type(value) is dict and len(value) == 0:
-                row = wb.add_single_row(
-                    sheet, row, col_dict_level_0, (update_label(key, lm), '-'))
-            elif type(value) is dict and len(value) > 0:
-                taskmappings = {key: value}
-            elif type(value) is bool and value is True:
-                row = wb.add_single_row(
-                    sheet, row, col_dict_level_0, (update_label(key, lm), unicode_symbols["tick"]))
-            elif type(value) is bool and value is False:
-                row = wb.add_single_row(
-                    sheet, row, col_dict_level_0, (update_label(key, lm), unicode_symbols["cross"]))
-            else:
-                row = wb.add_single_row(
-                    sheet, row, col_dict_level_0, (update_label(key, lm), value))
-
-        if len(taskmappings) > 0:
-            res = list(taskmappings.keys())[0]
-            row = wb.add_single_row(
-                sheet, row, col_dict_level_0, (update_label(res, lm), ':'))
-            for item in taskmappings[res]:
-                value = taskmappings[res][item]
-                if type(value) is bool and value is True:
-                    row = wb.add_single_row(
-                        sheet, row, col_dict_task_mapping, (update_label(item, lm),  unicode_symbols["tick"]))
-                elif type(value) is bool and value is False:
-                    row = wb.add_single_row(
-                        sheet, row, col_dict_task_mapping, (update_label(item, lm),  unicode_symbols["cross"]))
-                else:
-                    row = wb.add_single_row(
-                        sheet, row, col_dict_task_mapping, (update_label(item, lm), value))
+    if batch_cache is None:
+        batches = build_type_batches(config.type_names, config, label_mapping, workers, use_processes)
+    else:
+        batches = batch_cache.get_batches(config.type_names, config, label_mapping, workers, use_processes)
+    for batch in batches:
+        render_type_batch(wb, batch, sheet_names[batch.typename])
 
-        # external_name = (typename[1])[:31]
-        fm_sheet_name = typename[0][0] + "-" + \
-            typename[1][0:13] + " Field Mappings"
-        sheet = wb.get_new_worksheet(fm_sheet_name)
-        df_fm = pd.DataFrame(columns=list(field_mapping.keys()))
-        df_fm = df_fm.append(fieldmappingslist, ignore_index=True)
-        df_fm.fillna('', inplace=True)
-
-        listoffieldmappings = df_fm.values.tolist()
-        filtered_listoffieldmappings_list = []
-
-        for i in listoffieldmappings:
-            temp = []
-            temp.append(i[0])  # Outreach Field Name 0
-            temp.append(i[2])  # SF Field Name 1
-            temp.append('')  # Left for Field Type...TODO: should be dropdown 2
-            # Left for Record Type...TODO: should be dropdown 3
-            temp.append('')
-            # temp.append('') ## Recommended empty or prefilled 4
-            # temp.append('')  ## UI Visibility TODO: pre set values 5
-            if i[10] == True:  # Updates IN 6
-                temp.append(unicode_symbols["tick"])  # UI
-            else:
-                temp.append('')
-            if i[11] == True:  # Updates OUT 7
-                temp.append(unicode_symbols["tick"])  # UI check
-            else:
-                temp.append('')
-            temp.append('')  # NOTES 8
-            temp.append('')  # reserved for popup notes 9
-            temp.append('')  # reserved for
-            temp.append('')
-            temp.append('')
-            temp.append('')
-            temp.append('')
-            filtered_listoffieldmappings_list.append(temp)
-        if typename[0] in types_mapping_to_preset_data.keys():
-            temp_preset = types_mapping_to_preset_data[typename[0]]
-            for i in filtered_listoffieldmappings_list:
-                if i[0] in temp_preset.keys():
-                    index = filtered_listoffieldmappings_list.index(i)
-                    filtered_listoffieldmappings_list[index][2] = temp_preset[i[0]]["FieldType"]
-                    filtered_listoffieldmappings_list[index][3] = temp_preset[i[0]]["RecordType"]
-                    # filtered_listoffieldmappings_list[index][4] = temp_preset[i[0]]["Recommended"]
-                    # filtered_listoffieldmappings_list[index][5] = temp_preset[i[0]]["UI Visibility"]
-                    filtered_listoffieldmappings_list[index][12] = temp_preset[i[0]]["Note"]
-
-        wb.fill_sheet(sheet, col_field_mapping1,
-                      filtered_listoffieldmappings_list)
+    if deterministic or profile != 'default':
+        wb.autofit_columns()
+        return wb.close_workbook()
 
     wb.close_workbook()
 
     autofit_spreadsheet_columns(spreadsheet_filename)
+    return file_sha256(spreadsheet_filename)
+
+
+def _file_stamp(fname):
+    try:
+        stat = os.stat(fname)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def watch_plugin_config(input_fname, spreadsheet_filename, workers=None, use_processes=False,
+                        cache_dir=None, lint=False, poll_interval=0.2):
+    """
+    Converts an export, then converts it again every time the file changes,
+    until interrupted. The file is polled (there is no portable file change
+    notification in the standard library), and a change is picked up once the
+    file has stopped changing for one poll interval, so a half-saved export
+    isn't read. Only the plugin types whose settings changed have their rows
+    built again; the rest come from a BatchCache. The workbook is always
+    written afresh, with the columns autofit before it is saved.
+    Prints which types were rebuilt and how long each rebuild took.
+    """
+    batch_cache = BatchCache()
+    last_stamp = None
+    last_hash = None
+    print('Watching {} (Ctrl-C to stop)'.format(input_fname))
+    try:
+        while True:
+            stamp = _file_stamp(input_fname)
+            if stamp is None or stamp == last_stamp:
+                time.sleep(poll_interval)
+                continue
+            time.sleep(poll_interval)
+            if _file_stamp(input_fname) != stamp:
+                continue
+            last_stamp = stamp
+            start = time.perf_counter()
+            try:
+                content_hash = convert_plugin_config(
+                    input_fname, spreadsheet_filename, workers, use_processes, cache_dir,
+                    deterministic=True, lint=lint, batch_cache=batch_cache)
+            except (ValueError, KeyError, TypeError) as e:
+                # Most likely an export that is being edited; wait for the next save
+                print('{} could not be converted: {!r}'.format(input_fname, e))
+                continue
+            elapsed = time.perf_counter() - start
+            rebuilt = ', '.join('-'.join(typename) for typename in batch_cache.rebuilt)
+            print('{} rebuilt {} of {} types{} in {:.0f} ms{}'.format(
+                time.strftime('%H:%M:%S'), len(batch_cache.rebuilt), len(batch_cache.batches),
+                ' ({})'.format(rebuilt) if rebuilt else '', elapsed * 1000,
+                '' if content_hash != last_hash else ', output unchanged'))
+            last_hash = content_hash
+    except KeyboardInterrupt:
+        print('Stopped watching {}'.format(input_fname))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Convert a plugin configuration JSON export into a spreadsheet')
+    parser.add_argument('--input',
+                        type=str,
+                        help='path to the plugin configuration JSON file',
+                        default='sage_plugin_configuration.json',
+                        dest='input')
+    parser.add_argument('--output',
+                        type=str,
+                        help='name of the spreadsheet output file (defaults to the input name with .xlsx)',
+                        required=False,
+                        dest='output')
+    parser.add_argument('--workers',
+                        type=int,
+                        help='number of workers building the sheet rows (1 builds them serially)',
+                        required=False,
+                        dest='workers')
+    parser.add_argument('--processes',
+                        action='store_true',
+                        help='build the sheet rows in a process pool instead of a thread pool',
+                        dest='processes')
+    parser.add_argument('--cache-dir',
+                        type=str,
+                        help='directory of compiled plugin caches to load the input from (see plugin_cache.py)',
+                        required=False,
+                        dest='cache_dir')
+    parser.add_argument('--lint',
+                        action='store_true',
+                        help='add a Findings sheet listing likely configuration mistakes (see plugin_linter.py)',
+                        dest='lint')
+    parser.add_argument('--deterministic',
+                        action='store_true',
+                        help='write a byte-identical spreadsheet for identical input',
+                        dest='deterministic')
+    parser.add_argument('--profile',
+                        choices=sorted(xlsxwritertools.OUTPUT_PROFILES),
+                        help='zip compression of the spreadsheet: fast (stored, for intermediate files), '
+                             'compact (maximum compression) or default',
+                        default='default',
+                        dest='profile')
+    parser.add_argument('--watch',
+                        action='store_true',
+                        help='convert the input again whenever it changes, rebuilding only the changed types',
+                        dest='watch')
+    args = parser.parse_args()
+    if not args.output:
+        args.output = os.path.splitext(args.input)[0] + '.xlsx'
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.watch:
+        watch_plugin_config(args.input, args.output, args.workers, args.processes,
+                            args.cache_dir, args.lint)
+        raise SystemExit()
+    content_hash = convert_plugin_config(args.input, args.output, args.workers,
+                                         args.processes, args.cache_dir, args.deterministic,
+                                         args.lint, profile=args.profile)
+    print('{} sha256 {}'.format(args.output, content_hash))
+    print(format_condition_cache_stats(condition_cache_info()))
@@ -0,0 +1,231 @@
+"""
+Estimates the daily API calls a plugin configuration makes against the CRM and
+compares them with the plugin's GlobalAPICallThreshold and
+OutreachSpecificAPICallThreshold.
+The estimate for each plugin type comes from its settings:
+    polling calls        PollingEnabled: one query per poll, every
+                         PollingIntervalMinutes
+    merge & delete calls MergeAndDeletePollingEnabled: a deleted and a merged
+                         records query every MergeAndDeletePollingFrequencyMinutes
+    inbound page calls   InboundCreateEnabled/InboundUpdateEnabled: one more
+                         query per QUERY_PAGE_SIZE records changed in the CRM
+    outbound calls       OutboundCreateEnabled/OutboundUpdateEnabled: one call
+                         per record changed in Outreach
+The change volumes aren't in the export, so they are parameters that default to
+0, which makes the estimate a floor set by the polling settings alone.
+All of the types of all of the tenants go into a single DataFrame and the
+estimate is computed column-wise, so a few hundred tenants cost about as much
+as one.
+Usage:
+    python api_budget.py exports/*_plugin_configuration.json --outbound-changes-per-day 2000
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from plugin_records import read_plugin_json, get_mappings_dict, tenant_name
+from plugin_cache import load_plugin_config
+
+MINUTES_PER_DAY = 24 * 60
+CALLS_PER_POLL = 1
+CALLS_PER_MERGE_DELETE_POLL = 2
+CALLS_PER_OUTBOUND_CHANGE = 1
+QUERY_PAGE_SIZE = 2000
+
+type_setting_columns = {
+    'PollingEnabled': 'polling_enabled',
+    'PollingIntervalMinutes': 'polling_interval',
+    'MergeAndDeletePollingEnabled': 'merge_delete_enabled',
+    'MergeAndDeletePollingFrequencyMinutes': 'merge_delete_interval',
+    'InboundCreateEnabled': 'inbound_create',
+    'InboundUpdateEnabled': 'inbound_update',
+    'OutboundCreateEnabled': 'outbound_create',
+    'OutboundUpdateEnabled': 'outbound_update',
+}
+
+
+def build_type_frame(tenants):
+    """
+    Collects the settings of every plugin type of every tenant.
+    tenants: dictionary of tenant -> (limits, type_names, types), i.e. what
+        get_mappings_dict returns for each tenant's export
+    Returns a DataFrame with one row per tenant and plugin type.
+    """
+    records = []
+    for tenant, (limits, type_names, types) in tenants.items():
+        for typename in type_names:
+            ptype = types[typename]['input']
+            record = {'tenant': tenant,
+                      'external_type': typename[0],
+                      'internal_type': typename[1],
+                      'global_threshold': limits.get('GlobalAPICallThreshold'),
+                      'outreach_threshold': limits.get('OutreachSpecificAPICallThreshold')}
+            for key, column in type_setting_columns.items():
+                record[column] = ptype.get(key)
+            records.append(record)
+    columns = ['tenant', 'external_type', 'internal_type', 'global_threshold',
+               'outreach_threshold'] + list(type_setting_columns.values())
+    return pd.DataFrame.from_records(records, columns=columns)
+
+
+def _flag(frame, column):
+    return frame[column].fillna(False).astype(bool)
+
+
+def _per_day(frame, column):
+    # Runs per day of a setting given in minutes; missing or nonsense
+    # intervals count as once a day.
+    minutes = pd.to_numeric(frame[column], errors='coerce')
+    minutes = minutes.where(minutes >= 1, MINUTES_PER_DAY).fillna(MINUTES_PER_DAY)
+    return MINUTES_PER_DAY / minutes
+
+
+def estimate_api_calls(tenants, inbound_changes_per_day=0, outbound_changes_per_day=0):
+    """
+    Estimates the daily API calls of every plugin type of every tenant.
+    tenants: dictionary of tenant -> (limits, type_names, types)
+    inbound_changes_per_day: records changed in the CRM per type and day
+    outbound_changes_per_day: records changed in Outreach per type and day
+    Returns the DataFrame of build_type_frame with the estimated calls and
+    the share of each threshold they use (NaN where a threshold isn't set).
+    """
+    frame = build_type_frame(tenants)
+    inbound = _flag(frame, 'inbound_create') | _flag(frame, 'inbound_update')
+    outbound = _flag(frame, 'outbound_create') | _flag(frame, 'outbound_update')
+    polling = _flag(frame, 'polling_enabled')
+    frame['polls_per_day'] = np.where(polling, _per_day(frame, 'polling_interval'), 0.0)
+    frame['polling_calls'] = frame['polls_per_day'] * CALLS_PER_POLL
+    frame['merge_delete_calls'] = np.where(
+        _flag(frame, 'merge_delete_enabled'),
+        _per_day(frame, 'merge_delete_interval') * CALLS_PER_MERGE_DELETE_POLL, 0.0)
+    frame['inbound_page_calls'] = np.where(
+        inbound & polling, np.ceil(inbound_changes_per_day / QUERY_PAGE_SIZE), 0.0)
+    frame['outbound_calls'] = np.where(
+        outbound, outbound_changes_per_day * CALLS_PER_OUTBOUND_CHANGE, 0.0)
+    frame['total_calls'] = frame[['polling_calls', 'merge_delete_calls',
+                                  'inbound_page_calls', 'outbound_calls']].sum(axis=1)
+    for threshold in ('global_threshold', 'outreach_threshold'):
+        limit = pd.to_numeric(frame[threshold], errors='coerce')
+        frame[threshold.replace('threshold', 'share')] = frame['total_calls'] / limit.where(limit > 0)
+    return frame
+
+
+def summarize_tenants(estimates):
+    """
+    Adds up the estimate of each tenant.
+    estimates: the DataFrame returned by estimate_api_calls
+    Returns a DataFrame with one row per tenant: the calls by kind, the
+    thresholds, the share of each threshold used and whether the estimate
+    exceeds a threshold.
+    """
+    call_columns = ['polling_calls', 'merge_delete_calls', 'inbound_page_calls',
+                    'outbound_calls', 'total_calls']
+    grouped = estimates.groupby('tenant', sort=False)
+    summary = grouped[call_columns].sum()
+    for threshold in ('global_threshold', 'outreach_threshold'):
+        limit = pd.to_numeric(grouped[threshold].first(), errors='coerce')
+        summary[threshold] = limit
+        summary[threshold.replace('threshold', 'share')] = summary['total_calls'] / limit.where(limit > 0)
+    summary['over_threshold'] = ((summary['global_share'] > 1) |
+                                 (summary['outreach_share'] > 1))
+    return summary.reset_index()
+
+
+col_dict_budget = {0: {"label": "External Type", "width": 22, "style": "text_style"},
+                   1: {"label": "Internal Type", "width": 22, "style": "text_style"},
+                   2: {"label": "Polls / Day", "width": 12, "style": "int_style"},
+                   3: {"label": "Polling Calls", "width": 14, "style": "int_style"},
+                   4: {"label": "Merge & Delete Calls", "width": 16, "style": "int_style"},
+                   5: {"label": "Inbound Page Calls", "width": 16, "style": "int_style"},
+                   6: {"label": "Outbound Calls", "width": 14, "style": "int_style"},
+                   7: {"label": "Total Calls / Day", "width": 16, "style": "int_style"},
+                   8: {"label": "% of Global Threshold", "width": 16, "style": "pct_style"},
+                   9: {"label": "% of Outreach Threshold", "width": 16, "style": "pct_style"},
+                   }
+budget_frame_columns = ['external_type', 'internal_type', 'polls_per_day', 'polling_calls',
+                        'merge_delete_calls', 'inbound_page_calls', 'outbound_calls',
+                        'total_calls', 'global_share', 'outreach_share']
+
+
+def _cell_values(values):
+    # xlsxwriter can't write NaN, so missing shares are left blank
+    return ['' if isinstance(value, float) and np.isnan(value) else value
+            for value in values]
+
+
+def write_budget_sheet(wb, estimates, sheet_name='API Budget'):
+    """
+    Adds a sheet with the estimate of each plugin type of one tenant and a
+    total row.
+    wb: an XLSXWorkbook
+    estimates: the rows of estimate_api_calls for one tenant
+    """
+    sheet = wb.get_new_worksheet(sheet_name)
+    rows = [_cell_values(values)
+            for values in estimates[budget_frame_columns].itertuples(index=False)]
+    row = wb.fill_sheet(sheet, col_dict_budget, rows)
+    if len(estimates):
+        summary = summarize_tenants(estimates).iloc[0]
+        total = ['Total', ''] + _cell_values(
+            [estimates['polls_per_day'].sum()] +
+            [summary[column] for column in budget_frame_columns[3:]])
+        total_col_dict = {col: dict(metadata, style=metadata['style'].replace('_style', '_tot_style'))
+                          for col, metadata in col_dict_budget.items()}
+        total_col_dict[0]['style'] = total_col_dict[1]['style'] = 'text_tot_style'
+        total_sheet, row = wb.sheet_for_row(sheet, row, col_dict_budget)
+        wb.add_single_row(total_sheet, row, total_col_dict, total)
+    return sheet
+
+
+def load_tenants(fnames, cache_dir=None):
+    tenants = {}
+    for fname in fnames:
+        if cache_dir:
+            tenants[tenant_name(fname)] = load_plugin_config(fname, cache_dir)
+        else:
+            tenants[tenant_name(fname)] = get_mappings_dict(read_plugin_json(fname))
+    return tenants
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Estimate the daily API calls of plugin configurations against their thresholds')
+    parser.add_argument('inputs',
+                        nargs='+',
+                        help='plugin configuration JSON files, one per tenant')
+    parser.add_argument('--inbound-changes-per-day',
+                        type=int,
+                        help='records changed in the CRM per type and day (default 0)',
+                        default=0,
+                        dest='inbound_changes_per_day')
+    parser.add_argument('--outbound-changes-per-day',
+                        type=int,
+                        help='records changed in Outreach per type and day (default 0)',
+                        default=0,
+                        dest='outbound_changes_per_day')
+    parser.add_argument('--csv',
+                        type=str,
+                        help='write the per-type estimates of all tenants to this CSV file',
+                        required=False,
+                        dest='csv')
+    parser.add_argument('--cache-dir',
+                        type=str,
+                        help='directory of compiled plugin caches to load the inputs from (see plugin_cache.py)',
+                        required=False,
+                        dest='cache_dir')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    tenants = load_tenants(args.inputs, args.cache_dir)
+    estimates = estimate_api_calls(tenants, args.inbound_changes_per_day,
+                                   args.outbound_changes_per_day)
+    if args.csv:
+        estimates.to_csv(args.csv, index=False)
+    summary = summarize_tenants(estimates)
+    with pd.option_context('display.width', 200, 'display.max_columns', 20):
+        print(summary[['tenant', 'total_calls', 'global_threshold', 'global_share',
+                       'outreach_threshold', 'outreach_share', 'over_threshold']])
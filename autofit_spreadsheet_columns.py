@@ -2,25 +2,184 @@
 2022-11-15 NOJ:
 A helper function using openpyxl to autofit all columns in a given spreadsheet.
 The helper accepts a filename, iterates through each column in each worksheet to determine the length of the longest cell in the column, and sets the column with based off that length.
+autofit_xlsxwriter_worksheet does the same for a worksheet that xlsxwriter is
+still writing, so the widths can be set without loading and saving the file
+again afterwards.
+Widths come from the Helvetica and Helvetica-Bold glyph widths (the fonts of
+the XLSXWorkbook styles, in the AFM units of 1/1000 em) scaled by each cell's
+font size, rather than from the number of characters. Wide symbols such as
+the tick and cross are measured as a full em and other characters outside
+the table as a digit. Every distinct text is measured once per column pass
+and the text widths are cached across columns, sheets and workbooks.
 """
+import functools
+import unicodedata
+
 from openpyxl import load_workbook
 
+# Helvetica and Helvetica-Bold widths of the printable ASCII characters
+# (' ' to '~'), from the standard AFM metrics.
+HELVETICA_WIDTHS = (
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+    1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+    333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+    556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584)
+HELVETICA_BOLD_WIDTHS = (
+    278, 333, 474, 556, 556, 889, 722, 238, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 333, 333, 584, 584, 584, 611,
+    975, 722, 722, 722, 722, 667, 611, 778, 722, 278, 556, 722, 611, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 333, 278, 333, 584, 556,
+    333, 556, 611, 556, 611, 556, 333, 611, 611, 278, 278, 556, 278, 889, 611, 611,
+    611, 611, 389, 556, 333, 611, 556, 778, 556, 556, 500, 389, 280, 389, 584)
+glyph_widths = {
+    False: {chr(32 + i): width for i, width in enumerate(HELVETICA_WIDTHS)},
+    True: {chr(32 + i): width for i, width in enumerate(HELVETICA_BOLD_WIDTHS)},
+}
+EM_WIDTH = 1000
+DIGIT_WIDTH = 556
+DEFAULT_FONT_SIZE = 11
+# Excel column widths are counted in the pixel width of a digit of the
+# default font (Calibri 11: 7 pixels); text is drawn at 96 dpi.
+PIXELS_PER_WIDTH_UNIT = 7
+PIXELS_PER_POINT = 96 / 72
+# Room so the text doesn't touch the border; Excel adds its own cell margin
+# of XLSX_COLUMN_MARGIN_PIXELS to the width on top of this.
+COLUMN_PADDING_PIXELS = 8
+XLSX_COLUMN_MARGIN_PIXELS = 5
+
+
+def _glyph_width(char, table):
+    width = table.get(char)
+    if width is not None:
+        return width
+    if unicodedata.east_asian_width(char) in ('W', 'F'):
+        return EM_WIDTH  # emoji-style symbols: the tick, the cross, ...
+    if unicodedata.combining(char):
+        return 0
+    base = unicodedata.normalize('NFKD', char)[:1]
+    return table.get(base, DIGIT_WIDTH)
+
+
+def measure_text(text, bold=False):
+    """
+    Returns the width of the longest line of text, in 1/1000 em.
+    """
+    table = glyph_widths[bool(bold)]
+    return max(sum(_glyph_width(char, table) for char in line)
+               for line in text.split('\n'))
+
+
+# Texts repeat a lot across sheets and workbooks (field names, symbols,
+# labels); numbers mostly don't, so they are measured without the cache.
+text_width_units = functools.lru_cache(maxsize=65536)(measure_text)
+
+
+def column_width(units, font_size=DEFAULT_FONT_SIZE):
+    """
+    Converts a text width in 1/1000 em at font_size points into an Excel
+    column width.
+    """
+    pixels = units / EM_WIDTH * (font_size or DEFAULT_FONT_SIZE) * PIXELS_PER_POINT
+    return round((pixels + COLUMN_PADDING_PIXELS) / PIXELS_PER_WIDTH_UNIT, 2)
+
+
+def stored_column_width(width):
+    """
+    Returns the width written to the file for a column width, with Excel's
+    cell margin added the way xlsxwriter's set_column adds it, so both
+    autofit functions write the same widths.
+    """
+    pixels = int(width * PIXELS_PER_WIDTH_UNIT + 0.5) + XLSX_COLUMN_MARGIN_PIXELS
+    return int(pixels / PIXELS_PER_WIDTH_UNIT * 256) / 256
+
+
+def display_text(value):
+    """
+    Returns the text a cell value shows, close enough for measuring it.
+    """
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
 
 def autofit_spreadsheet_columns(spreadsheet_filename):
     workbook = load_workbook(filename=spreadsheet_filename)
     for worksheet in workbook:
-        # 2022-11-15 NOJ: Source https://stackoverflow.com/a/39530676
-        for column in worksheet.columns:
-            column_name = column[0].column_letter  # Get the column name
-            max_length = 0
+        for column in worksheet.iter_cols():
+            widths = {}
             for cell in column:
-                try:  # Necessary to avoid error on empty cells
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            # 2022-11-15 NOJ: A scaling factor and fixed padding (both determined empricially) is required to increase cell width because we are using a font that is thinner than monospace.
-            adjusted_width = (max_length + 4) * 1.15
-            worksheet.column_dimensions[column_name].width = adjusted_width
+                if cell.value is None or cell.value == '':
+                    continue
+                font = cell.font
+                key = (cell.value, bool(font.b), font.sz)
+                if key not in widths:
+                    widths[key] = column_width(text_width_units(display_text(cell.value), bool(font.b)),
+                                               font.sz)
+            if widths:
+                worksheet.column_dimensions[column[0].column_letter].width = \
+                    stored_column_width(max(widths.values()))
 
     workbook.save(filename=spreadsheet_filename)
+
+
+def autofit_xlsxwriter_worksheet(worksheet):
+    """
+    Sets the column widths of an xlsxwriter worksheet that hasn't been saved
+    yet, with the same rule as autofit_spreadsheet_columns: every column
+    holding a value gets the width of its widest value.
+    worksheet: an xlsxwriter worksheet (not in constant_memory mode)
+    """
+    table = worksheet.table
+    if not any(table.values()):
+        return
+    # First pass: the distinct values of each column and font, so a value
+    # repeated down a column is measured once. Strings are collected by their
+    # shared string id.
+    groups = {}
+    for cells in table.values():
+        for col_num, cell in cells.items():
+            cell_type = cell.__class__.__name__
+            if cell_type == 'String':
+                value = cell.string
+            elif cell_type == 'Number':
+                value = cell.number
+            elif cell_type == 'RichString':
+                value = cell.raw_string
+            elif cell_type == 'Boolean':
+                value = bool(cell.boolean)
+            else:
+                continue
+            key = (col_num, cell_type, cell.format)
+            values = groups.get(key)
+            if values is None:
+                values = groups[key] = set()
+            values.add(value)
+    # Second pass: measure each group and keep the widest value per column.
+    string_table = worksheet.str_table.string_table
+    strings = sorted(string_table, key=string_table.__getitem__)
+    widths = {}
+    for (col_num, cell_type, cell_format), values in groups.items():
+        bold = bool(cell_format.bold) if cell_format else False
+        font_size = cell_format.font_size if cell_format else DEFAULT_FONT_SIZE
+        if cell_type == 'String':
+            texts = (strings[value] for value in values)
+            measure = text_width_units
+        else:
+            texts = (display_text(value) for value in values)
+            measure = text_width_units if cell_type != 'Number' else measure_text
+        units = max((measure(text, bold) for text in texts if text), default=None)
+        if units is None:
+            continue
+        width = column_width(units, font_size)
+        if width > widths.get(col_num, 0):
+            widths[col_num] = width
+    for col_num in sorted(widths):
+        col_info = worksheet.col_info.get(col_num)
+        cell_format = col_info[1] if col_info else None
+        worksheet.set_column(col_num, col_num, widths[col_num], cell_format)
@@ -0,0 +1,110 @@
+"""
+Benchmark of the column autofit on a large generated sheet.
+Writes rows x columns cells that look like a Field Mappings sheet (field
+names, tick and cross symbols at the checkbox font size, numbers and longer
+notes) into an XLSXWorkbook, then times XLSXWorkbook.autofit_columns, and
+for comparison a character-count pass over the same cells (the old rule).
+With --openpyxl the workbook is also saved and autofit again through
+autofit_spreadsheet_columns, which loads and saves it with openpyxl.
+Usage:
+    python benchmark_autofit.py --rows 100000 --columns 10
+"""
+import argparse
+import io
+import time
+
+import xlsxwritertools
+from autofit_spreadsheet_columns import autofit_spreadsheet_columns, text_width_units
+from TC_plugin_to_xlsx import unicode_symbols
+
+
+def build_workbook(rows, columns, distinct, filename):
+    wb = xlsxwritertools.XLSXWorkbook(filename)
+    sheet = wb.get_new_worksheet('Benchmark')
+    styles = (wb.text_style, wb.color_checkboxes, wb.int_style, wb.color_text_style)
+    symbols = (unicode_symbols['tick'], unicode_symbols['cross'])
+    for col in range(columns):
+        sheet.write(0, col, 'Column {} Header'.format(col), wb.hdr_style)
+    for row in range(1, rows + 1):
+        for col in range(columns):
+            kind = col % 4
+            if kind == 0:
+                value = 'custom_field_{}__c'.format((row * 7 + col) % distinct)
+            elif kind == 1:
+                value = symbols[(row + col) % 2]
+            elif kind == 2:
+                value = (row * 31 + col) % 100000
+            else:
+                value = '{} {} {}'.format('Record Type', unicode_symbols['not equal'],
+                                          (row + col) % distinct)
+            sheet.write(row, col, value, styles[kind])
+    return wb
+
+
+def character_count_pass(worksheet):
+    # The old rule: the number of characters of the longest value
+    string_table = worksheet.str_table.string_table
+    strings = sorted(string_table, key=string_table.__getitem__)
+    max_lengths = {}
+    for cells in worksheet.table.values():
+        for col_num, cell in cells.items():
+            value = strings[cell.string] if hasattr(cell, 'string') else getattr(cell, 'number', None)
+            length = len(str(value))
+            if length > max_lengths.get(col_num, 0):
+                max_lengths[col_num] = length
+    return max_lengths
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Time the column autofit on a generated sheet')
+    parser.add_argument('--rows',
+                        type=int,
+                        default=100000,
+                        dest='rows')
+    parser.add_argument('--columns',
+                        type=int,
+                        default=10,
+                        dest='columns')
+    parser.add_argument('--distinct',
+                        type=int,
+                        help='number of distinct field names and notes (default 5000)',
+                        default=5000,
+                        dest='distinct')
+    parser.add_argument('--openpyxl',
+                        type=str,
+                        help='also save the workbook to this file and autofit it with openpyxl',
+                        required=False,
+                        dest='openpyxl')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    cells = args.rows * args.columns
+    start = time.perf_counter()
+    wb = build_workbook(args.rows, args.columns, args.distinct, args.openpyxl or io.BytesIO())
+    print('wrote {:,} cells in {:.2f} s'.format(cells, time.perf_counter() - start))
+    sheet = wb.workbook.worksheets()[0]
+
+    start = time.perf_counter()
+    character_count_pass(sheet)
+    print('character count:  {:.2f} s'.format(time.perf_counter() - start))
+
+    text_width_units.cache_clear()
+    start = time.perf_counter()
+    wb.autofit_columns()
+    elapsed = time.perf_counter() - start
+    print('glyph widths:     {:.2f} s ({:.2f} us per cell), {}'.format(
+        elapsed, elapsed / cells * 1e6, text_width_units.cache_info()))
+
+    start = time.perf_counter()
+    wb.autofit_columns()
+    print('glyph widths, cached texts: {:.2f} s'.format(time.perf_counter() - start))
+
+    if args.openpyxl:
+        wb.close_workbook()
+        start = time.perf_counter()
+        autofit_spreadsheet_columns(args.openpyxl)
+        print('openpyxl load, autofit and save: {:.2f} s'.format(time.perf_counter() - start))
@@ -0,0 +1,58 @@
+"""
+Benchmark of the output profiles of the converter on the bundled plugin
+configurations: the time convert_plugin_config takes and the size of the
+spreadsheet it writes, for each profile.
+Usage:
+    python benchmark_output_profiles.py --repeat 5
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+import xlsxwritertools
+from TC_plugin_to_xlsx import convert_plugin_config
+
+bundled_configs = ('sage_plugin_configuration.json', 'MC_plugin_configuration.json',
+                   'OR_plugin_configuration.json')
+
+
+def time_profile(input_fname, profile, repeat, output_dir):
+    output_fname = os.path.join(output_dir, '{}.{}.xlsx'.format(
+        os.path.splitext(os.path.basename(input_fname))[0], profile))
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        convert_plugin_config(input_fname, output_fname, workers=1, profile=profile)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), os.path.getsize(output_fname)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Time the converter and measure its output with each output profile')
+    parser.add_argument('inputs',
+                        nargs='*',
+                        help='plugin configuration JSON files (defaults to the bundled ones)')
+    parser.add_argument('--repeat',
+                        type=int,
+                        help='conversions per file and profile; the median time is shown (default 5)',
+                        default=5,
+                        dest='repeat')
+    args = parser.parse_args()
+    if not args.inputs:
+        here = os.path.dirname(os.path.abspath(__file__))
+        args.inputs = [os.path.join(here, fname) for fname in bundled_configs]
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print('{:<36} {:<8} {:>9} {:>10}'.format('input', 'profile', 'time (ms)', 'size (kB)'))
+    with tempfile.TemporaryDirectory() as output_dir:
+        for input_fname in args.inputs:
+            for profile in xlsxwritertools.OUTPUT_PROFILES:
+                elapsed, size = time_profile(input_fname, profile, args.repeat, output_dir)
+                print('{:<36} {:<8} {:>9.0f} {:>10.1f}'.format(
+                    os.path.basename(input_fname), profile, elapsed * 1000, size / 1024))
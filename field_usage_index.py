@@ -0,0 +1,277 @@
+"""
+Inverted index of where fields are used across tenants' plugin exports.
+For every field name, Outreach or CRM, the index lists each use as a
+FieldUsage: the tenant, the plugin type, whether the field is the Outreach or
+the CRM side of a field mapping or appears in a condition, the sync direction
+of the mapping (inbound, outbound, both or off) or the condition block, and
+the field on the other side of the mapping (or the comparison of the
+condition). Names are looked up case-insensitively.
+The index file is laid out so that a lookup reads only what it needs:
+    magic | section lengths | header | directory | tenants | postings
+The header holds the size, mtime and sha256 of every indexed export, the
+directory maps each field name to the offset and length of its postings, and
+the postings of each field are a separate pickle, so a lookup unpickles the
+directory and one small slice. The tenants section keeps every tenant's
+usages, so updating the index re-parses only the exports whose content
+changed (by size and mtime first, then by sha256, as in plugin_cache.py) and
+rebuilds the directory and postings from the rest.
+The index is a pickle, so only load indexes that this tool wrote.
+Usage:
+    python field_usage_index.py --update exports/*_plugin_configuration.json
+    python field_usage_index.py --field custom35 --field FirstName
+    python field_usage_index.py --update exports/*.json --field FirstName
+"""
+import argparse
+import json
+import os
+import pickle
+import struct
+import sys
+import time
+from typing import NamedTuple
+
+from plugin_records import (read_plugin_json, get_mappings_dict, tenant_name, TEMPLATE_FIELD,
+                            iter_condition_block)
+from plugin_cache import file_sha256
+from plugin_config import mapping_direction
+
+INDEX_FORMAT_VERSION = 1
+INDEX_MAGIC = b'PXFIELDS'
+DEFAULT_INDEX = 'field_usage.idx'
+_section_lengths = struct.Struct('<III')
+
+
+class FieldUsage(NamedTuple):
+    tenant: str
+    external_type: str
+    internal_type: str
+    kind: str      # 'outreach', 'crm' or 'condition'
+    usage: str     # inbound/outbound/both/off, or the condition block
+    detail: str    # the field mapped to, or the condition's comparison
+
+
+def _condition_value_text(value):
+    # Lists and dictionaries are shown as JSON
+    if value is None:
+        return ''
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, sort_keys=True)
+    return str(value)
+
+
+def build_tenant_usages(fname, tenant=None):
+    """
+    Lists every field use in one export.
+    Returns a list of (field, FieldUsage) tuples.
+    """
+    tenant = sys.intern(tenant or tenant_name(fname))
+    limits, type_names, types = get_mappings_dict(read_plugin_json(fname))
+    usages = []
+    for typename in type_names:
+        external_type, internal_type = (sys.intern(name) for name in typename)
+        for row in types[typename]['field_mappings']:
+            direction = mapping_direction(row)
+            internal_field = row.display_internal_field
+            if row.internal_field != TEMPLATE_FIELD:
+                usages.append((row.internal_field, FieldUsage(
+                    tenant, external_type, internal_type, 'outreach', direction, row.external_field)))
+            if row.external_field:
+                usages.append((row.external_field, FieldUsage(
+                    tenant, external_type, internal_type, 'crm', direction, internal_field)))
+        for key, value in types[typename]['input'].items():
+            if 'Conditions' not in key or not isinstance(value, dict):
+                continue
+            for group_path, operator, field, comparison, condition_value in iter_condition_block(value):
+                if field:
+                    usages.append((field, FieldUsage(
+                        tenant, external_type, internal_type, 'condition', sys.intern(key),
+                        '{} {}'.format(comparison, _condition_value_text(condition_value)).strip())))
+    return usages
+
+
+def field_key(field):
+    return field.casefold()
+
+
+def _file_stamp(fname):
+    stat = os.stat(fname)
+    return {'path': os.path.abspath(fname), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def write_index(index_fname, files, tenants):
+    """
+    Writes an index file.
+    files: dictionary of tenant -> stamp of its export (path, size, mtime_ns,
+        sha256)
+    tenants: dictionary of tenant -> its (field, FieldUsage) list
+    """
+    # Usages are stored as plain tuples, which pickle far smaller and faster
+    # than NamedTuples
+    postings = {}
+    for tenant in sorted(tenants):
+        for field, usage in tenants[tenant]:
+            postings.setdefault(field_key(field), []).append((field,) + tuple(usage))
+    directory = {}
+    blobs = []
+    offset = 0
+    for key in sorted(postings):
+        blob = pickle.dumps(postings[key], protocol=pickle.HIGHEST_PROTOCOL)
+        directory[key] = (offset, len(blob))
+        blobs.append(blob)
+        offset += len(blob)
+    header_bytes = pickle.dumps({'format': INDEX_FORMAT_VERSION, 'files': files},
+                                protocol=pickle.HIGHEST_PROTOCOL)
+    directory_bytes = pickle.dumps(directory, protocol=pickle.HIGHEST_PROTOCOL)
+    tenants_bytes = pickle.dumps(
+        {tenant: [(field,) + tuple(usage) for field, usage in usages]
+         for tenant, usages in tenants.items()},
+        protocol=pickle.HIGHEST_PROTOCOL)
+    index_dir = os.path.dirname(os.path.abspath(index_fname))
+    os.makedirs(index_dir, exist_ok=True)
+    # Written to a temporary name first and moved into place, so a lookup
+    # running at the same time never sees half a file.
+    tmp_fname = '{}.{}.tmp'.format(index_fname, os.getpid())
+    with open(tmp_fname, 'wb') as f:
+        f.write(INDEX_MAGIC)
+        f.write(_section_lengths.pack(len(header_bytes), len(directory_bytes), len(tenants_bytes)))
+        f.write(header_bytes)
+        f.write(directory_bytes)
+        f.write(tenants_bytes)
+        for blob in blobs:
+            f.write(blob)
+    os.replace(tmp_fname, index_fname)
+
+
+class FieldUsageIndex():
+    def __init__(self, index_fname=DEFAULT_INDEX):
+        """
+        An index file opened for lookups. Only the header and the directory
+        are read here; the postings are read per lookup.
+        """
+        self.index_fname = index_fname
+        with open(index_fname, 'rb') as f:
+            if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                raise ValueError('{} is not a field usage index'.format(index_fname))
+            lengths = _section_lengths.unpack(f.read(_section_lengths.size))
+            header = pickle.loads(f.read(lengths[0]))
+            if header.get('format') != INDEX_FORMAT_VERSION:
+                raise ValueError('{} has index format {}, expected {}; rebuild it'.format(
+                    index_fname, header.get('format'), INDEX_FORMAT_VERSION))
+            self.files = header['files']
+            self.directory = pickle.loads(f.read(lengths[1]))
+        self._tenants_offset = len(INDEX_MAGIC) + _section_lengths.size + lengths[0] + lengths[1]
+        self._postings_offset = self._tenants_offset + lengths[2]
+
+    def lookup(self, field):
+        """
+        Returns the (field, FieldUsage) uses of a field name, in any case.
+        """
+        entry = self.directory.get(field_key(field))
+        if entry is None:
+            return []
+        offset, length = entry
+        with open(self.index_fname, 'rb') as f:
+            f.seek(self._postings_offset + offset)
+            return [(entry[0], FieldUsage(*entry[1:])) for entry in pickle.loads(f.read(length))]
+
+    def load_tenants(self):
+        """
+        Returns the usages of every tenant: tenant -> its (field, FieldUsage)
+        list.
+        """
+        with open(self.index_fname, 'rb') as f:
+            f.seek(self._tenants_offset)
+            tenants = pickle.loads(f.read(self._postings_offset - self._tenants_offset))
+        return {tenant: [(entry[0], FieldUsage(*entry[1:])) for entry in entries]
+                for tenant, entries in tenants.items()}
+
+
+def update_index(fnames, index_fname=DEFAULT_INDEX, prune=False):
+    """
+    Adds exports to an index (creating it if needed), re-parsing only the ones
+    that changed since they were indexed.
+    prune: remove the tenants that aren't among fnames
+    Returns the tenants that were (re)indexed and the ones removed.
+    """
+    files = {}
+    tenants = {}
+    if os.path.exists(index_fname):
+        try:
+            index = FieldUsageIndex(index_fname)
+            files = index.files
+            tenants = index.load_tenants()
+        except (ValueError, OSError, struct.error, pickle.UnpicklingError, EOFError):
+            files, tenants = {}, {}
+    updated = []
+    stamps_changed = False
+    for fname in fnames:
+        tenant = tenant_name(fname)
+        stamp = _file_stamp(fname)
+        indexed = files.get(tenant) if tenant in tenants else None
+        if indexed and all(indexed[key] == stamp[key] for key in ('path', 'size', 'mtime_ns')):
+            continue
+        stamp['sha256'] = file_sha256(fname)
+        files[tenant] = stamp
+        stamps_changed = True
+        if indexed and indexed['sha256'] == stamp['sha256']:
+            continue  # touched or moved, not changed
+        tenants[tenant] = build_tenant_usages(fname, tenant)
+        updated.append(tenant)
+    removed = []
+    if prune:
+        keep = {tenant_name(fname) for fname in fnames}
+        removed = [tenant for tenant in files if tenant not in keep]
+        for tenant in removed:
+            files.pop(tenant)
+            tenants.pop(tenant, None)
+    if stamps_changed or removed or not os.path.exists(index_fname):
+        write_index(index_fname, files, tenants)
+    return updated, removed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Find where fields are used across plugin configuration exports')
+    parser.add_argument('--field',
+                        action='append',
+                        help='a field name to look up (Outreach or CRM, any case); repeat for more',
+                        default=[],
+                        dest='fields')
+    parser.add_argument('--index',
+                        type=str,
+                        help='the index file (default {})'.format(DEFAULT_INDEX),
+                        default=DEFAULT_INDEX,
+                        dest='index')
+    parser.add_argument('--update',
+                        nargs='+',
+                        help='plugin configuration JSON files to (re)index before the lookup',
+                        required=False,
+                        dest='update')
+    parser.add_argument('--prune',
+                        action='store_true',
+                        help='with --update, remove the tenants that are not among the files',
+                        dest='prune')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    start = time.perf_counter()
+    if args.update:
+        updated, removed = update_index(args.update, args.index, args.prune)
+        print('indexed {} of {} files{} ({:.0f} ms)'.format(
+            len(updated), len(args.update),
+            ', removed {}'.format(', '.join(removed)) if removed else '',
+            (time.perf_counter() - start) * 1000))
+    if args.fields:
+        start = time.perf_counter()
+        index = FieldUsageIndex(args.index)
+        for field in args.fields:
+            uses = index.lookup(field)
+            for name, usage in uses:
+                # InternalField and ExternalField can be null in the export
+                print('\t'.join('' if value is None else str(value) for value in (name,) + usage))
+            print('{}: {} uses in {} tenants ({:.1f} ms)'.format(
+                field, len(uses), len({usage.tenant for name, usage in uses}),
+                (time.perf_counter() - start) * 1000))
@@ -1,5 +1,6 @@
 import argparse
 import json
+import tempfile
 from operator import itemgetter
 import requests
 import xlsxwritertools
@@ -16,17 +17,34 @@ def build_request_session(email, token):
 	session.headers=headers
 	return session
 
-def get_field_info(session):
+def build_base_url(subdomain):
+    return 'https://{}.zendesk.com/api/v2/'.format(subdomain)
+
+def get_all_pages(session, full_url, key):
+    """
+    Follows the next_page links of a Zendesk list endpoint, yielding the
+    records of one page at a time, e.g. the list under 'ticket_fields'.
+    """
+    while full_url:
+        response = session.get(full_url)
+        response.raise_for_status()
+        page = response.json()
+        yield page.get(key, [])
+        full_url = page.get('next_page')
+
+def get_field_pages(session, base_url=None):
     endpoint = 'ticket_fields.json'
-    full_url = url + endpoint
-    ticket_fields = session.get(full_url)
-    return ticket_fields.json()
+    full_url = (base_url or url) + endpoint
+    return get_all_pages(session, full_url, 'ticket_fields')
 
-def get_form_info(session):
+def get_field_info(session, base_url=None):
+    return {'ticket_fields': [fld for page in get_field_pages(session, base_url) for fld in page]}
+
+def get_form_info(session, base_url=None):
     endpoint = 'ticket_forms.json'
-    full_url = url + endpoint
-    ticket_forms = session.get(full_url)
-    return ticket_forms.json()
+    full_url = (base_url or url) + endpoint
+    return {'ticket_forms': [form for page in get_all_pages(session, full_url, 'ticket_forms')
+                             for form in page]}
 
 def load_json_data(fname):
     with open(fname, 'r') as f:
@@ -38,99 +56,258 @@ def get_fid_dict(ticket_fields):
     return fid_dict
 
 def build_form_tab_data(ticket_forms, fid_dict):
+    """
+    Builds the rows of every form tab and, in the same pass, an inverted index
+    of field id -> names of the forms the field is in. fid_dict is not
+    modified. The forms of a field are kept in a dict used as an ordered set,
+    so a field listed twice in one form only shows that form once.
+    Returns the form tab rows keyed by form name, and the field index.
+    """
     all_form_info = {}
+    field_forms = {}
     for form in ticket_forms['ticket_forms']:
         form_name = form['name']
         rows = []
         for fid in form['ticket_field_ids']:
-            if fid in fid_dict:
-                tix_field = fid_dict[fid]
+            tix_field = fid_dict.get(fid)
+            if tix_field is not None:
                 row = [
-                        fid, 
+                        fid,
                         tix_field['title'],
-                        tix_field['type'], 
+                        tix_field['type'],
                         tix_field['required'],
                         tix_field['editable_in_portal'],
                 ]
-                if 'isInForm' not in tix_field:
-                    tix_field['isInForm'] = []
-                tix_field['isInForm'].append(form_name)
+                field_forms.setdefault(fid, {})[form_name] = None
             else:
                 row = [fid, 'Field does not exist', '', '', '']
             rows.append(row)
         all_form_info[form_name] = rows
-    return all_form_info
+    return all_form_info, field_forms
 
-def build_field_tab_data(fid_dict):
-    fname_inform_dict = {}
-    fname_notinform_dict = {}
+def build_unique_field_names(fid_dict):
+    """
+    Gives every field a name that no other field has. The first field with a
+    title keeps it; later fields with the same title get ' (2)', ' (3)', ...
+    skipping any name that is already some other field's title.
+    Returns a dictionary of field id -> unique name.
+    """
+    title_ids = {}
     for fid, fdata in fid_dict.items():
-        fname = fdata['title']
-        if (fname in fname_inform_dict) or (fname in fname_notinform_dict):
-            fname = '{} (2)'.format(fname)
-        if 'isInForm' in fdata:
-            fname_inform_dict[fname] = fdata
-        else:
-            fname_notinform_dict[fname] = fdata
+        title_ids.setdefault(fdata['title'], []).append(fid)
+    taken = set(title_ids)
+    unique_names = {}
+    for title, fids in title_ids.items():
+        unique_names[fids[0]] = title
+        suffix_number = 2
+        for fid in fids[1:]:
+            fname = '{} ({})'.format(title, suffix_number)
+            while fname in taken:
+                suffix_number += 1
+                fname = '{} ({})'.format(title, suffix_number)
+            taken.add(fname)
+            unique_names[fid] = fname
+            suffix_number += 1
+    return unique_names
+
+def build_field_tab_data(fid_dict, field_forms, unique_names=None):
+    """
+    Builds the rows of the 'Fields in Forms' and 'Fields Not in Forms' tabs
+    from the field index made by build_form_tab_data. The fields are sorted
+    by name once and split between the two tabs in a single pass.
+    unique_names: the names from build_unique_field_names, if already built
+    """
+    if unique_names is None:
+        unique_names = build_unique_field_names(fid_dict)
     inform_field_rows = []
-    for fname, fdata in sorted(fname_inform_dict.items(), key=itemgetter(0)):
-            row = [
-                    fdata['id'],
-                    fname,
-                    fdata['type'],
-                    fdata['required'],
-                    fdata['editable_in_portal'],
-                    fdata['active'],
-                    fdata['isInForm'],
-            ]
-            inform_field_rows.append(row)
     notinform_field_rows = []
-    for fname, fdata in sorted(fname_notinform_dict.items(), key=itemgetter(0)):
-            row = [
-                    fdata['id'],
-                    fname,
-                    fdata['type'],
-                    fdata['required'],
-                    fdata['editable_in_portal'],
-                    fdata['active'],
-            ]
+    for fid, fname in sorted(unique_names.items(), key=itemgetter(1)):
+        fdata = fid_dict[fid]
+        row = [
+                fid,
+                fname,
+                fdata['type'],
+                fdata['required'],
+                fdata['editable_in_portal'],
+                fdata['active'],
+        ]
+        if fid in field_forms:
+            row.append(list(field_forms[fid]))
+            inform_field_rows.append(row)
+        else:
             notinform_field_rows.append(row)
     return inform_field_rows, notinform_field_rows
 
-def write_spreadsheet(output_fname, inform_field_rows, notinform_field_rows, all_form_info):
-    wb = xlsxwritertools.XLSXWorkbook(output_fname)
-    #wb.build_default_styles()
-    inf_sheet = wb.get_new_worksheet('Fields in Forms')
-    col_dict = {0: {"label": "Field ID", "width": 10, "style": "idnum_style"},
-            1: {"label": "Field Name", "width": 24, "style": "text_style"},
-            2: {"label": "Type", "width": 14, "style": "text_style"},
-            3: {"label": "Required", "width": 8, "style": "text_style"},
-            4: {"label": "Portal Editable", "width": 15, "style": "text_style"},
-            5: {"label": "Active", "width": 8, "style": "text_style"},
-            6: {"label": "In Form", "width": 24, "style": "text_style", "multicolumn": True},
-            }
-    row = wb.fill_sheet(inf_sheet, col_dict, inform_field_rows)
-
-    nif_sheet = wb.get_new_worksheet('Fields Not in Forms')
-    col_dict = {0: {"label": "Field ID", "width": 10, "style": "idnum_style"},
-            1: {"label": "Field Name", "width": 24, "style": "text_style"},
-            2: {"label": "Type", "width": 14, "style": "text_style"},
-            3: {"label": "Required", "width": 8, "style": "text_style"},
-            4: {"label": "Portal Editable", "width": 15, "style": "text_style"},
-            5: {"label": "Active", "width": 8, "style": "text_style"},
-            }
-    row = wb.fill_sheet(nif_sheet, col_dict, notinform_field_rows)
-
-    form_col_dict = {0: {"label": "Field ID", "width": 10, "style": "idnum_style"},
-            1: {"label": "Field Name", "width": 24, "style": "text_style"},
-            2: {"label": "Type", "width": 14, "style": "text_style"},
-            3: {"label": "Required", "width": 8, "style": "text_style"},
-            4: {"label": "Portal Editable", "width": 15, "style": "text_style"},
-            }
-    for formname in sorted(all_form_info.keys()):
-        sheet = wb.get_new_worksheet(formname)
+# Ticket field types whose values come from a list of custom_field_options
+option_field_types = ('dropdown', 'tagger', 'multiselect')
+
+def spool_field_options(field_pages, option_spool):
+    """
+    Collects the ticket fields of an iterable of pages (e.g. from
+    get_field_pages) into a {'ticket_fields': [...]} payload, moving the
+    custom_field_options of the dropdown, tagger and multiselect fields out
+    to option_spool, a text file, as one JSON line per page. Only one page of
+    options is held at a time; iter_spooled_pages reads them back.
+    The field records are changed: their options are taken out.
+    """
+    fields = []
+    for page in field_pages:
+        option_fields = []
+        for fdata in page:
+            options = fdata.pop('custom_field_options', None)
+            if options and fdata['type'] in option_field_types:
+                option_fields.append({'id': fdata['id'], 'type': fdata['type'],
+                                      'custom_field_options': options})
+            fields.append(fdata)
+        if option_fields:
+            option_spool.write(json.dumps(option_fields) + '\n')
+    return {'ticket_fields': fields}
+
+def iter_spooled_pages(option_spool):
+    """
+    Yields the pages spool_field_options wrote, one at a time.
+    """
+    option_spool.seek(0)
+    for line in option_spool:
+        yield json.loads(line)
+
+def iter_field_option_rows(field_pages, unique_names):
+    """
+    Yields one row per option of the dropdown, tagger and multiselect fields:
+    the field id, the field's unique name, the option name, its value (the
+    tag) and whether it is the default. The rows come page by page, in the
+    order the payload lists the fields and their options, so an instance
+    with hundreds of thousands of options never has them all in a list.
+    field_pages: an iterable of lists of ticket fields, e.g.
+        iter_spooled_pages(option_spool) or [ticket_fields['ticket_fields']]
+    unique_names: the names from build_unique_field_names (build_report_data
+        returns them)
+    """
+    for page in field_pages:
+        for fdata in page:
+            if fdata['type'] not in option_field_types:
+                continue
+            fid = fdata['id']
+            for option in fdata.get('custom_field_options') or ():
+                yield (fid, unique_names[fid], option.get('name', ''), option.get('value', ''),
+                       bool(option.get('default', False)))
+
+def build_report_data(ticket_fields, ticket_forms):
+    """
+    Runs the whole join for one instance.
+    Returns the 'Fields in Forms' rows, the 'Fields Not in Forms' rows, the
+    form tab rows keyed by form name, and the unique field names (for
+    iter_field_option_rows).
+    """
+    fid_dict = get_fid_dict(ticket_fields)
+    unique_names = build_unique_field_names(fid_dict)
+    all_form_info, field_forms = build_form_tab_data(ticket_forms, fid_dict)
+    inform_field_rows, notinform_field_rows = build_field_tab_data(
+        fid_dict, field_forms, unique_names)
+    return inform_field_rows, notinform_field_rows, all_form_info, unique_names
+
+field_col_dict = {0: {"label": "Field ID", "width": 10, "style": "idnum_style"},
+        1: {"label": "Field Name", "width": 24, "style": "text_style"},
+        2: {"label": "Type", "width": 14, "style": "text_style"},
+        3: {"label": "Required", "width": 8, "style": "text_style"},
+        4: {"label": "Portal Editable", "width": 15, "style": "text_style"},
+        5: {"label": "Active", "width": 8, "style": "text_style"},
+        }
+
+form_col_dict = {0: {"label": "Field ID", "width": 10, "style": "idnum_style"},
+        1: {"label": "Field Name", "width": 24, "style": "text_style"},
+        2: {"label": "Type", "width": 14, "style": "text_style"},
+        3: {"label": "Required", "width": 8, "style": "text_style"},
+        4: {"label": "Portal Editable", "width": 15, "style": "text_style"},
+        }
+
+overflow_col_dict = {0: {"label": "Field ID", "width": 10, "style": "idnum_style"},
+        1: {"label": "Field Name", "width": 24, "style": "text_style"},
+        2: {"label": "In Form", "width": 24, "style": "text_style"},
+        }
+
+option_col_dict = {0: {"label": "Field ID", "width": 10, "style": "idnum_style"},
+        1: {"label": "Field Name", "width": 24, "style": "text_style"},
+        2: {"label": "Option Name", "width": 32, "style": "text_style"},
+        3: {"label": "Value", "width": 32, "style": "text_style"},
+        4: {"label": "Default", "width": 8, "style": "text_style"},
+        }
+
+option_sheet_name = 'Field Options'
+
+field_sheet_names = ('Fields in Forms', 'Fields Not in Forms', 'In Form (overflow)')
+
+def write_field_sheets(wb, inform_field_rows, notinform_field_rows,
+                       max_form_columns=None, form_overflow='join', sheet_names=field_sheet_names):
+    """
+    Adds the 'Fields in Forms' and 'Fields Not in Forms' sheets (and the
+    'In Form (overflow)' sheet when forms spill over) to a workbook.
+    sheet_names: the names to use for those three sheets, for workbooks that
+        hold several instances
+    """
+    inf_name, nif_name, overflow_name = sheet_names
+    inf_sheet = wb.get_new_worksheet(inf_name)
+    col_dict = dict(field_col_dict)
+    col_dict[6] = {"label": "In Form", "width": 24, "style": "text_style", "multicolumn": True,
+            "max_columns": max_form_columns, "overflow": form_overflow}
+    spill = []
+    row = wb.fill_sheet(inf_sheet, col_dict, inform_field_rows, spill)
+
+    if spill:
+        # Forms that didn't fit on 'Fields in Forms', one row per field and form
+        overflow_sheet = wb.get_new_worksheet(overflow_name)
+        overflow_rows = [(rec[0], rec[1], form_name) for rec, form_name in spill]
+        row = wb.fill_sheet(overflow_sheet, overflow_col_dict, overflow_rows)
+
+    nif_sheet = wb.get_new_worksheet(nif_name)
+    row = wb.fill_sheet(nif_sheet, field_col_dict, notinform_field_rows)
+
+def write_option_sheet(wb, option_rows, sheet_name=option_sheet_name):
+    """
+    Adds the 'Field Options' sheet, written as the rows come in (see
+    XLSXWorkbook.stream_sheet). Instances with more options than a sheet has
+    rows carry on in continuation sheets.
+    option_rows: an iterable of rows, e.g. from iter_field_option_rows
+    """
+    sheet = wb.get_new_streamed_worksheet(sheet_name)
+    return wb.stream_sheet(sheet, option_col_dict, option_rows)
+
+def plan_form_sheet_names(all_form_info, reserved=field_sheet_names):
+    """
+    Works out the sheet names of the form tabs before anything is written, so
+    a form named like another sheet of the workbook gets a ' (2)' suffix
+    instead of stopping the run (see xlsxwritertools.plan_sheet_names).
+    reserved: the names of the workbook's other sheets
+    Returns {form name: sheet name}, in sheet order.
+    """
+    formnames = sorted(all_form_info.keys())
+    return dict(zip(formnames, xlsxwritertools.plan_sheet_names(formnames, reserved)))
+
+def write_form_sheets(wb, all_form_info, sheet_names=None):
+    """
+    sheet_names: {form name: sheet name}, from plan_form_sheet_names
+    """
+    if sheet_names is None:
+        sheet_names = plan_form_sheet_names(all_form_info)
+    for formname, sheet_name in sheet_names.items():
+        sheet = wb.get_new_worksheet(sheet_name)
         data = all_form_info[formname]
         row = wb.fill_sheet(sheet, form_col_dict, data)
+
+def write_spreadsheet(output_fname, inform_field_rows, notinform_field_rows, all_form_info,
+                      max_form_columns=None, form_overflow='join', option_rows=None):
+    wb = xlsxwritertools.XLSXWorkbook(output_fname)
+    #wb.build_default_styles()
+    reserved = list(field_sheet_names)
+    if option_rows is not None:
+        reserved.append(option_sheet_name)
+    form_sheet_names = plan_form_sheet_names(all_form_info, reserved)
+    wb.reserve_sheet_names(form_sheet_names.values())
+    write_field_sheets(wb, inform_field_rows, notinform_field_rows,
+                       max_form_columns, form_overflow)
+    if option_rows is not None:
+        write_option_sheet(wb, option_rows)
+    write_form_sheets(wb, all_form_info, form_sheet_names)
     wb.close_workbook()
 
 def parse_args():
@@ -164,39 +341,68 @@ def parse_args():
             help="Name of the spreadsheet output file",
             required=True,
             dest="output")
+    parser.add_argument('--max-form-columns',
+            type=int,
+            help='most "In Form" columns to show per field, 0 for no limit (default 25)',
+            default=25,
+            dest='max_form_columns')
+    parser.add_argument('--form-overflow',
+            choices=['join', 'sheet'],
+            help=('what to do with the forms past --max-form-columns: join them into the '
+                  'last column, or list them on an "In Form (overflow)" sheet'),
+            default='join',
+            dest='form_overflow')
 
     args = parser.parse_args()
     return args
 
-def get_field_and_form_data(args):
+def get_field_and_form_data(args, option_spool=None):
+    """
+    Reads the fields page by page, moving their options to option_spool
+    (see spool_field_options). A field file is a single JSON document, so it
+    is read whole, but its options are spooled and let go of in the same way.
+    Without option_spool the fields keep their options.
+    """
     if args.email:
         if not args.token:
             e = "You must include a token along with an email to fetch data from the subdomain via API"
             raise Exception(e)
         session = build_request_session(args.email, args.token)
-        ticket_fields = get_field_info(session)
+        base_url = build_base_url(args.subdomain)
+        if option_spool is None:
+            ticket_fields = get_field_info(session, base_url)
+        else:
+            ticket_fields = spool_field_options(get_field_pages(session, base_url), option_spool)
         print('retrieved ticket fields')
-        ticket_forms = get_form_info(session)
+        ticket_forms = get_form_info(session, base_url)
         print('retrieved ticket forms')
     elif args.field_file:
         if not args.form_file:
             e = "You must supply both a field file and a form file if you are not using the API"
             raise Exception(e)
         ticket_fields = load_json_data(args.field_file)
+        if option_spool is not None:
+            ticket_fields = spool_field_options([ticket_fields['ticket_fields']], option_spool)
         ticket_forms = load_json_data(args.form_file)
     return ticket_fields, ticket_forms
 
 
 if __name__ == "__main__":
     args = parse_args()
-    url = 'https://{}.zendesk.com/api/v2/'.format(args.subdomain)
+    url = build_base_url(args.subdomain)
     print(url)
-    ticket_fields, ticket_forms = get_field_and_form_data(args)
-    fid_dict = get_fid_dict(ticket_fields)
-    print('built fid_dict')
-    all_form_info = build_form_tab_data(ticket_forms, fid_dict)
-    print('built form tab info')
-    inform_field_rows, notinform_field_rows = build_field_tab_data(fid_dict)
-    print('built field tab info')
-    write_spreadsheet(args.output, inform_field_rows, notinform_field_rows, all_form_info)
+    with tempfile.TemporaryFile('w+', encoding='utf-8') as option_spool:
+        ticket_fields, ticket_forms = get_field_and_form_data(args, option_spool)
+        fid_dict = get_fid_dict(ticket_fields)
+        unique_names = build_unique_field_names(fid_dict)
+        print('built fid_dict')
+        all_form_info, field_forms = build_form_tab_data(ticket_forms, fid_dict)
+        print('built form tab info')
+        inform_field_rows, notinform_field_rows = build_field_tab_data(
+            fid_dict, field_forms, unique_names)
+        print('built field tab info')
+        form_overflow = 'spill' if args.form_overflow == 'sheet' else 'join'
+        write_spreadsheet(args.output, inform_field_rows, notinform_field_rows, all_form_info,
+                          args.max_form_columns, form_overflow,
+                          iter_field_option_rows(iter_spooled_pages(option_spool), unique_names))
     print('Complete! Report written to {}'.format(args.output))
@@ -0,0 +1,32 @@
+"""
+How long to wait before retrying an HTTP request, shared by the clients that
+retry rate-limited and failed requests (plugin_export_fetcher.py,
+zendesk_audit_runner.py).
+A Retry-After header is either a number of seconds or an HTTP date; a header
+that is missing or can't be parsed falls back to exponential backoff.
+"""
+import datetime
+import email.utils
+
+
+def retry_delay(retry_after, attempt):
+    """
+    Returns the number of seconds to wait before retrying.
+    retry_after: the Retry-After header of the response, or None
+    attempt: the number of the attempt that failed, from 0
+    """
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+        try:
+            retry_time = email.utils.parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            retry_time = None
+        if retry_time is not None:
+            if retry_time.tzinfo is None:
+                retry_time = retry_time.replace(tzinfo=datetime.timezone.utc)
+            now = datetime.datetime.now(datetime.timezone.utc)
+            return max(0.0, (retry_time - now).total_seconds())
+    return float(2 ** attempt)
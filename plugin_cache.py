@@ -0,0 +1,191 @@
+"""
+Compiled cache of parsed plugin configurations.
+The same *_plugin_configuration.json exports get parsed over and over for
+different reports. compile_plugin_config() parses an export once (with
+get_mappings_dict, so the field mappings are already FieldMappingRow records)
+and stores the result as a pickle next to a small header. load_plugin_config()
+memory-maps that file and only unpickles the payload when the header says it
+is still current, so a repeat load costs little more than reading the file.
+The header records the export's SchemaVersion and the size, mtime and sha256
+of the source file. A cache is used as-is when size and mtime are unchanged;
+when they differ the source is hashed, and the cache is rebuilt only if the
+hash differs too. Bumping CACHE_FORMAT_VERSION invalidates every cache, which
+is needed whenever the compiled structures change shape.
+The cache files are pickles, so only load caches that this tool wrote.
+Usage:
+    python plugin_cache.py MC_plugin_configuration.json OR_plugin_configuration.json
+"""
+import argparse
+import hashlib
+import mmap
+import os
+import pickle
+import struct
+
+from plugin_records import read_plugin_json, get_mappings_dict
+
+CACHE_FORMAT_VERSION = 1
+CACHE_MAGIC = b'PXCACHE\x00'
+CACHE_SUFFIX = '.pxcache'
+DEFAULT_CACHE_DIR = '.plugin_cache'
+_header_length = struct.Struct('<I')
+
+
+def file_sha256(fname):
+    """
+    Returns the hex sha256 of a file, read in chunks.
+    """
+    digest = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_cache_filename(fname, cache_dir=None):
+    """
+    Returns where the cache of a plugin export lives. By default that is a
+    .plugin_cache directory next to the export.
+    fname: path to the plugin configuration JSON file
+    cache_dir: directory to keep the caches in
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(
+            os.path.abspath(fname)), DEFAULT_CACHE_DIR)
+    return os.path.join(cache_dir, os.path.basename(fname) + CACHE_SUFFIX)
+
+
+def _source_stamp(fname):
+    stat = os.stat(fname)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _write_cache(cache_fname, header, payload_bytes):
+    # Written to a temporary name first and moved into place, so concurrent
+    # readers never see half a file.
+    header_bytes = pickle.dumps(header, protocol=pickle.HIGHEST_PROTOCOL)
+    os.makedirs(os.path.dirname(cache_fname), exist_ok=True)
+    tmp_fname = '{}.{}.tmp'.format(cache_fname, os.getpid())
+    with open(tmp_fname, 'wb') as f:
+        f.write(CACHE_MAGIC)
+        f.write(_header_length.pack(len(header_bytes)))
+        f.write(header_bytes)
+        f.write(payload_bytes)
+    os.replace(tmp_fname, cache_fname)
+
+
+def compile_plugin_config(fname, cache_dir=None):
+    """
+    Parses a plugin export and writes its compiled cache.
+    fname: path to the plugin configuration JSON file
+    cache_dir: directory to keep the caches in
+    Returns what get_mappings_dict returns: (limits, type_names, types).
+    """
+    stamp = _source_stamp(fname)
+    sha256 = file_sha256(fname)
+    plugin_data = read_plugin_json(fname)
+    schema_version = plugin_data.get('SchemaVersion')
+    compiled = get_mappings_dict(plugin_data)
+
+    header = dict(stamp, format=CACHE_FORMAT_VERSION, sha256=sha256,
+                  schema_version=schema_version)
+    payload_bytes = pickle.dumps(compiled, protocol=pickle.HIGHEST_PROTOCOL)
+    _write_cache(get_cache_filename(fname, cache_dir), header, payload_bytes)
+    return compiled
+
+
+def read_cache_header(cache_fname):
+    """
+    Returns the header of a cache file, or None when the file is missing or
+    isn't a cache written by this module.
+    """
+    try:
+        with open(cache_fname, 'rb') as f:
+            if f.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+                return None
+            (length,) = _header_length.unpack(f.read(_header_length.size))
+            return pickle.loads(f.read(length))
+    except (OSError, struct.error, pickle.UnpicklingError, EOFError):
+        return None
+
+
+def check_cache(fname, header):
+    """
+    Checks a cache header against the source file: first by size and mtime,
+    then, if those changed, by content hash.
+    Returns None when the cache is stale, otherwise the source's current
+    stamp if only the stamp changed (the content didn't), or {} if nothing
+    changed at all.
+    """
+    if header is None or header.get('format') != CACHE_FORMAT_VERSION:
+        return None
+    stamp = _source_stamp(fname)
+    if stamp['size'] == header['size'] and stamp['mtime_ns'] == header['mtime_ns']:
+        return {}
+    if file_sha256(fname) == header['sha256']:
+        return stamp
+    return None
+
+
+def is_cache_current(fname, header):
+    return check_cache(fname, header) is not None
+
+
+def _load_payload(cache_fname, new_stamp=None):
+    with open(cache_fname, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = len(CACHE_MAGIC)
+            (length,) = _header_length.unpack_from(mm, start)
+            start += _header_length.size
+            header = pickle.loads(mm[start:start + length])
+            with memoryview(mm) as view:
+                payload = pickle.loads(view[start + length:])
+            if new_stamp:
+                # The source was touched but not changed: record the new stamp
+                # so the next load doesn't have to hash the source again.
+                header.update(new_stamp)
+                _write_cache(cache_fname, header, mm[start + length:])
+    return header, payload
+
+
+def load_plugin_config(fname, cache_dir=None):
+    """
+    Returns the parsed plugin export, from its cache when the cache is current
+    and by compiling it (and refreshing the cache) otherwise. Every call
+    returns fresh objects, so callers are free to modify what they get.
+    fname: path to the plugin configuration JSON file
+    cache_dir: directory to keep the caches in
+    Returns what get_mappings_dict returns: (limits, type_names, types).
+    """
+    cache_fname = get_cache_filename(fname, cache_dir)
+    new_stamp = check_cache(fname, read_cache_header(cache_fname))
+    if new_stamp is not None:
+        try:
+            header, payload = _load_payload(cache_fname, new_stamp)
+            return payload
+        except (OSError, ValueError, pickle.UnpicklingError, EOFError):
+            pass
+    return compile_plugin_config(fname, cache_dir)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Compile plugin configuration JSON exports into caches for fast loading')
+    parser.add_argument('inputs',
+                        nargs='+',
+                        help='plugin configuration JSON files to compile')
+    parser.add_argument('--cache-dir',
+                        type=str,
+                        help='directory to keep the caches in (defaults to .plugin_cache next to each file)',
+                        required=False,
+                        dest='cache_dir')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    for fname in args.inputs:
+        compile_plugin_config(fname, args.cache_dir)
+        print('Compiled {} to {}'.format(
+            fname, get_cache_filename(fname, args.cache_dir)))
@@ -0,0 +1,292 @@
+"""
+Read-only object model of a plugin configuration export, with indexes.
+Reports used to walk the dictionaries of get_mappings_dict again and again,
+and some of them changed those dictionaries on the way (relabelling the
+limits, for instance), so a parsed export couldn't be shared. A PluginConfig
+is built once from an export and never changes afterwards: the settings are
+FrozenDicts and tuples, the field mappings FieldMappingRow records, and every
+index is built in the constructor. Nothing is computed lazily, so one
+PluginConfig can be read from any number of threads at once.
+The indexes answer the common questions with a dictionary lookup, returning a
+tuple of the k matches:
+    config.plugin_type(('Contact', 'Prospect'))     # PluginType
+    config.mappings_by_internal_field('first_name')  # (MappingUse, ...)
+    config.mappings_by_external_field('FirstName')
+    config.mappings_by_direction('both')             # inbound/outbound/both/off
+    config.conditions_by_field('Status')             # (ConditionUse, ...)
+Field names are matched exactly. Templated mappings ('__TEMPLATE__' as the
+internal field) are left out of the internal field index.
+FrozenDicts are dicts, so the settings still go through json.dumps and pickle
+(e.g. to a process pool); it is only changing them that raises a TypeError.
+as_mappings() gives the (limits, type_names, types) shape of get_mappings_dict,
+as read-only views, for the code that takes that.
+Usage:
+    python plugin_config.py sage_plugin_configuration.json --internal-field first_name
+"""
+import argparse
+from typing import NamedTuple
+
+from plugin_records import (read_plugin_json, get_mappings_dict, iter_condition_block, TypeStats,
+                            TEMPLATE_FIELD)
+from plugin_cache import load_plugin_config
+
+DIRECTIONS = ('inbound', 'outbound', 'both', 'off')
+
+
+class FrozenDict(dict):
+    """
+    A dict that can't be changed after it is made.
+    """
+    __slots__ = ()
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('{} is read-only'.format(self.__class__.__name__))
+
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, dict.__repr__(self))
+
+
+def freeze(value):
+    """
+    Returns a read-only copy of a JSON value: dicts become FrozenDicts and
+    lists tuples, all the way down.
+    """
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def thaw(value):
+    """
+    Returns a plain, changeable copy of a frozen value.
+    """
+    if isinstance(value, dict):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(item) for item in value]
+    return value
+
+
+def mapping_direction(row):
+    """
+    Returns the sync direction of a FieldMappingRow: 'inbound', 'outbound',
+    'both' or 'off'.
+    """
+    if row.inbound_enabled and row.outbound_enabled:
+        return 'both'
+    if row.inbound_enabled:
+        return 'inbound'
+    if row.outbound_enabled:
+        return 'outbound'
+    return 'off'
+
+
+class PluginType(NamedTuple):
+    typename: tuple        # (ExternalType, InternalType)
+    settings: FrozenDict   # the type's settings, FieldMappings left out
+    field_mappings: tuple  # FieldMappingRow records
+    stats: TypeStats
+
+
+class MappingUse(NamedTuple):
+    typename: tuple
+    row: object            # FieldMappingRow
+
+
+class ConditionUse(NamedTuple):
+    typename: tuple
+    setting: str           # PollingConditions, InboundCreateConditions, ...
+    group_path: str
+    logical_operator: str
+    field: str
+    comparison: str
+    value: object
+
+
+def _index(pairs):
+    index = {}
+    for key, item in pairs:
+        index.setdefault(key, []).append(item)
+    return FrozenDict((key, tuple(items)) for key, items in index.items())
+
+
+class PluginConfig():
+    __slots__ = ('limits', 'type_names', 'types', '_internal_fields', '_external_fields',
+                 '_directions', '_condition_fields')
+
+    def __init__(self, limits, type_names, types):
+        """
+        Builds the model and its indexes from what get_mappings_dict returns;
+        the arguments are copied, not kept or changed.
+        limits: the plugin-level settings
+        type_names: list of (ExternalType, InternalType) tuples
+        types: dictionary of type name -> {'input', 'field_mappings', 'stats'}
+        """
+        setattr_ = object.__setattr__
+        setattr_(self, 'limits', freeze({key: value for key, value in limits.items()
+                                         if key != 'PluginTypeMappings'}))
+        setattr_(self, 'type_names', tuple(tuple(typename) for typename in type_names))
+        plugin_types = {}
+        mapping_uses = []
+        condition_uses = []
+        for typename in self.type_names:
+            type_data = types[typename]
+            settings = freeze({key: value for key, value in type_data['input'].items()
+                               if key != 'FieldMappings'})
+            plugin_type = PluginType(typename, settings, tuple(type_data['field_mappings']),
+                                     type_data['stats'])
+            plugin_types[typename] = plugin_type
+            mapping_uses.extend(MappingUse(typename, row) for row in plugin_type.field_mappings)
+            for key, value in settings.items():
+                if 'Conditions' in key and isinstance(value, dict):
+                    condition_uses.extend(ConditionUse(typename, key, *condition)
+                                          for condition in iter_condition_block(value))
+        setattr_(self, 'types', FrozenDict(plugin_types))
+        setattr_(self, '_internal_fields', _index(
+            (use.row.internal_field, use) for use in mapping_uses
+            if use.row.internal_field != TEMPLATE_FIELD))
+        setattr_(self, '_external_fields', _index(
+            (use.row.external_field, use) for use in mapping_uses if use.row.external_field))
+        setattr_(self, '_directions', _index(
+            (mapping_direction(use.row), use) for use in mapping_uses))
+        setattr_(self, '_condition_fields', _index(
+            (use.field, use) for use in condition_uses if use.field))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('PluginConfig is read-only')
+
+    __delattr__ = __setattr__
+
+    def __reduce__(self):
+        return (_rebuild_plugin_config, self.as_mappings())
+
+    @classmethod
+    def from_plugin_data(cls, plugin_data):
+        """
+        Builds the model of a plugin JSON export (as read_plugin_json returns
+        it), which is left as it was.
+        """
+        return cls(*get_mappings_dict(plugin_data))
+
+    @property
+    def provider(self):
+        return self.limits.get('Provider', '')
+
+    def plugin_type(self, typename):
+        """
+        Returns the PluginType of an (ExternalType, InternalType) pair, or
+        None.
+        """
+        return self.types.get(tuple(typename))
+
+    def mappings_by_internal_field(self, field):
+        """
+        Returns the MappingUses of an Outreach field, in export order.
+        """
+        return self._internal_fields.get(field, ())
+
+    def mappings_by_external_field(self, field):
+        """
+        Returns the MappingUses of a CRM field, in export order.
+        """
+        return self._external_fields.get(field, ())
+
+    def mappings_by_direction(self, direction):
+        """
+        Returns the MappingUses that sync in exactly one direction: 'inbound',
+        'outbound', 'both' or 'off'.
+        """
+        if direction not in DIRECTIONS:
+            raise ValueError('unknown direction {!r}, expected one of {}'.format(
+                direction, ', '.join(DIRECTIONS)))
+        return self._directions.get(direction, ())
+
+    def conditions_by_field(self, field):
+        """
+        Returns the ConditionUses of a field, in export order.
+        """
+        return self._condition_fields.get(field, ())
+
+    def as_mappings(self):
+        """
+        Returns (limits, type_names, types) in the shape of get_mappings_dict,
+        made of read-only views of the model.
+        """
+        types = FrozenDict(
+            (typename, FrozenDict(output=FrozenDict(), input=plugin_type.settings,
+                                  field_mappings=plugin_type.field_mappings,
+                                  stats=plugin_type.stats))
+            for typename, plugin_type in self.types.items())
+        return self.limits, list(self.type_names), types
+
+
+def _rebuild_plugin_config(limits, type_names, types):
+    return PluginConfig(limits, type_names, types)
+
+
+def load_plugin_model(fname, cache_dir=None):
+    """
+    Returns the PluginConfig of an export, going through the compiled cache
+    of plugin_cache.py when cache_dir is given.
+    """
+    if cache_dir:
+        return PluginConfig(*load_plugin_config(fname, cache_dir))
+    return PluginConfig.from_plugin_data(read_plugin_json(fname))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Look fields up in a plugin configuration export')
+    parser.add_argument('input',
+                        type=str,
+                        help='plugin configuration JSON file')
+    parser.add_argument('--internal-field',
+                        type=str,
+                        help='list the mappings of this Outreach field',
+                        required=False,
+                        dest='internal_field')
+    parser.add_argument('--external-field',
+                        type=str,
+                        help='list the mappings of this CRM field',
+                        required=False,
+                        dest='external_field')
+    parser.add_argument('--direction',
+                        choices=DIRECTIONS,
+                        help='list the mappings that sync this way',
+                        required=False,
+                        dest='direction')
+    parser.add_argument('--condition-field',
+                        type=str,
+                        help='list the conditions on this field',
+                        required=False,
+                        dest='condition_field')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    config = load_plugin_model(args.input)
+    uses = []
+    if args.internal_field:
+        uses.extend(config.mappings_by_internal_field(args.internal_field))
+    if args.external_field:
+        uses.extend(config.mappings_by_external_field(args.external_field))
+    if args.direction:
+        uses.extend(config.mappings_by_direction(args.direction))
+    for use in uses:
+        print('\t'.join(('-'.join(use.typename), use.row.display_internal_field,
+                         use.row.external_field, mapping_direction(use.row))))
+    if args.condition_field:
+        for use in config.conditions_by_field(args.condition_field):
+            print('\t'.join(('-'.join(use.typename), use.setting, use.group_path or '-',
+                             str(use.logical_operator), str(use.field), str(use.comparison),
+                             str(use.value))))
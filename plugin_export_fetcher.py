@@ -0,0 +1,278 @@
+"""
+Downloads the plugin configuration exports of many tenants concurrently and
+feeds them into the converter.
+The downloads run on an asyncio event loop: a semaphore bounds how many are in
+flight, and each one streams the response to a temporary file in a worker
+thread (requests does the HTTP) that is moved into place once it's complete.
+Request errors (dropped connections, timeouts, responses cut off
+mid-stream), 429s and 5xx responses are retried with exponential backoff,
+honouring Retry-After. With --convert every export is handed to
+convert_plugin_config in a process pool as soon as its download finishes, so
+the spreadsheets are being written while the remaining downloads run.
+The endpoint is a URL template with a {tenant} placeholder, and each tenant can
+override it. The tenants file is a JSON object keyed by tenant:
+    {
+        "sage": {"token": "..."},
+        "acme": {"token": "...", "url": "https://exports.acme.com/plugin.json"}
+    }
+plugin_export_stub.py serves a directory of exports over HTTP, for trying this
+out without a real endpoint.
+Usage:
+    python plugin_export_fetcher.py --tenants-file tenants.json \\
+        --url-template "https://api.example.com/plugins/{tenant}/export" \\
+        --output-dir exports --convert
+"""
+import argparse
+import asyncio
+import functools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import requests
+
+import xlsxwritertools
+from http_retry import retry_delay
+from TC_plugin_to_xlsx import (convert_plugin_config, condition_cache_info,
+                               condition_cache_stats_since, total_condition_cache_stats,
+                               format_condition_cache_stats)
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class FetchError(Exception):
+    pass
+
+
+def convert_export(json_fname, spreadsheet_fname, profile='default'):
+    """
+    Converts one downloaded export in a convert_executor worker. Returns the
+    ConditionCacheStats of the conversion, as the worker's cache stays in
+    the worker.
+    """
+    before = condition_cache_info()
+    convert_plugin_config(json_fname, spreadsheet_fname, 1, profile=profile)
+    return condition_cache_stats_since(before)
+
+
+class PluginExportFetcher():
+    def __init__(self, url_template, concurrency=4, max_retries=3, timeout=60,
+                 chunk_size=1 << 16):
+        """
+        Fetches plugin configuration exports.
+        url_template: endpoint of the export, with a {tenant} placeholder
+        concurrency: most downloads in flight at once
+        max_retries: retries of a failed download before giving up
+        timeout: connect/read timeout of each request, in seconds
+        chunk_size: size of the chunks streamed to disk
+        """
+        self.url_template = url_template
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+
+    def build_url(self, tenant, options):
+        return options.get('url') or self.url_template.format(tenant=tenant)
+
+    def build_headers(self, options):
+        headers = {'Accept': 'application/json'}
+        if options.get('token'):
+            headers['Authorization'] = 'Bearer {}'.format(options['token'])
+        return headers
+
+    def _download(self, url, headers, dest_fname):
+        """
+        Streams one response to dest_fname. Blocking; run in a worker thread.
+        Returns None when the download worked, or the Retry-After header of
+        the response to retry ('' when it has none).
+        The partial file is removed when the download fails.
+        """
+        tmp_fname = '{}.{}.part'.format(dest_fname, os.getpid())
+        try:
+            with requests.get(url, headers=headers, stream=True,
+                              timeout=self.timeout) as response:
+                if response.status_code in RETRY_STATUS_CODES:
+                    return response.headers.get('Retry-After', '')
+                response.raise_for_status()
+                with open(tmp_fname, 'wb') as f:
+                    for chunk in response.iter_content(self.chunk_size):
+                        f.write(chunk)
+            os.replace(tmp_fname, dest_fname)
+            return None
+        finally:
+            try:
+                os.remove(tmp_fname)
+            except FileNotFoundError:
+                pass
+
+    async def fetch(self, tenant, options, dest_fname, semaphore):
+        """
+        Downloads the export of one tenant to dest_fname, retrying on request
+        errors (connection errors, timeouts, responses cut off mid-stream),
+        429s and 5xx responses. Other HTTP errors aren't retried.
+        """
+        url = self.build_url(tenant, options)
+        headers = self.build_headers(options)
+        async with semaphore:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    retry_after = await asyncio.to_thread(
+                        self._download, url, headers, dest_fname)
+                    if retry_after is None:
+                        return dest_fname
+                    reason = 'rate limited or server error'
+                except requests.HTTPError:
+                    raise
+                except requests.RequestException as e:
+                    retry_after = None
+                    reason = str(e)
+                if attempt == self.max_retries:
+                    break
+                await asyncio.sleep(retry_delay(retry_after, attempt))
+        raise FetchError('{}: {} after {} attempts'.format(
+            tenant, reason, self.max_retries + 1))
+
+    async def fetch_all(self, tenants, output_dir, convert_executor=None, profile='default'):
+        """
+        Downloads the exports of every tenant into output_dir as
+        <tenant>_plugin_configuration.json.
+        tenants: dictionary of tenant -> {'token': ..., 'url': ...}
+        convert_executor: when given, each export is converted to a
+            spreadsheet in this executor as soon as it has been downloaded
+        profile: the output profile of the spreadsheets (see
+            xlsxwritertools.OUTPUT_PROFILES)
+        Returns a dictionary of tenant -> output file (the spreadsheet when
+        converting, the JSON otherwise) for the tenants that worked, a
+        dictionary of tenant -> exception for the ones that didn't, and the
+        ConditionCacheStats of the conversions added up.
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        loop = asyncio.get_running_loop()
+        cache_stats = []
+
+        async def run(tenant, options):
+            dest_fname = os.path.join(
+                output_dir, '{}_plugin_configuration.json'.format(tenant))
+            await self.fetch(tenant, options, dest_fname, semaphore)
+            print('retrieved {}'.format(tenant))
+            if convert_executor is None:
+                return dest_fname
+            spreadsheet_fname = os.path.splitext(dest_fname)[0] + '.xlsx'
+            cache_stats.append(await loop.run_in_executor(convert_executor, functools.partial(
+                convert_export, dest_fname, spreadsheet_fname, profile=profile)))
+            print('converted {} to {}'.format(tenant, spreadsheet_fname))
+            return spreadsheet_fname
+
+        tasks = [run(tenant, options) for tenant, options in tenants.items()]
+        outcomes = await asyncio.gather(*tasks, return_exceptions=True)
+        results = {}
+        failures = {}
+        for tenant, outcome in zip(tenants, outcomes):
+            if isinstance(outcome, Exception):
+                failures[tenant] = outcome
+                print('FAILED {}: {}'.format(tenant, outcome))
+            else:
+                results[tenant] = outcome
+        return results, failures, total_condition_cache_stats(cache_stats)
+
+
+def load_tenants(fname=None, tenant_names=None, token=None):
+    """
+    Returns the tenant dictionary from a tenants file, from a list of tenant
+    names sharing one token, or both (the names then select from the file).
+    """
+    tenants = {}
+    if fname:
+        with open(fname, 'r') as f:
+            tenants = json.load(f)
+    if tenant_names:
+        missing = [t for t in tenant_names if fname and t not in tenants]
+        if missing:
+            e = "No tenant entry for {}".format(', '.join(missing))
+            raise Exception(e)
+        tenants = {t: tenants.get(t, {'token': token}) for t in tenant_names}
+    return tenants
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Download the plugin configuration exports of many tenants and convert them')
+    parser.add_argument('--tenants-file',
+                        type=str,
+                        help='path to a JSON file of tenant -> {"token": ..., "url": ...}',
+                        required=False,
+                        dest='tenants_file')
+    parser.add_argument('--tenants',
+                        nargs='+',
+                        help='tenants to fetch (all of the tenants file by default)',
+                        required=False,
+                        dest='tenants')
+    parser.add_argument('--token',
+                        type=str,
+                        help='API token for tenants given with --tenants and not in the tenants file',
+                        required=False,
+                        dest='token')
+    parser.add_argument('--url-template',
+                        type=str,
+                        help='export endpoint with a {tenant} placeholder',
+                        required=True,
+                        dest='url_template')
+    parser.add_argument('--output-dir',
+                        type=str,
+                        help='directory to download the exports into',
+                        default='exports',
+                        dest='output_dir')
+    parser.add_argument('--concurrency',
+                        type=int,
+                        help='most downloads in flight at once (default 4)',
+                        default=4,
+                        dest='concurrency')
+    parser.add_argument('--retries',
+                        type=int,
+                        help='retries of a failed download (default 3)',
+                        default=3,
+                        dest='retries')
+    parser.add_argument('--convert',
+                        action='store_true',
+                        help='convert each export to a spreadsheet as soon as it is downloaded',
+                        dest='convert')
+    parser.add_argument('--convert-workers',
+                        type=int,
+                        help='number of processes converting exports',
+                        required=False,
+                        dest='convert_workers')
+    parser.add_argument('--profile',
+                        choices=sorted(xlsxwritertools.OUTPUT_PROFILES),
+                        help='zip compression of the spreadsheets (see TC_plugin_to_xlsx.py --profile)',
+                        default='default',
+                        dest='profile')
+    args = parser.parse_args()
+    if not args.tenants_file and not args.tenants:
+        parser.error('at least one of --tenants-file and --tenants is required')
+    return args
+
+
+async def main(args):
+    tenants = load_tenants(args.tenants_file, args.tenants, args.token)
+    fetcher = PluginExportFetcher(args.url_template, args.concurrency, args.retries)
+    start = time.monotonic()
+    if args.convert:
+        with ProcessPoolExecutor(max_workers=args.convert_workers) as executor:
+            results, failures, cache_stats = await fetcher.fetch_all(
+                tenants, args.output_dir, executor, args.profile)
+    else:
+        results, failures, cache_stats = await fetcher.fetch_all(tenants, args.output_dir)
+    print('{} of {} tenants done in {:.1f}s'.format(
+        len(results), len(tenants), time.monotonic() - start))
+    if args.convert:
+        print(format_condition_cache_stats(cache_stats))
+    return failures
+
+
+if __name__ == "__main__":
+    failures = asyncio.run(main(parse_args()))
+    if failures:
+        raise SystemExit('Failed tenants: {}'.format(', '.join(failures)))
@@ -0,0 +1,117 @@
+"""
+A local stand-in for the plugin export endpoint, for trying out
+plugin_export_fetcher.py.
+Serves <directory>/<tenant>_plugin_configuration.json at /plugins/<tenant>/export.
+Unknown tenants get a 404. With --fail-first N the first N requests for each
+tenant get a 503 (with Retry-After: 0), to exercise the retries, the next
+--cut-off-first N responses stop halfway through the export, to exercise the
+retry of a partial download, and --delay slows every response down, to see
+the downloads overlap.
+Usage:
+    python plugin_export_stub.py --directory . --port 8765
+    python plugin_export_fetcher.py --tenants sage MC OR \\
+        --url-template "http://127.0.0.1:8765/plugins/{tenant}/export" --convert
+"""
+import argparse
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubExportHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        parts = self.path.strip('/').split('/')
+        if len(parts) != 3 or parts[0] != 'plugins' or parts[2] != 'export':
+            self.send_error(404)
+            return
+        tenant = parts[1]
+        fname = os.path.join(server.directory,
+                             '{}_plugin_configuration.json'.format(tenant))
+        if not os.path.isfile(fname):
+            self.send_error(404)
+            return
+        with server.lock:
+            attempts = server.attempts.get(tenant, 0)
+            server.attempts[tenant] = attempts + 1
+        if server.delay:
+            time.sleep(server.delay)
+        if attempts < server.fail_first:
+            self.send_response(503)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        size = os.path.getsize(fname)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        if attempts < server.fail_first + server.cut_off_first:
+            with open(fname, 'rb') as f:
+                self.wfile.write(f.read(size // 2))
+            self.close_connection = True
+            return
+        with open(fname, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 16), b''):
+                self.wfile.write(chunk)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+def make_stub_server(directory, port=0, fail_first=0, delay=0.0, quiet=True, cut_off_first=0):
+    """
+    Returns a stub server serving the exports in directory; call
+    serve_forever() on it (port 0 picks a free port, see server_address).
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubExportHandler)
+    server.directory = directory
+    server.fail_first = fail_first
+    server.cut_off_first = cut_off_first
+    server.delay = delay
+    server.quiet = quiet
+    server.attempts = {}
+    server.lock = threading.Lock()
+    return server
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Serve plugin configuration exports from a directory, like the export endpoint')
+    parser.add_argument('--directory',
+                        type=str,
+                        help='directory holding <tenant>_plugin_configuration.json files',
+                        default='.',
+                        dest='directory')
+    parser.add_argument('--port',
+                        type=int,
+                        default=8765,
+                        dest='port')
+    parser.add_argument('--fail-first',
+                        type=int,
+                        help='answer the first N requests of each tenant with a 503',
+                        default=0,
+                        dest='fail_first')
+    parser.add_argument('--cut-off-first',
+                        type=int,
+                        help='then send only half of the export in the next N responses of each tenant',
+                        default=0,
+                        dest='cut_off_first')
+    parser.add_argument('--delay',
+                        type=float,
+                        help='seconds to wait before every response',
+                        default=0.0,
+                        dest='delay')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    server = make_stub_server(args.directory, args.port, args.fail_first,
+                              args.delay, quiet=False, cut_off_first=args.cut_off_first)
+    print('Serving {} on http://127.0.0.1:{}'.format(args.directory, server.server_address[1]))
+    server.serve_forever()
@@ -0,0 +1,371 @@
+"""
+Resumable batch conversion of plugin exports through a job spool on a shared
+directory.
+Enqueuing writes one job file per export into <spool>/pending. Workers, as
+many processes as wanted on this host or on any host that mounts the same
+directory, claim a job by renaming its file into <spool>/claimed (a rename
+is atomic, so exactly one worker gets each job), convert the export with
+convert_plugin_config and record the outcome in the manifest:
+    pending/<job>.json               waiting to be claimed
+    claimed/<job>.json.<host>.<pid>  being converted by that worker
+    done/<job>.json                  input sha256, output and its sha256,
+                                     worker, start and finish time
+    failed/<job>.json                input sha256, the error and traceback
+Every file is written under a temporary name and renamed into place, and the
+spreadsheet is written next to its final name and renamed too, so a worker
+that dies leaves no half-written file behind. Its claim stays in claimed/;
+claims of processes that are gone from this host, and claims older than
+--stale-after on any host, are put back in pending/ by the next worker.
+A job whose input sha256 and options match its done record (with the
+spreadsheet still in place) is skipped, both when enqueuing and when a worker
+claims it, so a batch that died halfway is resumed by enqueuing the same
+exports again and starting the workers: only what is left gets converted.
+Failed jobs are retried the next time they are enqueued.
+Usage:
+    python plugin_job_spool.py --spool /mnt/shared/spool --output-dir /mnt/shared/xlsx exports/*.json
+    python plugin_job_spool.py --spool /mnt/shared/spool --work --workers 4
+    python plugin_job_spool.py --spool /mnt/shared/spool --status
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import socket
+import time
+import traceback
+
+import xlsxwritertools
+from plugin_records import tenant_name
+from plugin_cache import file_sha256
+from TC_plugin_to_xlsx import (convert_plugin_config, condition_cache_info,
+                               condition_cache_stats_since, total_condition_cache_stats,
+                               format_condition_cache_stats)
+
+SPOOL_DIRS = ('pending', 'claimed', 'done', 'failed')
+# Claims older than this are assumed to belong to a worker that died
+DEFAULT_STALE_AFTER = 3600
+JOB_SUFFIX = '.json'
+
+
+def init_spool(spool_dir):
+    for name in SPOOL_DIRS:
+        os.makedirs(os.path.join(spool_dir, name), exist_ok=True)
+
+
+def job_id(input_fname):
+    """
+    Returns the job name of an export: its tenant and a short hash of its
+    path, so exports of the same tenant in different directories don't share
+    a job.
+    """
+    path_hash = hashlib.sha1(os.path.abspath(input_fname).encode('utf-8')).hexdigest()[:8]
+    return '{}-{}'.format(tenant_name(input_fname), path_hash)
+
+
+def _write_json(fname, data):
+    # Written to a temporary name first and moved into place, so nothing
+    # reading the spool ever sees half a file.
+    tmp_fname = '{}.{}.{}.tmp'.format(fname, socket.gethostname(), os.getpid())
+    with open(tmp_fname, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(tmp_fname, fname)
+
+
+def _read_json(fname):
+    try:
+        with open(fname) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _spool_path(spool_dir, state, name):
+    return os.path.join(spool_dir, state, name + JOB_SUFFIX)
+
+
+def is_done(spool_dir, job):
+    """
+    Tells whether a job has already been converted from the same input with
+    the same options, and its spreadsheet is still there.
+    """
+    record = _read_json(_spool_path(spool_dir, 'done', job['id']))
+    return (record is not None and record.get('input_sha256') == job['input_sha256']
+            and record.get('options') == job['options']
+            and os.path.exists(record.get('output', '')))
+
+
+def enqueue(spool_dir, input_fnames, output_dir, options=None):
+    """
+    Adds a job for every export that hasn't been converted in its current
+    state yet.
+    options: keyword arguments for convert_plugin_config (deterministic,
+        lint, profile, cache_dir)
+    Returns the ids of the jobs added and of the ones skipped as done.
+    """
+    init_spool(spool_dir)
+    options = dict(options or {})
+    added = []
+    skipped = []
+    for input_fname in input_fnames:
+        job = {'id': job_id(input_fname),
+               'input': os.path.abspath(input_fname),
+               'input_sha256': file_sha256(input_fname),
+               'output': os.path.abspath(os.path.join(
+                   output_dir, os.path.splitext(os.path.basename(input_fname))[0] + '.xlsx')),
+               'options': options,
+               'enqueued': time.time()}
+        if is_done(spool_dir, job):
+            skipped.append(job['id'])
+            continue
+        # A pending job for the same export is simply replaced; one that is
+        # claimed right now gets converted again afterwards.
+        _write_json(_spool_path(spool_dir, 'pending', job['id']), job)
+        added.append(job['id'])
+    return added, skipped
+
+
+def _claim_owner(claim_name):
+    # claimed/<job>.json.<host>.<pid>
+    host, _, pid = claim_name[claim_name.index(JOB_SUFFIX) + len(JOB_SUFFIX) + 1:].rpartition('.')
+    return host, int(pid) if pid.isdigit() else None
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def requeue_stale_claims(spool_dir, stale_after=DEFAULT_STALE_AFTER):
+    """
+    Puts the jobs of dead workers back in pending: claims by processes that
+    no longer exist on this host, and claims older than stale_after seconds.
+    Returns the ids of the jobs put back.
+    """
+    claimed_dir = os.path.join(spool_dir, 'claimed')
+    hostname = socket.gethostname()
+    requeued = []
+    for claim_name in sorted(os.listdir(claimed_dir)):
+        if JOB_SUFFIX + '.' not in claim_name:
+            continue
+        claim_fname = os.path.join(claimed_dir, claim_name)
+        host, pid = _claim_owner(claim_name)
+        try:
+            age = time.time() - os.stat(claim_fname).st_mtime
+        except FileNotFoundError:
+            continue
+        if (host == hostname and pid is not None and not _process_alive(pid)) or age > stale_after:
+            name = claim_name[:claim_name.index(JOB_SUFFIX)]
+            try:
+                os.rename(claim_fname, _spool_path(spool_dir, 'pending', name))
+            except FileNotFoundError:
+                continue  # finished or requeued by someone else meanwhile
+            requeued.append(name)
+    return requeued
+
+
+def claim_next_job(spool_dir):
+    """
+    Claims the first pending job no other worker has claimed first.
+    Returns the job and its claim file, or (None, None) when nothing is
+    pending.
+    """
+    pending_dir = os.path.join(spool_dir, 'pending')
+    suffix = '.{}.{}'.format(socket.gethostname(), os.getpid())
+    for name in sorted(os.listdir(pending_dir)):
+        if not name.endswith(JOB_SUFFIX):
+            continue
+        claim_fname = os.path.join(spool_dir, 'claimed', name + suffix)
+        try:
+            os.rename(os.path.join(pending_dir, name), claim_fname)
+        except FileNotFoundError:
+            continue  # another worker got there first
+        os.utime(claim_fname)  # the claim's age counts from now
+        job = _read_json(claim_fname)
+        if job is None:
+            os.remove(claim_fname)
+            continue
+        return job, claim_fname
+    return None, None
+
+
+def run_job(spool_dir, job):
+    """
+    Converts the export of a claimed job and records the outcome in done/
+    or failed/.
+    Returns 'done', 'skipped' or 'failed'.
+    """
+    worker = '{}.{}'.format(socket.gethostname(), os.getpid())
+    started = time.time()
+    record = {'id': job['id'], 'input': job['input'], 'output': job['output'],
+              'options': job['options'], 'worker': worker, 'started': started}
+    try:
+        # The export may have changed since it was enqueued; the record has
+        # the hash of what was actually converted.
+        job = dict(job, input_sha256=file_sha256(job['input']))
+        record['input_sha256'] = job['input_sha256']
+        if is_done(spool_dir, job):
+            return 'skipped'
+        os.makedirs(os.path.dirname(job['output']), exist_ok=True)
+        partial_fname = '{}.{}.partial.xlsx'.format(os.path.splitext(job['output'])[0], worker)
+        try:
+            record['output_sha256'] = convert_plugin_config(
+                job['input'], partial_fname, workers=1, **job['options'])
+            os.replace(partial_fname, job['output'])
+        finally:
+            if os.path.exists(partial_fname):
+                os.remove(partial_fname)
+    except Exception as e:
+        # Any error fails only this job; the worker carries on with the next
+        record.update(finished=time.time(), error='{}: {}'.format(e.__class__.__name__, e),
+                      traceback=traceback.format_exc())
+        _write_json(_spool_path(spool_dir, 'failed', job['id']), record)
+        return 'failed'
+    record['finished'] = time.time()
+    _write_json(_spool_path(spool_dir, 'done', job['id']), record)
+    try:
+        os.remove(_spool_path(spool_dir, 'failed', job['id']))
+    except FileNotFoundError:
+        pass
+    return 'done'
+
+
+def run_worker(spool_dir, stale_after=DEFAULT_STALE_AFTER, quiet=False):
+    """
+    Drains the spool: claims and runs jobs until none are pending.
+    Returns a dictionary of outcome -> number of jobs, and the
+    ConditionCacheStats of the conversions this worker ran.
+    """
+    init_spool(spool_dir)
+    cache_before = condition_cache_info()
+    counts = {'done': 0, 'skipped': 0, 'failed': 0}
+    requeue_stale_claims(spool_dir, stale_after)
+    while True:
+        job, claim_fname = claim_next_job(spool_dir)
+        if job is None:
+            break
+        start = time.perf_counter()
+        outcome = run_job(spool_dir, job)
+        try:
+            os.remove(claim_fname)
+        except FileNotFoundError:
+            pass  # taken for stale and requeued while the job ran
+        counts[outcome] += 1
+        if not quiet:
+            print('{} {} {} ({:.0f} ms)'.format(
+                os.getpid(), outcome, job['id'], (time.perf_counter() - start) * 1000))
+    return counts, condition_cache_stats_since(cache_before)
+
+
+def run_workers(spool_dir, workers, stale_after=DEFAULT_STALE_AFTER):
+    """
+    Drains the spool with several worker processes on this host.
+    Returns the total of each outcome and the ConditionCacheStats of all the
+    workers added up.
+    """
+    if workers <= 1:
+        return run_worker(spool_dir, stale_after)
+    # Stale claims are requeued once up front, so the workers don't race
+    # each other for them.
+    init_spool(spool_dir)
+    requeue_stale_claims(spool_dir, stale_after)
+    with multiprocessing.Pool(workers) as pool:
+        results = pool.starmap(run_worker, [(spool_dir, stale_after)] * workers)
+    totals = {outcome: sum(counts[outcome] for counts, _ in results) for outcome in results[0][0]}
+    return totals, total_condition_cache_stats(cache_stats for _, cache_stats in results)
+
+
+def spool_status(spool_dir):
+    """
+    Returns the number of jobs in each state and the failed job records.
+    """
+    counts = {}
+    for state in SPOOL_DIRS:
+        state_dir = os.path.join(spool_dir, state)
+        names = os.listdir(state_dir) if os.path.isdir(state_dir) else []
+        counts[state] = sum(1 for name in names if not name.endswith('.tmp'))
+    failed_dir = os.path.join(spool_dir, 'failed')
+    failures = [_read_json(os.path.join(failed_dir, name))
+                for name in sorted(os.listdir(failed_dir))
+                if name.endswith(JOB_SUFFIX)] if os.path.isdir(failed_dir) else []
+    return counts, [record for record in failures if record]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Convert plugin exports through a job spool that several workers and hosts can drain')
+    parser.add_argument('inputs',
+                        nargs='*',
+                        help='plugin configuration JSON files to enqueue (unchanged, already converted ones are skipped)')
+    parser.add_argument('--spool',
+                        type=str,
+                        help='the spool directory, shared by every worker',
+                        required=True,
+                        dest='spool')
+    parser.add_argument('--output-dir',
+                        type=str,
+                        help='directory for the spreadsheets of the enqueued exports (default: next to each export)',
+                        required=False,
+                        dest='output_dir')
+    parser.add_argument('--work',
+                        action='store_true',
+                        help='convert pending jobs until the spool is empty',
+                        dest='work')
+    parser.add_argument('--workers',
+                        type=int,
+                        help='number of worker processes on this host (default 1)',
+                        default=1,
+                        dest='workers')
+    parser.add_argument('--stale-after',
+                        type=int,
+                        help='seconds after which a claim is assumed abandoned (default {})'.format(
+                            DEFAULT_STALE_AFTER),
+                        default=DEFAULT_STALE_AFTER,
+                        dest='stale_after')
+    parser.add_argument('--status',
+                        action='store_true',
+                        help='print the number of jobs in each state and the failures',
+                        dest='status')
+    parser.add_argument('--profile',
+                        choices=sorted(xlsxwritertools.OUTPUT_PROFILES),
+                        help='output profile of the spreadsheets (see TC_plugin_to_xlsx.py --profile)',
+                        default='default',
+                        dest='profile')
+    parser.add_argument('--deterministic',
+                        action='store_true',
+                        help='write byte-identical spreadsheets for identical exports',
+                        dest='deterministic')
+    parser.add_argument('--lint',
+                        action='store_true',
+                        help='add a Findings sheet to the spreadsheets',
+                        dest='lint')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.inputs:
+        options = {'deterministic': args.deterministic, 'lint': args.lint, 'profile': args.profile}
+        by_dir = {}
+        for fname in args.inputs:
+            by_dir.setdefault(args.output_dir or os.path.dirname(os.path.abspath(fname)), []).append(fname)
+        for output_dir, fnames in by_dir.items():
+            added, skipped = enqueue(args.spool, fnames, output_dir, options)
+            print('enqueued {} jobs, {} already done'.format(len(added), len(skipped)))
+    if args.work:
+        start = time.perf_counter()
+        counts, cache_stats = run_workers(args.spool, args.workers, args.stale_after)
+        print('{} done, {} skipped, {} failed in {:.1f} s'.format(
+            counts['done'], counts['skipped'], counts['failed'], time.perf_counter() - start))
+        print(format_condition_cache_stats(cache_stats))
+    if args.status:
+        counts, failures = spool_status(args.spool)
+        print(', '.join('{} {}'.format(count, state) for state, count in counts.items()))
+        for record in failures:
+            print('failed {}: {}'.format(record['id'], record['error']))
@@ -0,0 +1,300 @@
+"""
+Linter for plugin configuration exports.
+Checks an export for settings that are likely mistakes before it gets rendered:
+field mappings enabled both ways with different omit-if-empty flags, polling
+that is too aggressive for the API call threshold, conditions on fields that
+aren't mapped, and fields mapped more than once.
+The rules run against a TypeIndex per plugin type. An index is built in a
+single pass over the type's FieldMappingRow records (from get_mappings_dict),
+and the mapping rules are run in that same pass, so every rule is evaluated
+without walking the mappings again. Rules are registered with the
+mapping_rule, type_rule and plugin_rule decorators:
+    @type_rule
+    def my_rule(index):
+        if ...:
+            yield Finding('warning', 'my-rule', index.label, '', 'message')
+Findings can be written as JSON (--json) or as a 'Findings' sheet (--xlsx, or
+--lint in TC_plugin_to_xlsx.py).
+Usage:
+    python plugin_linter.py exports/*_plugin_configuration.json --json findings.json
+"""
+import argparse
+import json
+from typing import NamedTuple
+
+import xlsxwritertools
+from plugin_records import (MappingFlags, read_plugin_json, get_mappings_dict, TEMPLATE_FIELD,
+                            iter_condition_block)
+from plugin_cache import load_plugin_config
+
+SEVERITIES = ('error', 'warning', 'info')
+# Polling faster than this is reported even when the API budget allows it
+MIN_POLLING_INTERVAL_MINUTES = 5
+# Share of GlobalAPICallThreshold that polling alone may use up in a day
+POLLING_BUDGET_SHARE = 0.1
+MINUTES_PER_DAY = 24 * 60
+
+mapping_rules = []
+type_rules = []
+plugin_rules = []
+
+
+def mapping_rule(func):
+    """
+    Registers a rule run for every field mapping: func(index, row).
+    """
+    mapping_rules.append(func)
+    return func
+
+
+def type_rule(func):
+    """
+    Registers a rule run once per plugin type: func(index).
+    """
+    type_rules.append(func)
+    return func
+
+
+def plugin_rule(func):
+    """
+    Registers a rule run once per export: func(limits, indexes).
+    """
+    plugin_rules.append(func)
+    return func
+
+
+class Finding(NamedTuple):
+    severity: str
+    rule: str
+    plugin_type: str
+    field: str
+    message: str
+
+
+def iter_condition_fields(block):
+    """
+    Yields the Field of every condition in a Conditions/ConditionGroups block.
+    """
+    return (field for _, _, field, _, _ in iter_condition_block(block))
+
+
+class TypeIndex():
+    def __init__(self, typename, type_data):
+        """
+        Lookups for one plugin type, built in one pass over its mappings.
+        typename: (ExternalType, InternalType) tuple
+        type_data: the type's entry in the types dictionary of get_mappings_dict
+        """
+        self.typename = typename
+        self.label = '-'.join(typename)
+        self.ptype = type_data['input']
+        self.stats = type_data['stats']
+        self.rows = type_data['field_mappings']
+        # internal field -> its mappings, templated mappings left out
+        self.internal_rows = {}
+        self.internal_fields = set()
+        self.external_fields = set()
+        # (condition setting, field) for the fields the type's conditions use
+        self.condition_fields = list(dict.fromkeys(
+            (key, field)
+            for key, value in self.ptype.items()
+            if 'Conditions' in key and value
+            for field in iter_condition_fields(value)))
+
+    def build(self, findings):
+        """
+        Fills the lookups and runs the mapping rules in the same pass.
+        """
+        for row in self.rows:
+            if row.internal_field != TEMPLATE_FIELD:
+                self.internal_rows.setdefault(row.internal_field, []).append(row)
+            self.internal_fields.add(row.internal_field)
+            self.external_fields.add(row.external_field)
+            for rule in mapping_rules:
+                findings.extend(rule(self, row))
+        return self
+
+
+@mapping_rule
+def conflicting_omit_flags(index, row):
+    both_ways = MappingFlags.INBOUND_ENABLED | MappingFlags.OUTBOUND_ENABLED
+    if row.flags & both_ways != both_ways:
+        return
+    if row.inbound_omit_if_empty != row.outbound_omit_if_empty:
+        yield Finding('warning', 'conflicting-omit-flags', index.label,
+                      row.display_internal_field,
+                      'mapped both ways, but only {} skips empty values'.format(
+                          'inbound' if row.inbound_omit_if_empty else 'outbound'))
+
+
+@type_rule
+def duplicate_internal_field(index):
+    # Mapping a field twice is only a conflict when both mappings sync it in
+    # the same direction; one inbound and one outbound mapping is a pattern.
+    for field, rows in index.internal_rows.items():
+        if len(rows) < 2:
+            continue
+        inbound = sum(1 for row in rows if row.inbound_enabled)
+        outbound = sum(1 for row in rows if row.outbound_enabled)
+        externals = ', '.join(row.external_field for row in rows)
+        if inbound > 1 or outbound > 1:
+            yield Finding('error', 'duplicate-internal-field', index.label, field,
+                          'mapped {} times ({}), {} inbound and {} outbound enabled'.format(
+                              len(rows), externals, inbound, outbound))
+        else:
+            yield Finding('info', 'duplicate-internal-field', index.label, field,
+                          'mapped {} times ({})'.format(len(rows), externals))
+
+
+@type_rule
+def condition_field_not_mapped(index):
+    mapped = index.internal_fields | index.external_fields
+    for key, field in index.condition_fields:
+        if field not in mapped:
+            yield Finding('info', 'condition-field-not-mapped', index.label, field,
+                          '{} uses a field that has no field mapping'.format(key))
+
+
+@type_rule
+def aggressive_polling(index):
+    if index.stats.polling_enabled and _polling_interval(index) < MIN_POLLING_INTERVAL_MINUTES:
+        yield Finding('info', 'aggressive-polling', index.label, '',
+                      'polls every {} min (less than {} min)'.format(
+                          index.stats.polling_interval, MIN_POLLING_INTERVAL_MINUTES))
+
+
+def _polling_interval(index):
+    try:
+        return max(float(index.stats.polling_interval), 1.0)
+    except (TypeError, ValueError):
+        return float(MINUTES_PER_DAY)
+
+
+@plugin_rule
+def polling_over_api_budget(limits, indexes):
+    threshold = limits.get('GlobalAPICallThreshold')
+    if not threshold:
+        return
+    # At least one API call per poll of each type
+    polls_per_day = {index.label: MINUTES_PER_DAY / _polling_interval(index)
+                     for index in indexes if index.stats.polling_enabled}
+    total = sum(polls_per_day.values())
+    budget = threshold * POLLING_BUDGET_SHARE
+    if total > budget:
+        busiest = max(polls_per_day, key=polls_per_day.get)
+        yield Finding('warning', 'polling-over-api-budget', busiest, '',
+                      'polling makes at least {:,.0f} calls a day, over {:.0%} of '
+                      'GlobalAPICallThreshold ({:,})'.format(
+                          total, POLLING_BUDGET_SHARE, threshold))
+
+
+def lint_plugin_config(limits, type_names, types):
+    """
+    Runs every rule against a parsed export.
+    limits, type_names, types: what get_mappings_dict returns
+    Returns a list of Findings, most severe first.
+    """
+    findings = []
+    indexes = []
+    for typename in type_names:
+        index = TypeIndex(typename, types[typename]).build(findings)
+        for rule in type_rules:
+            findings.extend(rule(index))
+        indexes.append(index)
+    for rule in plugin_rules:
+        findings.extend(rule(limits, indexes))
+    findings.sort(key=lambda finding: SEVERITIES.index(finding.severity))
+    return findings
+
+
+def lint_file(fname, cache_dir=None):
+    if cache_dir:
+        limits, type_names, types = load_plugin_config(fname, cache_dir)
+    else:
+        limits, type_names, types = get_mappings_dict(read_plugin_json(fname))
+    return lint_plugin_config(limits, type_names, types)
+
+
+col_dict_findings = {0: {"label": "Severity", "width": 10, "style": "text_style"},
+                     1: {"label": "Rule", "width": 28, "style": "text_style"},
+                     2: {"label": "Plugin Type", "width": 30, "style": "text_style"},
+                     3: {"label": "Field", "width": 24, "style": "text_style"},
+                     4: {"label": "Message", "width": 70, "style": "text_style"},
+                     }
+
+
+def write_findings_sheet(wb, findings, sheet_name='Findings', sheet_links=None):
+    """
+    Adds a sheet listing the findings.
+    wb: an XLSXWorkbook
+    sheet_links: optional dictionary of plugin type label -> sheet name, to
+        link the Plugin Type column to the type's sheet. Labels that aren't in
+        it stay plain text.
+    """
+    sheet_links = sheet_links or {}
+    # The linked labels are left blank here and written as links below; the
+    # findings are short enough to take one row each.
+    rows = [finding._replace(plugin_type=None) if finding.plugin_type in sheet_links else finding
+            for finding in findings]
+    sheet = wb.get_new_worksheet(sheet_name)
+    wb.fill_sheet(sheet, col_dict_findings, rows)
+    for row, finding in enumerate(findings, 1):
+        if finding.plugin_type in sheet_links:
+            sheet.write_url(row, 2, **xlsxwritertools.internal_link(
+                sheet_links[finding.plugin_type], finding.plugin_type))
+    return sheet
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Check plugin configuration JSON exports for likely mistakes')
+    parser.add_argument('inputs',
+                        nargs='+',
+                        help='plugin configuration JSON files to lint')
+    parser.add_argument('--json',
+                        type=str,
+                        help='write the findings to this JSON file ("-" for stdout)',
+                        required=False,
+                        dest='json')
+    parser.add_argument('--xlsx',
+                        type=str,
+                        help='write the findings to a spreadsheet with a Findings sheet',
+                        required=False,
+                        dest='xlsx')
+    parser.add_argument('--cache-dir',
+                        type=str,
+                        help='directory of compiled plugin caches to load the inputs from (see plugin_cache.py)',
+                        required=False,
+                        dest='cache_dir')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = {fname: lint_file(fname, args.cache_dir) for fname in args.inputs}
+    if args.json:
+        data = [{'file': fname, 'findings': [finding._asdict() for finding in findings]}
+                for fname, findings in results.items()]
+        if args.json == '-':
+            print(json.dumps(data, indent=1))
+        else:
+            with open(args.json, 'w') as f:
+                json.dump(data, f, indent=1)
+    if args.xlsx:
+        wb = xlsxwritertools.XLSXWorkbook(args.xlsx)
+        findings = [Finding(finding.severity, finding.rule,
+                            '{}: {}'.format(fname, finding.plugin_type),
+                            finding.field, finding.message)
+                    for fname, file_findings in results.items()
+                    for finding in file_findings]
+        write_findings_sheet(wb, findings)
+        wb.close_workbook()
+    for fname, findings in results.items():
+        if args.json == '-':
+            break
+        counts = {severity: 0 for severity in SEVERITIES}
+        for finding in findings:
+            counts[finding.severity] += 1
+        print('{}: {}'.format(fname, ', '.join(
+            '{} {}'.format(count, severity) for severity, count in counts.items())))
@@ -0,0 +1,259 @@
+"""
+Compact record types for plugin configuration data.
+A plugin export holds every field mapping as a JSON dictionary with a dozen
+keys, most of them booleans. Keeping thousands of those dictionaries around
+(one set per tenant) is wasteful, and turning them into positional lists makes
+for index-based bugs. FieldMappingRow keeps one mapping in a NamedTuple: the
+field names are interned, since the same names repeat across plugin types and
+tenants, and the boolean settings are packed into a single MappingFlags int.
+Example:
+    row = FieldMappingRow.from_dict({'InternalField': 'first_name',
+                                     'ExternalField': 'FirstName',
+                                     'InboundEnabled': True,
+                                     'OutboundEnabled': False})
+    row.inbound_enabled   # True
+    row.to_dict()         # back to the plugin JSON keys
+"""
+import json
+import os
+import sys
+from enum import IntFlag
+from typing import NamedTuple
+
+
+class MappingFlags(IntFlag):
+    INBOUND_ENABLED = 1
+    OUTBOUND_ENABLED = 2
+    INBOUND_OMIT_IF_EMPTY = 4
+    OUTBOUND_OMIT_IF_EMPTY = 8
+    MAPPED_FIELD = 16
+    LOOK_FOR_NAME_INSTEAD_OF_ID = 32
+    DISPLAY_NAME_INSTEAD_OF_ID = 64
+
+
+# Plugin JSON key for each of the flags, in the order they appear in an export
+flag_keys = {
+    "MappedField": MappingFlags.MAPPED_FIELD,
+    "LookForNameInsteadOfID": MappingFlags.LOOK_FOR_NAME_INSTEAD_OF_ID,
+    "DisplayNameInsteadOfID": MappingFlags.DISPLAY_NAME_INSTEAD_OF_ID,
+    "InboundEnabled": MappingFlags.INBOUND_ENABLED,
+    "OutboundOmitIfEmpty": MappingFlags.OUTBOUND_OMIT_IF_EMPTY,
+    "InboundOmitIfEmpty": MappingFlags.INBOUND_OMIT_IF_EMPTY,
+    "OutboundEnabled": MappingFlags.OUTBOUND_ENABLED,
+}
+
+
+def intern_value(value):
+    """
+    Interns a string so that repeated field names share one object. Anything
+    that isn't a string is returned untouched.
+    """
+    if isinstance(value, str):
+        return sys.intern(value)
+    return value
+
+
+# The internal field of templated mappings (see display_internal_field)
+TEMPLATE_FIELD = '__TEMPLATE__'
+
+
+class FieldMappingRow(NamedTuple):
+    internal_field: str
+    external_field: str
+    internal_default: str
+    external_default: str
+    external_mapped_type: str
+    template: str
+    flags: int
+
+    @classmethod
+    def from_dict(cls, fm):
+        """
+        Builds a row from one entry of a plugin type's FieldMappings list.
+        fm: the field mapping dictionary from the plugin JSON
+        """
+        flags = 0
+        for key, flag in flag_keys.items():
+            if fm.get(key):
+                flags |= flag
+        return cls(
+            intern_value(fm.get('InternalField', '')),
+            intern_value(fm.get('ExternalField', '')),
+            fm.get('InternalDefault', ''),
+            fm.get('ExternalDefault', ''),
+            intern_value(fm.get('ExternalMappedType', '')),
+            fm.get('Template', ''),
+            int(flags),
+        )
+
+    def to_dict(self):
+        """
+        Returns the row as a plugin JSON field mapping. Optional keys that
+        were absent from the export are left out again.
+        """
+        fm = {'InternalField': self.internal_field,
+              'ExternalField': self.external_field}
+        if self.internal_default:
+            fm['InternalDefault'] = self.internal_default
+        if self.external_default:
+            fm['ExternalDefault'] = self.external_default
+        if self.external_mapped_type:
+            fm['ExternalMappedType'] = self.external_mapped_type
+        if self.template:
+            fm['Template'] = self.template
+        for key, flag in flag_keys.items():
+            fm[key] = bool(self.flags & flag)
+        return fm
+
+    def has_flag(self, flag):
+        return bool(self.flags & flag)
+
+    @property
+    def display_internal_field(self):
+        """
+        Templated mappings have TEMPLATE_FIELD as their internal field; the
+        template itself is what's worth showing.
+        """
+        return self.template or self.internal_field
+
+    @property
+    def inbound_enabled(self):
+        return bool(self.flags & MappingFlags.INBOUND_ENABLED)
+
+    @property
+    def outbound_enabled(self):
+        return bool(self.flags & MappingFlags.OUTBOUND_ENABLED)
+
+    @property
+    def inbound_omit_if_empty(self):
+        return bool(self.flags & MappingFlags.INBOUND_OMIT_IF_EMPTY)
+
+    @property
+    def outbound_omit_if_empty(self):
+        return bool(self.flags & MappingFlags.OUTBOUND_OMIT_IF_EMPTY)
+
+    @property
+    def mapped_field(self):
+        return bool(self.flags & MappingFlags.MAPPED_FIELD)
+
+    @property
+    def look_for_name_instead_of_id(self):
+        return bool(self.flags & MappingFlags.LOOK_FOR_NAME_INSTEAD_OF_ID)
+
+    @property
+    def display_name_instead_of_id(self):
+        return bool(self.flags & MappingFlags.DISPLAY_NAME_INSTEAD_OF_ID)
+
+
+class TypeStats(NamedTuple):
+    """
+    Summary counts for one plugin type, gathered while its field mappings are
+    turned into FieldMappingRow records.
+    """
+    field_mappings: int
+    inbound_fields: int
+    outbound_fields: int
+    condition_blocks: int
+    polling_enabled: bool
+    polling_interval: object
+
+
+def count_condition_blocks(ptype):
+    """
+    Counts the non-empty condition settings (PollingConditions,
+    InboundCreateConditions, ...) of a plugin type.
+    ptype: one entry of the plugin's PluginTypeMappings list
+    """
+    return sum(1 for key, value in ptype.items()
+               if 'Conditions' in key and value)
+
+
+def iter_condition_block(block, group_path=''):
+    """
+    Flattens a Conditions/ConditionGroups block.
+    Yields (group_path, logical_operator, field, comparison_operator, value)
+    for every condition, group_path being '' for the top level and the
+    dotted positions of the nested groups otherwise.
+    """
+    operator = block.get('LogicalOperator')
+    for condition in block.get('Conditions', ()):
+        yield (group_path, operator, condition.get('Field'),
+               condition.get('ComparisonOperator'), condition.get('Value'))
+    for i, group in enumerate(block.get('ConditionGroups', ())):
+        yield from iter_condition_block(group, '{}.{}'.format(group_path, i) if group_path else str(i))
+
+
+def build_field_mapping_rows_and_stats(ptype):
+    """
+    Turns the FieldMappings of a plugin type into FieldMappingRow records and
+    counts the type's summary stats in the same pass.
+    ptype: one entry of the plugin's PluginTypeMappings list
+    Returns a (rows, TypeStats) tuple.
+    """
+    rows = []
+    inbound = outbound = 0
+    for fm in ptype['FieldMappings']:
+        row = FieldMappingRow.from_dict(fm)
+        if row.flags & MappingFlags.INBOUND_ENABLED:
+            inbound += 1
+        if row.flags & MappingFlags.OUTBOUND_ENABLED:
+            outbound += 1
+        rows.append(row)
+    stats = TypeStats(
+        len(rows),
+        inbound,
+        outbound,
+        count_condition_blocks(ptype),
+        bool(ptype.get('PollingEnabled', False)),
+        ptype.get('PollingIntervalMinutes', ''),
+    )
+    return tuple(rows), stats
+
+
+def read_plugin_json(fname="sage_plugin_configuration.json"):
+    """
+    Helper function to load a plugin config json file.
+    """
+    with open(fname, 'r') as f:
+        plugin_data = json.load(f)
+    return plugin_data
+
+
+def tenant_name(fname):
+    """
+    Returns the tenant of an export from its file name, e.g. 'sage' for
+    sage_plugin_configuration.json.
+    """
+    name = os.path.basename(fname)
+    for suffix in ('_plugin_configuration.json', '.json'):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def get_mappings_dict(plugin_data):
+    """
+    Identifies the plugin types and the fields associated with the types.
+    The field mappings of each type are kept as FieldMappingRow records, and
+    the summary stats for the Index sheet are counted in the same pass.
+    plugin_data: the plugin JSON, as returned by read_plugin_json
+    plugin_data isn't modified.
+    Returns the limits (the plugin-level settings), the list of type names,
+    i.e. (ExternalType, InternalType) tuples, and a dictionary of the type
+    data keyed by type name.
+    """
+    ptype_mappings = plugin_data['Legacy'].get('PluginTypeMappings', [])
+    types = {}
+    type_names = []
+    for ptype in ptype_mappings:
+        if ptype['InternalType'] == 'MessengerGroup':  # Ignore MessengerGroup object
+            continue
+        # name = str(ptype['ExternalType'])+'-'+str(ptype['InternalType'])
+        name = (ptype['ExternalType'], ptype['InternalType'])
+        type_names.append(name)
+        field_mappings, stats = build_field_mapping_rows_and_stats(ptype)
+        types[name] = {"output": {}, "input": ptype,
+                       "field_mappings": field_mappings, "stats": stats}
+    limits = {key: value for key, value in plugin_data['Legacy'].items()
+              if key != 'PluginTypeMappings'}
+    return limits, type_names, types
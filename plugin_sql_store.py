@@ -0,0 +1,335 @@
+"""
+Persistent SQLite store of many tenants' plugin configuration exports, for
+answering questions across tenants with SQL instead of re-parsing JSON.
+Ingesting an export replaces everything stored for its tenant in one
+transaction. The sha256 of every ingested file is kept in the files table,
+so ingesting the same exports again only touches the ones that changed.
+Tables (every table has a tenant column; type_id refers to plugin_types):
+    files           tenant, path, sha256, ingested_at
+    limits          tenant, key, value: the plugin-level settings
+    plugin_types    type_id, tenant, external_type, internal_type, the polling
+                    and sync settings, and settings (the other settings as JSON)
+    field_mappings  type_id, tenant, internal_field, external_field, defaults,
+                    external_mapped_type, template and one 0/1 column per flag
+    conditions      type_id, tenant, block (e.g. OutboundCreateConditions),
+                    group_path ('' for the block's own conditions, '0', '0.1',
+                    ... for nested ConditionGroups), logical_operator, field,
+                    comparison_operator, value
+The field and tenant columns are indexed, so lookups like "which tenants push
+custom35 outbound" stay in the milliseconds however many tenants are stored:
+    SELECT DISTINCT tenant FROM field_mappings
+    WHERE internal_field = 'custom35' AND outbound_enabled
+Usage:
+    python plugin_sql_store.py exports/*_plugin_configuration.json --db plugins.sqlite
+    python plugin_sql_store.py --db plugins.sqlite --outbound-field custom35
+    python plugin_sql_store.py --db plugins.sqlite --query "SELECT tenant, value FROM limits WHERE key = 'Provider'"
+"""
+import argparse
+import json
+import os
+import sqlite3
+import time
+
+from plugin_records import flag_keys, read_plugin_json, get_mappings_dict, iter_condition_block, tenant_name
+from plugin_cache import file_sha256
+
+DEFAULT_DB = 'plugins.sqlite'
+SCHEMA_VERSION = 1
+
+# plugin_types column -> plugin JSON key
+type_setting_columns = {
+    'polling_enabled': 'PollingEnabled',
+    'polling_interval': 'PollingIntervalMinutes',
+    'merge_delete_enabled': 'MergeAndDeletePollingEnabled',
+    'merge_delete_interval': 'MergeAndDeletePollingFrequencyMinutes',
+    'inbound_create': 'InboundCreateEnabled',
+    'inbound_update': 'InboundUpdateEnabled',
+    'outbound_create': 'OutboundCreateEnabled',
+    'outbound_update': 'OutboundUpdateEnabled',
+}
+# field_mappings column -> plugin JSON flag key
+flag_columns = {
+    'mapped_field': 'MappedField',
+    'look_for_name_instead_of_id': 'LookForNameInsteadOfID',
+    'display_name_instead_of_id': 'DisplayNameInsteadOfID',
+    'inbound_enabled': 'InboundEnabled',
+    'outbound_omit_if_empty': 'OutboundOmitIfEmpty',
+    'inbound_omit_if_empty': 'InboundOmitIfEmpty',
+    'outbound_enabled': 'OutboundEnabled',
+}
+
+schema = """
+CREATE TABLE IF NOT EXISTS files (
+    tenant TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    ingested_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS limits (
+    tenant TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value,
+    PRIMARY KEY (tenant, key)
+);
+CREATE TABLE IF NOT EXISTS plugin_types (
+    type_id INTEGER PRIMARY KEY,
+    tenant TEXT NOT NULL,
+    external_type TEXT NOT NULL,
+    internal_type TEXT NOT NULL,
+    {type_columns},
+    settings TEXT
+);
+CREATE TABLE IF NOT EXISTS field_mappings (
+    type_id INTEGER NOT NULL REFERENCES plugin_types (type_id),
+    tenant TEXT NOT NULL,
+    internal_field TEXT NOT NULL,
+    external_field TEXT NOT NULL,
+    internal_default TEXT,
+    external_default TEXT,
+    external_mapped_type TEXT,
+    template TEXT,
+    {flag_columns}
+);
+CREATE TABLE IF NOT EXISTS conditions (
+    type_id INTEGER NOT NULL REFERENCES plugin_types (type_id),
+    tenant TEXT NOT NULL,
+    block TEXT NOT NULL,
+    group_path TEXT NOT NULL,
+    logical_operator TEXT,
+    field TEXT,
+    comparison_operator TEXT,
+    value TEXT
+);
+CREATE INDEX IF NOT EXISTS plugin_types_tenant ON plugin_types (tenant);
+CREATE INDEX IF NOT EXISTS plugin_types_external_type ON plugin_types (external_type);
+CREATE INDEX IF NOT EXISTS field_mappings_tenant ON field_mappings (tenant);
+CREATE INDEX IF NOT EXISTS field_mappings_internal_field ON field_mappings (internal_field);
+CREATE INDEX IF NOT EXISTS field_mappings_external_field ON field_mappings (external_field);
+CREATE INDEX IF NOT EXISTS field_mappings_type_id ON field_mappings (type_id);
+CREATE INDEX IF NOT EXISTS conditions_tenant ON conditions (tenant);
+CREATE INDEX IF NOT EXISTS conditions_field ON conditions (field);
+CREATE INDEX IF NOT EXISTS conditions_type_id ON conditions (type_id);
+""".format(type_columns=',\n    '.join('{} {}'.format(column, 'INTEGER' if column.endswith(('enabled', 'create', 'update')) else 'NUMERIC')
+                                       for column in type_setting_columns),
+           flag_columns=',\n    '.join('{} INTEGER NOT NULL'.format(column) for column in flag_columns))
+
+
+def open_store(db_fname=DEFAULT_DB):
+    """
+    Opens (creating it if needed) a plugin store.
+    Returns a sqlite3 connection.
+    """
+    conn = sqlite3.connect(db_fname)
+    # Each ingested file is its own transaction; WAL keeps those commits cheap
+    # and lets queries run while another process ingests.
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version not in (0, SCHEMA_VERSION):
+        conn.close()
+        raise ValueError('{} has schema version {}, expected {}; ingest into a new file'.format(
+            db_fname, version, SCHEMA_VERSION))
+    conn.executescript(schema)
+    conn.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+    conn.commit()
+    return conn
+
+
+def _sql_value(value):
+    # SQLite takes scalars as they are; lists and dictionaries are kept as JSON
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, sort_keys=True)
+    return value
+
+
+def iter_conditions(block):
+    """
+    The conditions of a Conditions/ConditionGroups block, as
+    iter_condition_block yields them, with the values as they are stored.
+    """
+    for group_path, operator, field, comparison, value in iter_condition_block(block):
+        yield group_path, operator, field, comparison, _sql_value(value)
+
+
+def remove_tenant(conn, tenant):
+    """
+    Deletes everything stored for a tenant (within the caller's transaction).
+    """
+    for table in ('conditions', 'field_mappings', 'plugin_types', 'limits', 'files'):
+        conn.execute('DELETE FROM {} WHERE tenant = ?'.format(table), (tenant,))
+
+
+def _insert_plugin(conn, tenant, plugin_data):
+    limits, type_names, types = get_mappings_dict(plugin_data)
+    conn.executemany('INSERT INTO limits (tenant, key, value) VALUES (?, ?, ?)',
+                     [(tenant, key, _sql_value(value)) for key, value in limits.items()])
+    type_columns = list(type_setting_columns)
+    insert_type = 'INSERT INTO plugin_types (tenant, external_type, internal_type, {}, settings) VALUES ({})'.format(
+        ', '.join(type_columns), ', '.join('?' * (len(type_columns) + 4)))
+    insert_mapping = ('INSERT INTO field_mappings (type_id, tenant, internal_field, external_field, '
+                      'internal_default, external_default, external_mapped_type, template, {}) '
+                      'VALUES ({})').format(', '.join(flag_columns), ', '.join('?' * (len(flag_columns) + 8)))
+    flags = [flag_keys[key] for key in flag_columns.values()]
+    for typename in type_names:
+        ptype = types[typename]['input']
+        other_settings = {key: value for key, value in ptype.items()
+                          if key not in ('ExternalType', 'InternalType', 'FieldMappings')
+                          and key not in type_setting_columns.values() and 'Conditions' not in key}
+        type_id = conn.execute(insert_type, [tenant, typename[0], typename[1]] +
+                               [_sql_value(ptype.get(key)) for key in type_setting_columns.values()] +
+                               [json.dumps(other_settings, sort_keys=True)]).lastrowid
+        conn.executemany(insert_mapping, [
+            (type_id, tenant, row.internal_field, row.external_field, row.internal_default,
+             row.external_default, row.external_mapped_type, row.template) +
+            tuple(int(bool(row.flags & flag)) for flag in flags)
+            for row in types[typename]['field_mappings']])
+        conn.executemany(
+            'INSERT INTO conditions (type_id, tenant, block, group_path, logical_operator, field, '
+            'comparison_operator, value) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            [(type_id, tenant, key) + condition
+             for key, value in ptype.items() if 'Conditions' in key and isinstance(value, dict)
+             for condition in iter_conditions(value)])
+
+
+def ingest_file(conn, fname, tenant=None):
+    """
+    Loads an export into the store unless the stored copy has the same
+    sha256.
+    tenant: the name to store it under (defaults to the file name, see
+        plugin_records.tenant_name)
+    Returns True if the tenant was (re)loaded, False if it was current.
+    """
+    tenant = tenant or tenant_name(fname)
+    sha256 = file_sha256(fname)
+    stored = conn.execute('SELECT sha256 FROM files WHERE tenant = ?', (tenant,)).fetchone()
+    if stored and stored[0] == sha256:
+        return False
+    plugin_data = read_plugin_json(fname)
+    with conn:
+        remove_tenant(conn, tenant)
+        _insert_plugin(conn, tenant, plugin_data)
+        conn.execute('INSERT INTO files (tenant, path, sha256, ingested_at) VALUES (?, ?, ?, ?)',
+                     (tenant, os.path.abspath(fname), sha256, time.time()))
+    return True
+
+
+def ingest_files(conn, fnames):
+    """
+    Ingests several exports. A file that isn't a plugin export is left out
+    (its tenant keeps what was stored before) and the others still go in.
+    Returns the tenants that were (re)loaded and a list of (file, error) for
+    the files that couldn't be ingested.
+    """
+    loaded = []
+    failed = []
+    for fname in fnames:
+        try:
+            if ingest_file(conn, fname):
+                loaded.append(tenant_name(fname))
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            failed.append((fname, '{}: {}'.format(e.__class__.__name__, e)))
+    return loaded, failed
+
+
+def prune_tenants(conn, keep):
+    """
+    Removes the tenants that aren't in keep. Returns the removed tenants.
+    """
+    removed = [tenant for (tenant,) in conn.execute('SELECT tenant FROM files')
+               if tenant not in keep]
+    with conn:
+        for tenant in removed:
+            remove_tenant(conn, tenant)
+    return removed
+
+
+def tenants_syncing_field(conn, field, direction='outbound'):
+    """
+    Returns (tenant, external_type, internal_type, internal_field,
+    external_field) for every mapping of a field (Outreach or CRM name)
+    enabled in the given direction ('inbound' or 'outbound').
+    """
+    if direction not in ('inbound', 'outbound'):
+        raise ValueError('direction must be inbound or outbound, not {!r}'.format(direction))
+    query = """
+        SELECT fm.tenant, pt.external_type, pt.internal_type, fm.internal_field, fm.external_field
+        FROM field_mappings fm JOIN plugin_types pt USING (type_id)
+        WHERE fm.{0}_enabled AND fm.internal_field = :field
+        UNION
+        SELECT fm.tenant, pt.external_type, pt.internal_type, fm.internal_field, fm.external_field
+        FROM field_mappings fm JOIN plugin_types pt USING (type_id)
+        WHERE fm.{0}_enabled AND fm.external_field = :field
+        ORDER BY 1, 2
+    """.format(direction)
+    return conn.execute(query, {'field': field}).fetchall()
+
+
+def print_rows(cursor):
+    columns = [description[0] for description in cursor.description or ()]
+    rows = cursor.fetchall()
+    if columns:
+        print('\t'.join(columns))
+    for row in rows:
+        print('\t'.join('' if value is None else str(value) for value in row))
+    return rows
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Load plugin configuration exports into a SQLite database and query it')
+    parser.add_argument('inputs',
+                        nargs='*',
+                        help='plugin configuration JSON files to ingest (unchanged files are skipped)')
+    parser.add_argument('--db',
+                        type=str,
+                        help='the SQLite database (default {})'.format(DEFAULT_DB),
+                        default=DEFAULT_DB,
+                        dest='db')
+    parser.add_argument('--prune',
+                        action='store_true',
+                        help='remove the tenants that are not among the inputs (requires inputs)',
+                        dest='prune')
+    parser.add_argument('--query',
+                        type=str,
+                        help='SQL to run after ingesting; the results are printed tab-separated',
+                        required=False,
+                        dest='query')
+    parser.add_argument('--outbound-field',
+                        type=str,
+                        help='list the tenants and types that sync this field outbound',
+                        required=False,
+                        dest='outbound_field')
+    parser.add_argument('--inbound-field',
+                        type=str,
+                        help='list the tenants and types that sync this field inbound',
+                        required=False,
+                        dest='inbound_field')
+    args = parser.parse_args()
+    if args.prune and not args.inputs:
+        parser.error('--prune requires the input files of the tenants to keep')
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    conn = open_store(args.db)
+    if args.inputs:
+        start = time.perf_counter()
+        loaded, failed = ingest_files(conn, args.inputs)
+        for fname, error in failed:
+            print('skipped {} ({})'.format(fname, error))
+        print('ingested {} of {} files into {} ({:.0f} ms)'.format(
+            len(loaded), len(args.inputs), args.db, (time.perf_counter() - start) * 1000))
+    if args.prune:
+        removed = prune_tenants(conn, {tenant_name(fname) for fname in args.inputs})
+        if removed:
+            print('removed {}'.format(', '.join(removed)))
+    for direction, field in (('outbound', args.outbound_field), ('inbound', args.inbound_field)):
+        if field:
+            rows = tenants_syncing_field(conn, field, direction)
+            for row in rows:
+                print('\t'.join(row))
+            print('{} mappings sync {} {}'.format(len(rows), field, direction))
+    if args.query:
+        print_rows(conn.execute(args.query))
+    conn.close()
@@ -0,0 +1,303 @@
+"""
+Reads an edited plugin workbook (as written by TC_plugin_to_xlsx.py) back into
+the plugin configuration JSON it came from.
+The workbook is opened with openpyxl in read-only mode and every sheet is
+streamed with iter_rows, so only one row is held in memory at a time however
+big the workbook is. Sheets are matched to plugin types with the same sheet
+name planning the converter uses, the settings on a type sheet are matched to
+their keys through label_mapping, and the Field Mappings columns are found by
+their col_field_mapping1 labels, so reordered columns are fine.
+What is patched into the original export:
+    Limits sheet         plugin-level settings
+    type sheets          the settings of each plugin type, task mapping
+                         settings included (conditions are left alone)
+    Field Mappings       SF Field Name, the empty placeholders, External
+                         Mapped Type and the tick columns. Rows are matched to
+                         the original mappings by Outreach Field Name; new
+                         rows are added as new mappings, and mappings missing
+                         from the sheet are kept (and reported).
+Outreach Field Type, Outreach Record Type and Notes come from the converter's
+preset data rather than the export, so edits to them are only reported.
+Usage:
+    python plugin_xlsx_importer.py --input sage_plugin_configuration.json \\
+        --workbook sage_plugin_configuration.xlsx --output sage_patched.json
+"""
+import argparse
+import copy
+import json
+import os
+
+from openpyxl import load_workbook
+
+from plugin_records import read_plugin_json, get_mappings_dict
+from TC_plugin_to_xlsx import (
+    col_field_mapping1, label_mapping, plan_type_sheet_names, types_mapping_to_preset_data,
+    unicode_symbols, update_external_internal_in_label_mapping, update_provider_in_label_mapping)
+
+TRUE_TEXT = {unicode_symbols['tick'], 'x', 'yes', 'y', 'true', '1'}
+FALSE_TEXT = {unicode_symbols['cross'], '', 'no', 'n', 'false', '0', '-'}
+
+# Field Mappings column (see col_field_mapping1) -> plugin JSON key and kind
+field_mapping_columns = {
+    1: ('ExternalField', 'text'),
+    4: ('InternalDefault', 'text'),
+    5: ('ExternalMappedType', 'text'),
+    6: ('ExternalDefault', 'text'),
+    7: ('MappedField', 'tick'),
+    8: ('LookForNameInsteadOfID', 'tick'),
+    9: ('DisplayNameInsteadOfID', 'tick'),
+    10: ('InboundEnabled', 'tick'),
+    11: ('OutboundEnabled', 'tick'),
+}
+# Columns that come from the converter's preset data, not the export, and
+# their keys in the preset data
+annotation_columns = {2: 'FieldType', 3: 'RecordType', 12: 'Note'}
+name_column = 0
+
+
+def parse_tick(value):
+    """
+    Reads a tick column: a tick (or yes/true/x/1) is True, a cross or an
+    empty cell (or no/false/0) is False.
+    """
+    if isinstance(value, bool):
+        return value
+    text = '' if value is None else str(value).strip().lower()
+    if text in TRUE_TEXT:
+        return True
+    if text in FALSE_TEXT:
+        return False
+    raise ValueError('not a tick: {!r}'.format(value))
+
+
+def parse_setting(value, original):
+    """
+    Reads a setting cell as the same type as the original value.
+    """
+    if isinstance(original, bool):
+        return parse_tick(value)
+    if value is None:
+        return '' if isinstance(original, str) else original
+    if isinstance(original, int) and not isinstance(value, bool):
+        return int(value)
+    if isinstance(original, str):
+        return str(value)
+    return value
+
+
+def parse_text(value):
+    return '' if value is None else str(value)
+
+
+def reverse_labels(lm, data):
+    """
+    Returns {label: key} for the keys of data, using the labels in lm (keys
+    without a label are their own label).
+    """
+    return {lm.get(key, key): key for key in data}
+
+
+class ImportReport():
+    def __init__(self):
+        """
+        The changes (and things that couldn't be imported) found while
+        importing a workbook, as (sheet, item, message) tuples.
+        """
+        self.changes = []
+        self.skipped = []
+
+    def change(self, sheet, item, old, new):
+        self.changes.append((sheet, item, '{!r} -> {!r}'.format(old, new)))
+
+    def skip(self, sheet, item, message):
+        self.skipped.append((sheet, item, message))
+
+
+def _patch_settings(rows, settings, lm, sheet_name, report):
+    """
+    Patches settings (a dictionary of the export) from (label, value) rows.
+    A row with ':' as its value opens a nested dictionary (task mapping
+    settings), which the rows below it belong to; condition blocks are
+    skipped.
+    """
+    labels = reverse_labels(lm, settings)
+    target = settings
+    target_labels = labels
+    for label, value in rows:
+        if label is None:
+            continue  # condition lines
+        key = target_labels.get(label)
+        if key is None and target is not settings:
+            key = labels.get(label)
+            if key is not None:
+                target, target_labels = settings, labels
+        if key is None:
+            report.skip(sheet_name, label, 'no setting with this label')
+            continue
+        original = target[key]
+        if isinstance(original, dict):
+            if original and 'Conditions' not in key and 'ConditionGroups' not in key \
+                    and all(not isinstance(v, (dict, list)) for v in original.values()):
+                target = original
+                target_labels = reverse_labels(lm, original)
+            continue
+        if isinstance(original, list):
+            continue
+        try:
+            new = parse_setting(value, original)
+        except (TypeError, ValueError) as e:
+            report.skip(sheet_name, label, str(e))
+            continue
+        if new != original:
+            report.change(sheet_name, key, original, new)
+            target[key] = new
+
+
+def _display_name(fm):
+    return fm.get('Template') or fm.get('InternalField', '')
+
+
+def _patch_field_mappings(rows, field_mappings, presets, sheet_name, report):
+    """
+    Patches the FieldMappings list of a type from the rows of its Field
+    Mappings sheet. The first row is the header.
+    presets: the converter's preset data for the type, to tell edited preset
+        columns from unedited ones
+    """
+    header = next(rows, None)
+    if header is None:
+        report.skip(sheet_name, '', 'empty sheet')
+        return
+    position = {label: i for i, label in enumerate(header)}
+    columns = {}
+    for col, metadata in col_field_mapping1.items():
+        if metadata['label'] in position:
+            columns[col] = position[metadata['label']]
+    if name_column not in columns:
+        report.skip(sheet_name, '', 'no {} column'.format(col_field_mapping1[name_column]['label']))
+        return
+
+    unmatched = {}
+    for i, fm in enumerate(field_mappings):
+        unmatched.setdefault(_display_name(fm), []).append(i)
+    for row in rows:
+        row = list(row) + [None] * (len(header) - len(row))
+        name = row[columns[name_column]]
+        if name is None or name == '':
+            continue
+        name = str(name)
+        if unmatched.get(name):
+            fm = field_mappings[unmatched[name].pop(0)]
+        else:
+            fm = {'InternalField': name}
+            field_mappings.append(fm)
+            report.change(sheet_name, name, None, 'new mapping')
+        for col, (key, kind) in field_mapping_columns.items():
+            if col not in columns:
+                continue
+            value = row[columns[col]]
+            try:
+                new = parse_tick(value) if kind == 'tick' else parse_text(value)
+            except ValueError as e:
+                report.skip(sheet_name, '{} {}'.format(name, key), str(e))
+                continue
+            old = fm.get(key, False if kind == 'tick' else '')
+            if new != old:
+                report.change(sheet_name, '{} {}'.format(name, key), old, new)
+                fm[key] = new
+        preset = presets.get(name, {})
+        for col, preset_key in annotation_columns.items():
+            if col in columns and parse_text(row[columns[col]]) != preset.get(preset_key, ''):
+                report.skip(sheet_name, '{} {}'.format(name, col_field_mapping1[col]['label']),
+                            'edited preset data, not part of the export')
+    for name, indexes in unmatched.items():
+        for i in indexes:
+            report.skip(sheet_name, name, 'not in the workbook, mapping kept')
+
+
+def import_plugin_workbook(plugin_data, workbook_fname):
+    """
+    Patches a plugin export with the edits made to its workbook.
+    plugin_data: the plugin JSON the workbook was made from (not modified)
+    workbook_fname: the edited workbook
+    Returns the patched plugin JSON and an ImportReport.
+    """
+    patched = copy.deepcopy(plugin_data)
+    report = ImportReport()
+    legacy = patched['Legacy']
+    ptypes = {(ptype['ExternalType'], ptype['InternalType']): ptype
+              for ptype in legacy.get('PluginTypeMappings', [])}
+    limits, type_names, types = get_mappings_dict(plugin_data)
+    sheet_names = plan_type_sheet_names(type_names)
+    update_provider_in_label_mapping(limits)
+    lm = dict(label_mapping)
+
+    wb = load_workbook(workbook_fname, read_only=True, data_only=True)
+    try:
+        if 'Limits' in wb.sheetnames:
+            rows = wb['Limits'].iter_rows(min_row=2, max_col=2, values_only=True)
+            plugin_settings = {key: value for key, value in legacy.items()
+                               if key != 'PluginTypeMappings'}
+            _patch_settings(rows, plugin_settings, lm, 'Limits', report)
+            legacy.update(plugin_settings)
+        for typename in type_names:
+            ptype = ptypes[typename]
+            sheet_name, fm_sheet_name = sheet_names[typename]
+            type_lm = update_external_internal_in_label_mapping(typename, dict(lm))
+            if sheet_name in wb.sheetnames:
+                rows = wb[sheet_name].iter_rows(min_row=2, max_col=2, values_only=True)
+                settings = {key: value for key, value in ptype.items()
+                            if key != 'FieldMappings'}
+                _patch_settings(rows, settings, type_lm, sheet_name, report)
+                ptype.update(settings)
+            else:
+                report.skip(sheet_name, '', 'sheet missing from the workbook')
+            if fm_sheet_name in wb.sheetnames:
+                rows = wb[fm_sheet_name].iter_rows(values_only=True)
+                _patch_field_mappings(rows, ptype['FieldMappings'],
+                                      types_mapping_to_preset_data.get(typename[0], {}),
+                                      fm_sheet_name, report)
+            else:
+                report.skip(fm_sheet_name, '', 'sheet missing from the workbook')
+    finally:
+        wb.close()
+    return patched, report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Patch a plugin configuration JSON export with the edits made to its spreadsheet')
+    parser.add_argument('--input',
+                        type=str,
+                        help='the plugin configuration JSON file the spreadsheet was made from',
+                        required=True,
+                        dest='input')
+    parser.add_argument('--workbook',
+                        type=str,
+                        help='the edited spreadsheet (defaults to the input name with .xlsx)',
+                        required=False,
+                        dest='workbook')
+    parser.add_argument('--output',
+                        type=str,
+                        help='name of the patched JSON file (defaults to the input name with _patched)',
+                        required=False,
+                        dest='output')
+    args = parser.parse_args()
+    base = os.path.splitext(args.input)[0]
+    if not args.workbook:
+        args.workbook = base + '.xlsx'
+    if not args.output:
+        args.output = base + '_patched.json'
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    patched, report = import_plugin_workbook(read_plugin_json(args.input), args.workbook)
+    with open(args.output, 'w') as f:
+        json.dump(patched, f, indent=2)
+    for sheet, item, message in report.changes:
+        print('changed  {}: {} {}'.format(sheet, item, message))
+    for sheet, item, message in report.skipped:
+        print('skipped  {}: {} ({})'.format(sheet, item, message))
+    print('{} changes written to {}'.format(len(report.changes), args.output))
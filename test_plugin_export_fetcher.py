@@ -0,0 +1,76 @@
+import asyncio
+import os
+import shutil
+import threading
+
+import pytest
+
+from http_retry import retry_delay
+from plugin_export_fetcher import FetchError, PluginExportFetcher
+from plugin_export_stub import make_stub_server
+
+EXPORT_FNAME = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'sage_plugin_configuration.json')
+
+
+@pytest.fixture
+def stub_server(tmp_path):
+    """
+    Returns a function that starts a stub server serving the sage export
+    with the given make_stub_server options.
+    """
+    export_dir = tmp_path / 'served'
+    export_dir.mkdir()
+    shutil.copy(EXPORT_FNAME, str(export_dir))
+    servers = []
+
+    def start(**options):
+        server = make_stub_server(str(export_dir), **options)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def fetch_sage(server, dest_dir, max_retries):
+    fetcher = PluginExportFetcher(
+        'http://127.0.0.1:{}/plugins/{{tenant}}/export'.format(server.server_address[1]),
+        max_retries=max_retries)
+    dest_fname = str(dest_dir / 'sage_plugin_configuration.json')
+
+    async def fetch():
+        return await fetcher.fetch('sage', {}, dest_fname, asyncio.Semaphore(1))
+
+    return asyncio.run(fetch())
+
+
+def read_bytes(fname):
+    with open(fname, 'rb') as f:
+        return f.read()
+
+
+def test_fetch_retries_503s_and_cut_off_responses(stub_server, tmp_path):
+    server = stub_server(fail_first=1, cut_off_first=1)
+    dest_fname = fetch_sage(server, tmp_path, max_retries=3)
+    assert server.attempts == {'sage': 3}
+    assert read_bytes(dest_fname) == read_bytes(EXPORT_FNAME)
+    assert sorted(os.listdir(str(tmp_path))) == ['sage_plugin_configuration.json', 'served']
+
+
+def test_fetch_gives_up_without_leaving_a_partial_file(stub_server, tmp_path):
+    server = stub_server(cut_off_first=2)
+    with pytest.raises(FetchError):
+        fetch_sage(server, tmp_path, max_retries=1)
+    assert server.attempts == {'sage': 2}
+    assert os.listdir(str(tmp_path)) == ['served']
+
+
+def test_retry_delay_reads_seconds_and_dates():
+    assert retry_delay('3', 0) == 3.0
+    assert retry_delay('Wed, 21 Oct 2015 07:28:00 GMT', 2) == 0.0  # in the past
+    assert retry_delay('soon', 2) == 4.0
+    assert retry_delay(None, 1) == 2.0
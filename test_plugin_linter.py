@@ -0,0 +1,24 @@
+import io
+
+from openpyxl import load_workbook
+
+import xlsxwritertools
+from plugin_linter import Finding, write_findings_sheet
+
+
+def test_findings_sheet_links_only_known_plugin_types():
+    findings = [Finding('error', 'both-ways', 'Account-Account', 'Name', 'linked'),
+                Finding('warning', 'plugin-rule', '', '', 'no plugin type'),
+                Finding('info', 'plugin-rule', 'Unknown-Type', '', 'no sheet')]
+    output = io.BytesIO()
+    wb = xlsxwritertools.XLSXWorkbook(output)
+    wb.get_new_worksheet('Account')
+    write_findings_sheet(wb, findings, sheet_links={'Account-Account': 'Account'})
+    wb.close_workbook()
+
+    sheet = load_workbook(output)['Findings']
+    assert [sheet.cell(row, 3).value for row in range(2, 5)] == \
+        ['Account-Account', None, 'Unknown-Type']
+    assert sheet.cell(2, 3).hyperlink.location == "'Account'!A1"
+    assert sheet.cell(3, 3).hyperlink is None
+    assert sheet.cell(4, 3).hyperlink is None
@@ -0,0 +1,63 @@
+import re
+import zipfile
+
+import xlsxwritertools
+
+# A streamed sheet must come out as if its cells had been written one by one
+# into a constant_memory sheet.
+
+col_dict_mixed = {0: {"label": "Text", "width": 20, "style": "text_style"},
+                  1: {"label": "Number", "width": 10, "style": "int_style"},
+                  2: {"label": "Flag", "width": 10, "style": "text_style"},
+                  }
+
+mixed_records = [
+    ('plain', 1, True),                  # a row template
+    ('plain', 2, False),
+    ('a < b & c > d', 1.5, None),
+    ('_x0041_ is not an escape', 0.1, ''),
+    ('control \x01 character', 1e20, True),
+    (' leading space', -3, False),
+    ('trailing space ', 2 ** 53, None),
+    ('line\nbreak', 12345678901234567, 'text in a flag column'),
+    ('\ttab', 3.25, True),
+    (None, None, None),
+    ('', 0, 0),
+    ('café ✔ ￾', -0.5, 1),
+]
+
+
+def sheet_xml(wb, sheet_number=1):
+    """
+    Returns the XML of a saved sheet, with the style names in place of the xf
+    indexes, which depend on the order the styles were first used in.
+    """
+    names = {}
+    for name, value in vars(wb).items():
+        xf_index = getattr(value, 'xf_index', None)
+        if xf_index is not None:
+            names.setdefault(str(xf_index), name)
+    with zipfile.ZipFile(wb.filename) as f:
+        xml = f.read('xl/worksheets/sheet{}.xml'.format(sheet_number)).decode('utf-8')
+    return re.sub(r' s="(\d+)"', lambda match: ' s="{}"'.format(names[match.group(1)]), xml)
+
+
+def test_stream_sheet_writes_what_constant_memory_writes(tmp_path):
+    streamed_fname = str(tmp_path / 'streamed.xlsx')
+    wb = xlsxwritertools.XLSXWorkbook(streamed_fname)
+    sheet = wb.get_new_streamed_worksheet('Streamed')
+    wb.stream_sheet(sheet, col_dict_mixed, iter(mixed_records))
+    wb.close_workbook()
+    streamed = sheet_xml(wb)
+
+    written_fname = str(tmp_path / 'written.xlsx')
+    wb = xlsxwritertools.XLSXWorkbook(written_fname)
+    sheet = wb.get_new_streamed_worksheet('Streamed')
+    wb.add_headers(sheet, col_dict_mixed, 0)
+    for row, rec in enumerate(mixed_records, 1):
+        for col, metadata in col_dict_mixed.items():
+            sheet.write(row, col, rec[col], getattr(wb, metadata['style']))
+    wb.close_workbook()
+
+    assert streamed == sheet_xml(wb)
+
@@ -31,21 +31,188 @@ col_dict = {
         }
 --Chris Meyers (cmeyers@zendesk.com) 2017-03-08
 """
+import datetime
+import hashlib
+import io
+import re
+import threading
 import xlsxwriter
+import xlsxwriter.workbook
 import time
+import zipfile
 from decimal import Decimal
+from typing import NamedTuple
 import pandas as pd
+from autofit_spreadsheet_columns import autofit_xlsxwriter_worksheet
+
+# Excel won't accept these characters in a sheet name, nor names longer than
+# 31 characters. Names are also compared case-insensitively.
+INVALID_SHEET_NAME_CHARS = re.compile(r'[\[\]:*?/\\]')
+MAX_SHEET_NAME_LENGTH = 31
+# Creation date written to deterministic workbooks instead of the current time
+DETERMINISTIC_CREATED = datetime.datetime(2000, 1, 1)
+# Zip compression of the output profiles, as (compression, compresslevel):
+#   default  xlsxwriter's own setting (deflate at zlib's default level)
+#   fast     parts stored uncompressed, for intermediate files that are read
+#            again soon: no time is spent deflating, the files are bigger
+#   compact  deflate at the highest level, for files that are handed out
+# Every profile keeps xlsxwriter's shared string table, which stores each
+# distinct string once however many cells hold it.
+OUTPUT_PROFILES = {
+    'default': (zipfile.ZIP_DEFLATED, None),
+    'fast': (zipfile.ZIP_STORED, None),
+    'compact': (zipfile.ZIP_DEFLATED, 9),
+}
+# xlsxwriter opens its ZipFile through a module global, which close_workbook
+# swaps for the length of the save; the lock keeps threads from mixing up
+# each other's profiles.
+_zipfile_lock = threading.Lock()
+# Excel's limits: rows per sheet (the header row included) and characters per
+# cell. xlsxwriter drops rows past the limit and cuts longer strings short.
+MAX_ROWS = 1048576
+MAX_CELL_CHARS = 32767
+
+
+def clean_sheet_name(name):
+    """
+    Makes a name acceptable as a sheet name by replacing the characters Excel
+    rejects and truncating it to the maximum length.
+    name: the wanted sheet name
+    """
+    name = INVALID_SHEET_NAME_CHARS.sub('_', str(name)).strip("'")
+    name = name[:MAX_SHEET_NAME_LENGTH]
+    return name or 'Sheet'
+
+
+def plan_sheet_names(names, reserved=()):
+    """
+    Turns a list of wanted sheet names into valid, unique ones. Names that
+    collide (after cleaning and truncation) get a ' (2)', ' (3)', ... suffix,
+    in the order they appear, so the same input always gives the same names.
+    Planning all of the names up front means a collision can't stop a run
+    halfway through writing the workbook.
+    names: the wanted sheet names, in workbook order
+    reserved: names of sheets that are already taken
+    Returns a list of sheet names, one for each of the names.
+    """
+    taken = {name.lower() for name in reserved}
+    planned = []
+    for name in names:
+        base = clean_sheet_name(name)
+        candidate = base
+        suffix_number = 2
+        while candidate.lower() in taken:
+            suffix = ' ({})'.format(suffix_number)
+            candidate = base[:MAX_SHEET_NAME_LENGTH - len(suffix)] + suffix
+            suffix_number += 1
+        taken.add(candidate.lower())
+        planned.append(candidate)
+    return planned
+
+
+def continuation_sheet_name(name, number):
+    """
+    Returns the wanted name of the number-th sheet of a sheet that ran out of
+    rows, e.g. 'L-Prospect Field Mappings (cont 2)', truncating the name so the
+    suffix always fits.
+    """
+    suffix = ' (cont {})'.format(number)
+    return clean_sheet_name(name)[:MAX_SHEET_NAME_LENGTH - len(suffix)] + suffix
+
+
+def split_cell_text(text, limit=MAX_CELL_CHARS):
+    """
+    Splits a string that is too long for one cell into pieces of at most
+    limit characters, preferring to break after a line break or a space.
+    Returns a list with at least one piece.
+    """
+    pieces = []
+    while len(text) > limit:
+        cut = max(text.rfind('\n', 0, limit), text.rfind(' ', 0, limit)) + 1
+        if cut < limit // 2:
+            cut = limit
+        pieces.append(text[:cut])
+        text = text[cut:]
+    pieces.append(text)
+    return pieces
+
+
+class _ProfileZipFile(zipfile.ZipFile):
+    """
+    A ZipFile that applies an output profile's compression to every part,
+    including those xlsxwriter adds with a ZipInfo of its own.
+    """
+    profile = OUTPUT_PROFILES['default']
+
+    def __init__(self, file, mode='r', compression=zipfile.ZIP_STORED, allowZip64=True):
+        compression, compresslevel = self.profile
+        super().__init__(file, mode, compression, allowZip64, compresslevel)
+
+    def writestr(self, zinfo_or_arcname, data, compress_type=None, compresslevel=None):
+        super().writestr(zinfo_or_arcname, data,
+                         self.compression if compress_type is None else compress_type,
+                         self.compresslevel if compresslevel is None else compresslevel)
+
+
+class StaticSheet(NamedTuple):
+    """
+    A sheet whose content doesn't depend on the data, described as values
+    rather than written cell by cell (see XLSXWorkbook.add_static_sheet).
+    name: the sheet name
+    widths: the width of each column, from column A
+    rows: the rows from the top, each a tuple of (style name, value) cells
+        from column A; the style names are XLSXWorkbook style attributes
+    """
+    name: str
+    widths: tuple
+    rows: tuple
+
+
+def internal_link(sheet_name, string=None):
+    """
+    Builds the url data for a hyperlink to cell A1 of another sheet in the same
+    workbook. The result can be used as the data of a 'url_style' column.
+    sheet_name: the name of the sheet to link to
+    string: the text to display, defaults to the sheet name
+    """
+    quoted = sheet_name.replace("'", "''")
+    return {'url': "internal:'{}'!A1".format(quoted),
+            'string': string if string is not None else sheet_name}
 
 
 class XLSXWorkbook():
-    def __init__(self, filename):
+    # Class-level so that a smaller limit can be set to try the rollover out
+    max_rows = MAX_ROWS
+    max_cell_chars = MAX_CELL_CHARS
+
+    def __init__(self, filename, deterministic=False, profile='default'):
         """
         Init for the class. Since the workbook is needed for all other aspects
         of the class, one will be created here.
         filename: the name of the file where the spreadsheet will be written
+        deterministic: write byte-identical files for identical content. The
+            document creation date is fixed and the workbook is assembled in
+            memory, since xlsxwriter's temporary files leave their local
+            timestamps and permissions in the zip entries.
+        profile: the zip compression of the saved file, 'default', 'fast' or
+            'compact' (see OUTPUT_PROFILES)
         """
+        if profile not in OUTPUT_PROFILES:
+            raise ValueError('unknown output profile {!r}, expected one of {}'.format(
+                profile, ', '.join(OUTPUT_PROFILES)))
         self.filename = filename
-        self.workbook = xlsxwriter.Workbook(self.filename)
+        self.deterministic = deterministic
+        self.profile = profile
+        if deterministic:
+            self.workbook = xlsxwriter.Workbook(self.filename, {'in_memory': True})
+            self.workbook.set_properties({'created': DETERMINISTIC_CREATED})
+        else:
+            self.workbook = xlsxwriter.Workbook(self.filename)
+        # First sheet name -> the sheet and its continuation sheets
+        self.continuations = {}
+        # Names that continuation sheets must not take, e.g. sheets that
+        # will only be added later
+        self.reserved_sheet_names = set()
         self.build_default_styles()
 
     def get_new_worksheet(self, sheetname):
@@ -57,6 +224,86 @@ class XLSXWorkbook():
         sheet = self.workbook.add_worksheet(sheetname)
         return sheet
 
+    def get_new_streamed_worksheet(self, sheetname):
+        """
+        Add a new sheet whose rows are written out to a temporary file as the
+        sheet is filled, in xlsxwriter's constant_memory mode, so a sheet of
+        any length only keeps its current row in memory. Rows have to be
+        written top to bottom; stream_sheet does that. Deterministic workbooks
+        are assembled in memory, where xlsxwriter can't stream, so they get an
+        ordinary sheet.
+        sheetname: the name of the sheet, should follow spreadsheet naming
+            conventions
+        """
+        if self.deterministic:
+            return self.get_new_worksheet(sheetname)
+        # constant_memory is read from the workbook when a sheet is added, so
+        # it is switched on only for this sheet
+        self.workbook.constant_memory = True
+        try:
+            sheet = self.workbook.add_worksheet(sheetname)
+        finally:
+            self.workbook.constant_memory = False
+        return sheet
+
+    def add_static_sheet(self, spec):
+        """
+        Adds a StaticSheet and writes its cells.
+        Returns the new sheet.
+        """
+        sheet = self.get_new_worksheet(spec.name)
+        for col, width in enumerate(spec.widths):
+            sheet.set_column(col, col, width)
+        for row, cells in enumerate(spec.rows):
+            for col, (style_name, value) in enumerate(cells):
+                sheet.write(row, col, value, getattr(self, style_name))
+        return sheet
+
+    def reserve_sheet_names(self, names):
+        """
+        Keeps continuation sheets from taking any of names, for sheets that
+        will be added after them.
+        """
+        self.reserved_sheet_names.update(names)
+
+    def add_continuation_sheet(self, sheet):
+        """
+        Adds the next continuation sheet of a sheet that ran out of rows. The
+        name is worked out from the first sheet's name and the number of
+        sheets so far, so the same data always gives the same names.
+        Returns the new sheet.
+        """
+        chain = self.continuations.setdefault(sheet.name, [sheet])
+        taken = [worksheet.name for worksheet in self.workbook.worksheets()]
+        name = plan_sheet_names([continuation_sheet_name(chain[0].name, len(chain) + 1)],
+                                reserved=taken + sorted(self.reserved_sheet_names))[0]
+        if chain[0].constant_memory:
+            new_sheet = self.get_new_streamed_worksheet(name)
+        else:
+            new_sheet = self.get_new_worksheet(name)
+        chain.append(new_sheet)
+        return new_sheet
+
+    def sheet_for_row(self, sheet, row, col_dict=None, multicol_max_length=0):
+        """
+        Maps a row number that may be past the end of a sheet onto the sheet
+        and row where it goes: rows past the limit go on continuation sheets,
+        each starting below its own header row. Continuation sheets are added
+        as they are needed, with col_dict's headers if one is given.
+        sheet: the first sheet
+        row: the row number, counting on from the end of the first sheet
+        Returns a (sheet, row) tuple.
+        """
+        if row < self.max_rows:
+            return sheet, row
+        index, row = divmod(row - 1, self.max_rows - 1)
+        chain = self.continuations.setdefault(sheet.name, [sheet])
+        while len(chain) <= index:
+            new_sheet = self.add_continuation_sheet(sheet)
+            if col_dict is not None:
+                self.add_headers(new_sheet, col_dict, multicol_max_length)
+        return chain[index], row + 1
+
     def set_style(self, stylename, params):
         """
         Method for adding a style to the workbook. Each style will be a class-
@@ -143,19 +390,24 @@ class XLSXWorkbook():
         """
         Method for adding header labels to a sheet. Will apply the hdr_style
         formatting to each cell and will set the width. The label and width
-        parameters come from the col_dict.
+        parameters come from the col_dict, and a 'note' in the col_dict is
+        added as a comment on the header cell.
         sheet: a sheet object that has been added to a workbook
         col_dict: a dictionary of meta-data about each column
+        multicol_max_length: the number of columns a multicolumn column spans
         """
         for col, metadata in col_dict.items():
             multicol = metadata.get('multicolumn', False)
+            if 'note' in metadata:
+                sheet.write_comment(0, col, metadata['note'])
             if not multicol:
                 sheet.set_column(col, col, metadata['width'])
                 sheet.write(0, col, metadata['label'], self.hdr_style)
-            else:
+            elif multicol_max_length > 0:
+                sheet.set_column(col, col + multicol_max_length - 1,
+                                 metadata['width'])
                 for i in range(0, multicol_max_length):
                     new_col = col + i
-                    sheet.set_column(new_col, new_col, metadata['width'])
                     sheet.write(0, new_col, metadata['label'], self.hdr_style)
 
     def add_sub_headers(self, sheet, col_dict, multicol_max_length, row, column):
@@ -192,9 +444,6 @@ class XLSXWorkbook():
             or in the case of a URL, a dictionary
         """
         style_string = metadata['style']
-        if 'note' in metadata.keys():
-            # print(row,col,metadata)
-            sheet.write_comment(0, col, metadata['note'])
         if style_string == 'url_style':
             if isinstance(data, dict):
                 # If the url data is a dictionary, that means that it could
@@ -203,8 +452,8 @@ class XLSXWorkbook():
             else:
                 sheet.write_url(row, col, data)
         elif metadata.get('multicolumn', False):
+            style = getattr(self, style_string)
             for i, val in enumerate(data):
-                style = getattr(self, style_string)
                 new_col = col + i
                 sheet.write(row, new_col, val, style)
         elif 'dropdown' in metadata.keys():
@@ -216,35 +465,127 @@ class XLSXWorkbook():
             style = getattr(self, style_string)
             sheet.write(row, col, data, style)
 
-    def fill_sheet(self, sheet, col_dict, data):
+    def _bound_multicolumn(self, metadata, rec, values, spill):
+        """
+        Caps the number of columns a multicolumn value takes up. The cap comes
+        from 'max_columns' in the column meta-data (no cap if it's missing).
+        With 'overflow': 'spill' the values past the cap are added to the
+        spill list as (rec, value) tuples, for the caller to write somewhere
+        else. Otherwise (the 'join' default) the last visible cell holds the
+        remaining values joined with 'join_with' (', ' by default).
+        """
+        max_columns = metadata.get('max_columns')
+        if not max_columns or len(values) <= max_columns:
+            return values
+        if metadata.get('overflow', 'join') == 'spill' and spill is not None:
+            spill.extend((rec, value) for value in values[max_columns:])
+            return values[:max_columns]
+        join_with = metadata.get('join_with', ', ')
+        joined = join_with.join(str(value) for value in values[max_columns - 1:])
+        return list(values[:max_columns - 1]) + [joined]
+
+    def _split_long_values(self, col_dict, rec, spill):
+        """
+        Bounds the multicolumn values of a record and splits the strings that
+        don't fit in a cell.
+        Returns the values to write, by column, and {column: [remaining
+        pieces]} for the split strings.
+        """
+        values = {}
+        overflow = {}
+        for col, metadata in col_dict.items():
+            value = rec[col]
+            if metadata.get('multicolumn', False):
+                value = list(self._bound_multicolumn(metadata, rec, value, spill))
+                for i, item in enumerate(value):
+                    if isinstance(item, str) and len(item) > self.max_cell_chars:
+                        pieces = split_cell_text(item, self.max_cell_chars)
+                        value[i] = pieces[0]
+                        overflow[col + i] = (pieces[1:], metadata)
+            elif isinstance(value, str) and len(value) > self.max_cell_chars \
+                    and metadata['style'] != 'url_style':
+                pieces = split_cell_text(value, self.max_cell_chars)
+                value = pieces[0]
+                overflow[col] = (pieces[1:], metadata)
+            values[col] = value
+        return values, overflow
+
+    def fill_sheet(self, sheet, col_dict, data, spill=None):
         """
         Method to fill a worksheet with simple data.
         sheet: A sheet object that has been added to a workbook.
         col_dict: A dictionary of meta-data about each column; the expected
-            keys are label, width, and style.
+            keys are label, width, and style. Multicolumn columns can also
+            have max_columns, overflow and join_with keys (see
+            _bound_multicolumn).
         data: The data to be added to the sheet. Should be a container of
             containers of data, i.e. a list of lists.
+        spill: Optional list that receives the multicolumn values that didn't
+            fit, when a column has 'overflow': 'spill'.
+        Rows past Excel's row limit go on continuation sheets, which get the
+        same headers, and a string too long for a cell carries on in the cells
+        below it.
         Returns an integer which is the number of the first open row at the
-        bottom of the sheet.
+        bottom of the sheet. Once the sheet has run out of rows this counts
+        on past its end; sheet_for_row turns it into a sheet and row.
         """
+        # The width of the multicolumn columns is worked out while the rows
+        # are written, and the headers are added once it is known.
         multicol_max_length = 0
-        for col, metadata in col_dict.items():
-            if metadata.get('multicolumn', False) and multicol_max_length == 0:
-                for datarow in data:
-                    if len(datarow[col]) > multicol_max_length:
-                        multicol_max_length = len(datarow[col])
-        self.add_headers(sheet, col_dict, multicol_max_length)
         row = 1
         for rec in data:
-            # print(rec)
+            values, overflow = self._split_long_values(col_dict, rec, spill)
+            target, target_row = self.sheet_for_row(sheet, row)
             for col, metadata in col_dict.items():
-                # print(col, metadata)
-                # print(sheet, row, col, metadata, rec[col], multicol_max_length)
-                # if rec[9]:
-                #     sheet.write_comment(row,0,rec[9])
+                value = values[col]
+                if metadata.get('multicolumn', False):
+                    if len(value) > multicol_max_length:
+                        multicol_max_length = len(value)
                 self._write_data_to_column(
-                    sheet, row, col, metadata, rec[col], multicol_max_length)
+                    target, target_row, col, metadata, value, multicol_max_length)
+            row += 1
+            # The rest of the split strings, one piece per row below
+            for i in range(max((len(pieces) for pieces, metadata in overflow.values()), default=0)):
+                target, target_row = self.sheet_for_row(sheet, row)
+                for col, (pieces, metadata) in overflow.items():
+                    if i < len(pieces):
+                        target.write(target_row, col, pieces[i], getattr(self, metadata['style']))
+                row += 1
+        for target in self.continuations.get(sheet.name, [sheet]):
+            self.add_headers(target, col_dict, multicol_max_length)
+        return row
+
+    def stream_sheet(self, sheet, col_dict, data):
+        """
+        Fills a sheet row by row from an iterable of records, for sheets too
+        long to build as a list first. The headers are written first and every
+        record is written as soon as it is read, so the records are never all
+        held in memory; on a sheet from get_new_streamed_worksheet xlsxwriter
+        also writes each finished row out to the sheet's temporary file. Rows
+        past Excel's row limit go on continuation sheets and long strings
+        carry on in the cells below, as in fill_sheet.
+        sheet: A sheet object that has been added to a workbook.
+        col_dict: A dictionary of meta-data about each column, with the keys
+            of fill_sheet; multicolumn and url_style columns aren't supported.
+        data: An iterable of records, e.g. a generator of tuples.
+        Returns the number of the first open row, as fill_sheet does.
+        """
+        self.add_headers(sheet, col_dict, 0)
+        styles = {col: getattr(self, metadata['style']) for col, metadata in col_dict.items()}
+        row = 1
+        for rec in data:
+            values, overflow = self._split_long_values(col_dict, rec, None)
+            target, target_row = self.sheet_for_row(sheet, row, col_dict)
+            for col, style in styles.items():
+                target.write(target_row, col, values[col], style)
             row += 1
+            # The rest of the split strings, one piece per row below
+            for i in range(max((len(pieces) for pieces, metadata in overflow.values()), default=0)):
+                target, target_row = self.sheet_for_row(sheet, row, col_dict)
+                for col, (pieces, metadata) in overflow.items():
+                    if i < len(pieces):
+                        target.write(target_row, col, pieces[i], styles[col])
+                row += 1
         return row
 
     def fill_sheet_from_profile_objects(self, sheet, col_dict, object_list):
@@ -352,11 +693,46 @@ class XLSXWorkbook():
         sheet.set_column(shift, max_col - 1, 12)
         return max_row+row+1
 
+    def autofit_columns(self):
+        """
+        Sets the width of every column from its widest value, like
+        autofit_spreadsheet_columns does, but before the workbook is saved so
+        the file doesn't have to be loaded and saved again.
+        """
+        for sheet in self.workbook.worksheets():
+            autofit_xlsxwriter_worksheet(sheet)
+
     def close_workbook(self):
         """
         Closing and saving the workbook.
+        With the fast and compact profiles, xlsxwriter's ZipFile global is
+        swapped for the length of the save and then set back to what it was.
+        _zipfile_lock only serialises the saves made through XLSXWorkbook; an
+        xlsxwriter Workbook closed directly on another thread at the same time
+        would pick up the profile's compression.
+        Returns the hex sha256 of the saved file, which only depends on the
+        content when the workbook is deterministic.
         """
-        self.workbook.close()
+        if self.profile == 'default':
+            self.workbook.close()
+        else:
+            zip_class = type('ProfileZipFile', (_ProfileZipFile,),
+                             {'profile': OUTPUT_PROFILES[self.profile]})
+            with _zipfile_lock:
+                previous_zip_class = xlsxwriter.workbook.ZipFile
+                xlsxwriter.workbook.ZipFile = zip_class
+                try:
+                    self.workbook.close()
+                finally:
+                    xlsxwriter.workbook.ZipFile = previous_zip_class
+        digest = hashlib.sha256()
+        if isinstance(self.filename, io.BytesIO):
+            digest.update(self.filename.getbuffer())
+        else:
+            with open(self.filename, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+        return digest.hexdigest()
 
     def add_single_row_new_way(self, sheet, row, col, col_dict, data):
         """
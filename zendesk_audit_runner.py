@@ -0,0 +1,305 @@
+"""
+Runs the field and form audit of form_and_field_details over many Zendesk
+instances at once.
+All of the instances are fetched concurrently from a thread pool. Requests to
+each host go through a RateLimiter shared by every session talking to that
+host, and a 429 response is retried after its Retry-After delay, so the
+instances don't get throttled however many workers are running.
+The results can be written as one workbook per subdomain (--output-dir), as a
+single combined workbook (--combined), or both. The combined workbook starts
+with a 'Field Comparison' sheet lining up the fields of every instance by
+title, followed by the field sheets of each instance. The per-form tabs and
+the 'Field Options' sheet are only written to the per-subdomain workbooks.
+The credentials file is a JSON object keyed by subdomain:
+    {
+        "z3n198": {"email": "admin@example.com", "token": "..."},
+        "acme": {"email": "admin@acme.com", "token": "...",
+                 "base_url": "https://support.acme.com/api/v2/"}
+    }
+base_url is optional and defaults to https://<subdomain>.zendesk.com/api/v2/.
+Usage:
+    python zendesk_audit_runner.py --credentials creds.json --combined audit.xlsx
+"""
+import argparse
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+
+import form_and_field_details as ffd
+import xlsxwritertools
+from http_retry import retry_delay
+
+
+class RateLimiter():
+    def __init__(self, requests_per_minute):
+        """
+        Spaces out requests so no more than requests_per_minute are started
+        in any minute. Safe to share between threads.
+        """
+        self.interval = 60.0 / requests_per_minute
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self):
+        """
+        Blocks until the caller may send its request.
+        """
+        with self.lock:
+            now = time.monotonic()
+            start_time = max(now, self.next_time)
+            self.next_time = start_time + self.interval
+        delay = start_time - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class RateLimitedSession(requests.Session):
+    def __init__(self, limiter, max_retries=5):
+        """
+        A requests session that waits on a RateLimiter before every request
+        and retries requests that were rate limited (HTTP 429).
+        """
+        super().__init__()
+        self.limiter = limiter
+        self.max_retries = max_retries
+
+    def request(self, method, url, *args, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            self.limiter.wait()
+            response = super().request(method, url, *args, **kwargs)
+            if response.status_code != 429 or attempt == self.max_retries:
+                return response
+            time.sleep(retry_delay(response.headers.get('Retry-After'), attempt))
+        return response
+
+
+class AuditRunner():
+    def __init__(self, requests_per_minute=200, workers=8):
+        """
+        Fetches the ticket fields and forms of many instances.
+        requests_per_minute: the request budget for each host
+        workers: the number of instances fetched at the same time
+        """
+        self.requests_per_minute = requests_per_minute
+        self.workers = workers
+        self.limiters = {}
+        self.limiters_lock = threading.Lock()
+
+    def get_limiter(self, base_url):
+        host = urlsplit(base_url).netloc
+        with self.limiters_lock:
+            if host not in self.limiters:
+                self.limiters[host] = RateLimiter(self.requests_per_minute)
+            return self.limiters[host]
+
+    def build_session(self, email, token, base_url):
+        session = RateLimitedSession(self.get_limiter(base_url))
+        session.auth = ('{}/token'.format(email), token)
+        session.headers = {'Content-Type': 'application/json'}
+        return session
+
+    def fetch_instance(self, subdomain, creds):
+        base_url = creds.get('base_url') or ffd.build_base_url(subdomain)
+        session = self.build_session(creds['email'], creds['token'], base_url)
+        ticket_fields = ffd.get_field_info(session, base_url)
+        ticket_forms = ffd.get_form_info(session, base_url)
+        return ticket_fields, ticket_forms
+
+    def _fetch_or_fail(self, subdomain, creds):
+        try:
+            return self.fetch_instance(subdomain, creds), None
+        except (requests.RequestException, ValueError, KeyError) as e:
+            return None, e
+
+    def fetch_all(self, credentials):
+        """
+        Fetches every instance in the credentials dictionary.
+        Returns a dictionary of subdomain -> (ticket_fields, ticket_forms)
+        for the instances that worked, in credentials order, and a
+        dictionary of subdomain -> exception for the ones that didn't.
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {subdomain: executor.submit(self._fetch_or_fail, subdomain, creds)
+                       for subdomain, creds in credentials.items()}
+            results = {}
+            failures = {}
+            for subdomain, future in futures.items():
+                data, error = future.result()
+                if error is None:
+                    results[subdomain] = data
+                    print('retrieved {}'.format(subdomain))
+                else:
+                    failures[subdomain] = error
+                    print('FAILED {}: {}'.format(subdomain, error))
+        return results, failures
+
+
+def describe_fields(fields):
+    """
+    Describes the fields of one instance sharing a title, e.g. 'tagger' or
+    'text (inactive)'.
+    """
+    descriptions = []
+    for fld in fields:
+        description = fld['type']
+        if not fld.get('active', True):
+            description += ' (inactive)'
+        descriptions.append(description)
+    return ', '.join(descriptions)
+
+
+def build_comparison_rows(results):
+    """
+    Lines up the fields of every instance by title.
+    results: dictionary of subdomain -> (ticket_fields, ticket_forms)
+    Returns one row per title: the title, the number of instances that have
+    it, whether the type is the same everywhere, and then a description of
+    the field in each instance (blank where it's missing).
+    """
+    subdomains = list(results)
+    by_title = {}
+    for index, subdomain in enumerate(subdomains):
+        ticket_fields = results[subdomain][0]
+        for fld in ticket_fields['ticket_fields']:
+            cells = by_title.get(fld['title'])
+            if cells is None:
+                cells = by_title[fld['title']] = [[] for _ in subdomains]
+            cells[index].append(fld)
+    rows = []
+    for title in sorted(by_title):
+        cells = by_title[title]
+        types = {fld['type'] for fields in cells for fld in fields}
+        row = [title,
+               sum(1 for fields in cells if fields),
+               'Yes' if len(types) == 1 else 'No']
+        row.extend(describe_fields(fields) for fields in cells)
+        rows.append(row)
+    return rows
+
+
+def write_subdomain_workbooks(results, output_dir, max_form_columns=None, form_overflow='join'):
+    os.makedirs(output_dir, exist_ok=True)
+    for subdomain, (ticket_fields, ticket_forms) in results.items():
+        output_fname = os.path.join(
+            output_dir, '{}_fields_and_forms.xlsx'.format(subdomain))
+        inform_field_rows, notinform_field_rows, all_form_info, unique_names = \
+            ffd.build_report_data(ticket_fields, ticket_forms)
+        ffd.write_spreadsheet(output_fname, inform_field_rows, notinform_field_rows,
+                              all_form_info, max_form_columns, form_overflow,
+                              ffd.iter_field_option_rows([ticket_fields['ticket_fields']],
+                                                         unique_names))
+        print('Report for {} written to {}'.format(subdomain, output_fname))
+
+
+def write_combined_workbook(results, output_fname, max_form_columns=None, form_overflow='join'):
+    comparison_name = 'Field Comparison'
+    wanted = []
+    for subdomain in results:
+        wanted.extend(['In Forms - {}'.format(subdomain),
+                       'Not in Forms - {}'.format(subdomain),
+                       'Overflow - {}'.format(subdomain)])
+    planned = xlsxwritertools.plan_sheet_names(
+        wanted, reserved=[comparison_name])
+
+    wb = xlsxwritertools.XLSXWorkbook(output_fname)
+    sheet = wb.get_new_worksheet(comparison_name)
+    col_dict = {0: {"label": "Field Name", "width": 24, "style": "text_style"},
+            1: {"label": "Instances", "width": 10, "style": "int_style"},
+            2: {"label": "Same Type", "width": 10, "style": "text_style"},
+            }
+    for i, subdomain in enumerate(results):
+        col_dict[3 + i] = {"label": subdomain, "width": 18, "style": "text_style"}
+    wb.fill_sheet(sheet, col_dict, build_comparison_rows(results))
+
+    for i, (subdomain, (ticket_fields, ticket_forms)) in enumerate(results.items()):
+        inform_field_rows, notinform_field_rows = ffd.build_report_data(
+            ticket_fields, ticket_forms)[:2]
+        ffd.write_field_sheets(wb, inform_field_rows, notinform_field_rows,
+                               max_form_columns, form_overflow,
+                               sheet_names=planned[3 * i:3 * i + 3])
+    wb.close_workbook()
+    print('Combined report written to {}'.format(output_fname))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+            description=('Get the field and ticket form info from many subdomains '
+            'and put it into spreadsheets'))
+    parser.add_argument('--credentials',
+            type=str,
+            help='path to a JSON file of subdomain -> {"email": ..., "token": ...}',
+            required=True,
+            dest='credentials')
+    parser.add_argument('--subdomains',
+            nargs='+',
+            help='only audit these subdomains from the credentials file',
+            required=False,
+            dest='subdomains')
+    parser.add_argument('--output-dir',
+            type=str,
+            help='write one workbook per subdomain into this directory',
+            required=False,
+            dest='output_dir')
+    parser.add_argument('--combined',
+            type=str,
+            help='write one combined workbook with a field comparison sheet',
+            required=False,
+            dest='combined')
+    parser.add_argument('--workers',
+            type=int,
+            help='number of subdomains fetched at the same time (default 8)',
+            default=8,
+            dest='workers')
+    parser.add_argument('--requests-per-minute',
+            type=int,
+            help='request budget per host (default 200)',
+            default=200,
+            dest='requests_per_minute')
+    parser.add_argument('--max-form-columns',
+            type=int,
+            help='most "In Form" columns to show per field, 0 for no limit (default 25)',
+            default=25,
+            dest='max_form_columns')
+    parser.add_argument('--form-overflow',
+            choices=['join', 'sheet'],
+            help='what to do with the forms past --max-form-columns (see form_and_field_details.py)',
+            default='join',
+            dest='form_overflow')
+    args = parser.parse_args()
+    if not args.output_dir and not args.combined:
+        parser.error('at least one of --output-dir and --combined is required')
+    return args
+
+
+def load_credentials(fname, subdomains=None):
+    credentials = ffd.load_json_data(fname)
+    if subdomains:
+        missing = [s for s in subdomains if s not in credentials]
+        if missing:
+            e = "No credentials for {}".format(', '.join(missing))
+            raise Exception(e)
+        credentials = {s: credentials[s] for s in subdomains}
+    return credentials
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    credentials = load_credentials(args.credentials, args.subdomains)
+    runner = AuditRunner(args.requests_per_minute, args.workers)
+    start = time.monotonic()
+    results, failures = runner.fetch_all(credentials)
+    print('fetched {} of {} subdomains in {:.1f}s'.format(
+        len(results), len(credentials), time.monotonic() - start))
+    form_overflow = 'spill' if args.form_overflow == 'sheet' else 'join'
+    if args.output_dir:
+        write_subdomain_workbooks(results, args.output_dir,
+                                  args.max_form_columns, form_overflow)
+    if args.combined and results:
+        write_combined_workbook(results, args.combined,
+                                args.max_form_columns, form_overflow)
+    if failures:
+        raise SystemExit('Failed subdomains: {}'.format(', '.join(failures)))
@@ -0,0 +1,280 @@
+"""
+Snapshot store and change feed for Zendesk ticket field and form metadata.
+Every run stores the fetched ticket_fields and ticket_forms payloads as a
+timestamped, gzipped snapshot under <store>/<subdomain>/. Each field and form
+is hashed once, by id; the snapshots are listed in index.json together with a
+sha256 of those hashes, which doesn't depend on the order the API returned
+the records in. A payload whose hash is already in the store isn't written
+again, so an hourly run over an instance that didn't change only adds an
+index entry.
+The latest snapshot is then compared with the previous one by matching up the
+hashes of their fields and forms through dictionaries, so it is linear in the
+size of the payloads. When nothing changed no workbook is written; otherwise
+the report of form_and_field_details is regenerated with a 'Changes' sheet in
+front, or just the 'Changes' sheet with --delta-only.
+Usage:
+    python zendesk_snapshots.py --subdomain z3n198 --email me@example.com --token ... \\
+        --store snapshots --output z3n198_fields_and_forms.xlsx
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import time
+
+import form_and_field_details as ffd
+import xlsxwritertools
+
+INDEX_FNAME = 'index.json'
+
+
+def content_hash(data):
+    """
+    Returns the sha256 of a JSON-able object, independent of key order.
+    """
+    canonical = json.dumps(data, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def snapshot_records(snapshot):
+    """
+    Returns the fields and the forms of a (ticket_fields, ticket_forms)
+    snapshot as {id: record} dictionaries.
+    """
+    ticket_fields, ticket_forms = snapshot
+    return (ffd.get_fid_dict(ticket_fields),
+            {form['id']: form for form in ticket_forms['ticket_forms']})
+
+
+def record_hashes(records):
+    """
+    Returns the {id: content_hash} dictionaries of the (fields, forms) of
+    snapshot_records.
+    """
+    return tuple({rid: content_hash(record) for rid, record in kind_records.items()}
+                 for kind_records in records)
+
+
+class SnapshotStore():
+    def __init__(self, store_dir, subdomain):
+        """
+        The snapshots of one instance.
+        store_dir: the root directory of the store
+        subdomain: the instance, snapshots are kept in a directory of its own
+        """
+        self.directory = os.path.join(store_dir, subdomain)
+        self.index_fname = os.path.join(self.directory, INDEX_FNAME)
+
+    def load_index(self):
+        """
+        Returns the index: {'snapshots': [{'timestamp', 'hash', 'file'}, ...]}
+        oldest first, and {'files': {hash: file}}.
+        """
+        if not os.path.exists(self.index_fname):
+            return {'snapshots': [], 'files': {}}
+        return ffd.load_json_data(self.index_fname)
+
+    def save_index(self, index):
+        tmp_fname = self.index_fname + '.tmp'
+        with open(tmp_fname, 'w') as f:
+            json.dump(index, f, indent=1)
+        os.replace(tmp_fname, self.index_fname)
+
+    def add(self, ticket_fields, ticket_forms, hashes=None):
+        """
+        Stores a snapshot. The payloads are only written when their content
+        isn't in the store already.
+        hashes: the record_hashes of the snapshot, when already computed
+        Returns the index entry of the new snapshot.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        payload = {'ticket_fields': ticket_fields['ticket_fields'],
+                   'ticket_forms': ticket_forms['ticket_forms']}
+        if hashes is None:
+            hashes = record_hashes(snapshot_records((ticket_fields, ticket_forms)))
+        digest = content_hash(hashes)
+        timestamp = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+        index = self.load_index()
+        if digest not in index['files']:
+            fname = '{}-{}.json.gz'.format(timestamp, digest[:12])
+            tmp_fname = os.path.join(self.directory, fname + '.tmp')
+            with gzip.open(tmp_fname, 'wt', encoding='utf-8') as f:
+                json.dump(payload, f)
+            os.replace(tmp_fname, os.path.join(self.directory, fname))
+            index['files'][digest] = fname
+        entry = {'timestamp': timestamp, 'hash': digest,
+                 'file': index['files'][digest]}
+        index['snapshots'].append(entry)
+        self.save_index(index)
+        return entry
+
+    def load(self, entry):
+        """
+        Returns the (ticket_fields, ticket_forms) payloads of an index entry.
+        """
+        with gzip.open(os.path.join(self.directory, entry['file']), 'rt', encoding='utf-8') as f:
+            payload = json.load(f)
+        return ({'ticket_fields': payload['ticket_fields']},
+                {'ticket_forms': payload['ticket_forms']})
+
+    def latest_two(self):
+        """
+        Returns the index entries of the previous and the latest snapshot;
+        either can be None when the store has fewer than two.
+        """
+        snapshots = self.load_index()['snapshots']
+        latest = snapshots[-1] if snapshots else None
+        previous = snapshots[-2] if len(snapshots) > 1 else None
+        return previous, latest
+
+
+def diff_records(kind, old_records, new_records, name_key, old_hashes, new_hashes):
+    """
+    Compares two {id: record} dictionaries through their {id: content_hash}
+    dictionaries.
+    Returns one row per added, removed or changed record: kind, id, name,
+    change, and for changed records the keys whose values differ.
+    """
+    rows = []
+    for rid, new in new_records.items():
+        old = old_records.get(rid)
+        if old is None:
+            rows.append([kind, rid, new.get(name_key, ''), 'added', ''])
+        elif old_hashes[rid] != new_hashes[rid]:
+            keys = sorted(k for k in set(old) | set(new) if old.get(k) != new.get(k))
+            rows.append([kind, rid, new.get(name_key, ''), 'changed', ', '.join(keys)])
+    for rid, old in old_records.items():
+        if rid not in new_records:
+            rows.append([kind, rid, old.get(name_key, ''), 'removed', ''])
+    return rows
+
+
+def build_delta_rows(old, new, new_hashes=None):
+    """
+    Compares two (ticket_fields, ticket_forms) snapshots field by field and
+    form by form. An empty list means nothing changed.
+    new_hashes: the record_hashes of new, when already computed
+    """
+    old_fields, old_forms = old_records = snapshot_records(old)
+    new_fields, new_forms = new_records = snapshot_records(new)
+    old_field_hashes, old_form_hashes = record_hashes(old_records)
+    new_field_hashes, new_form_hashes = new_hashes or record_hashes(new_records)
+    rows = diff_records('field', old_fields, new_fields, 'title',
+                        old_field_hashes, new_field_hashes)
+    rows.extend(diff_records('form', old_forms, new_forms, 'name',
+                             old_form_hashes, new_form_hashes))
+    return rows
+
+
+changes_sheet_name = 'Changes'
+
+delta_col_dict = {0: {"label": "Kind", "width": 8, "style": "text_style"},
+        1: {"label": "ID", "width": 14, "style": "idnum_style"},
+        2: {"label": "Name", "width": 30, "style": "text_style"},
+        3: {"label": "Change", "width": 10, "style": "text_style"},
+        4: {"label": "Changed Keys", "width": 40, "style": "text_style"},
+        }
+
+
+def write_report(output_fname, snapshot, delta_rows=None, delta_only=False,
+                 max_form_columns=None, form_overflow='join'):
+    """
+    Writes the report of a snapshot, with a 'Changes' sheet in front when
+    there are delta rows.
+    """
+    wb = xlsxwritertools.XLSXWorkbook(output_fname)
+    reserved = ffd.field_sheet_names + (ffd.option_sheet_name,)
+    if delta_rows is not None:
+        sheet = wb.get_new_worksheet(changes_sheet_name)
+        wb.fill_sheet(sheet, delta_col_dict, delta_rows)
+        reserved += (changes_sheet_name,)
+    if not delta_only:
+        inform_field_rows, notinform_field_rows, all_form_info, unique_names = \
+            ffd.build_report_data(*snapshot)
+        form_sheet_names = ffd.plan_form_sheet_names(all_form_info, reserved)
+        wb.reserve_sheet_names(form_sheet_names.values())
+        ffd.write_field_sheets(wb, inform_field_rows, notinform_field_rows,
+                               max_form_columns, form_overflow)
+        ffd.write_option_sheet(wb, ffd.iter_field_option_rows([snapshot[0]['ticket_fields']],
+                                                              unique_names))
+        ffd.write_form_sheets(wb, all_form_info, form_sheet_names)
+    wb.close_workbook()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+            description=('Snapshot the field and ticket form info of a subdomain and '
+            'regenerate the spreadsheet only when something changed'))
+    parser.add_argument('--subdomain',
+            type=str,
+            help='Subdomain to query, also names the snapshot directory',
+            required=True)
+    parser.add_argument('--email',
+            type=str,
+            help='email to use for API call (not required)',
+            required=False)
+    parser.add_argument('--token',
+            type=str,
+            help='API token to use for API calls (not required unless email is provided)',
+            required=False)
+    parser.add_argument('--field-file',
+            type=str,
+            help='path to JSON file holding field information',
+            required=False,
+            dest='field_file')
+    parser.add_argument('--form-file',
+            type=str,
+            help='path to JSON file holding ticket form information',
+            required=False,
+            dest='form_file')
+    parser.add_argument('--store',
+            type=str,
+            help='directory holding the snapshots',
+            required=True,
+            dest='store')
+    parser.add_argument('--output',
+            type=str,
+            help="Name of the spreadsheet output file",
+            required=True,
+            dest="output")
+    parser.add_argument('--delta-only',
+            action='store_true',
+            help='only write the Changes sheet',
+            dest='delta_only')
+    parser.add_argument('--compare-only',
+            action='store_true',
+            help="don't fetch a new snapshot, compare the two latest ones in the store",
+            dest='compare_only')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    store = SnapshotStore(args.store, args.subdomain)
+    latest_hashes = None
+    if not args.compare_only:
+        ticket_fields, ticket_forms = ffd.get_field_and_form_data(args)
+        latest_hashes = record_hashes(snapshot_records((ticket_fields, ticket_forms)))
+        entry = store.add(ticket_fields, ticket_forms, latest_hashes)
+        print('stored snapshot {} ({})'.format(entry['timestamp'], entry['file']))
+    previous, latest = store.latest_two()
+    if latest is None:
+        raise SystemExit('No snapshots in {}'.format(store.directory))
+    snapshot = None
+    delta_rows = None
+    if previous is not None and previous['hash'] == latest['hash']:
+        delta_rows = []
+    elif previous is not None:
+        # Snapshots stored before the hash was order-independent can differ
+        # in hash alone, so the records decide.
+        snapshot = store.load(latest)
+        delta_rows = build_delta_rows(store.load(previous), snapshot, latest_hashes)
+    if delta_rows == []:
+        print('No changes since {}, report not regenerated'.format(previous['timestamp']))
+    else:
+        if delta_rows is not None:
+            print('{} changes since {}'.format(len(delta_rows), previous['timestamp']))
+        write_report(args.output, snapshot or store.load(latest), delta_rows, args.delta_only)
+        print('Complete! Report written to {}'.format(args.output))